@@ -7,16 +7,40 @@ TILE_SIZE = 8029
 TILE_SIDE = 256
 ZOOM_LEVELS = [0, 0.25, 0.5, 0.75, 1]
 
-def get_size(original_size, width, height):
-    T = original_size + THUMBNAIL_SIZE
+# Zoom levels that are tiled on demand (lazy_scales)
+LAZY_ZOOM_LEVELS = [0.75, 1]
+
+def get_tiles(width, height, zoom_levels):
     n = 0
-    for z in ZOOM_LEVELS:
+    for z in zoom_levels:
         n = n + (ceil(width * z / TILE_SIDE) * ceil(height * z / TILE_SIDE))
+    return n
+
+# Levels of a Deep Zoom pyramid (pyramid = deepzoom), from the original image
+# down to a single pixel
+def get_deepzoom_tiles(width, height):
+    n = 0
+    while True:
+        n = n + (ceil(width / float(TILE_SIDE)) * ceil(height / float(TILE_SIDE)))
+        if width == 1 and height == 1:
+            return n
+        width = ceil(width / 2.0)
+        height = ceil(height / 2.0)
+
+def get_size(original_size, width, height):
+    T = original_size + THUMBNAIL_SIZE
+    n = get_tiles(width, height, ZOOM_LEVELS)
     T = T + n * TILE_SIZE
+    lazy = get_tiles(width, height, LAZY_ZOOM_LEVELS) * TILE_SIZE
     print "Original size:", original_size, 'bytes'
     print "Resolution:", str(width) + 'x' + str(height)
     print "Total size:", T, 'bytes'
     print "Percentage extra:", (T - original_size) * 100 / T
+    print "Total size with zoom levels", LAZY_ZOOM_LEVELS, "tiled on demand:", T - lazy, 'bytes'
+    print "Percentage of the tiles saved:", lazy * 100 / (n * TILE_SIZE)
+    deepzoom = get_deepzoom_tiles(width, height)
+    print "Total size with a Deep Zoom pyramid:", original_size + THUMBNAIL_SIZE + deepzoom * TILE_SIZE, 'bytes'
+    print "Percentage of the tiles saved:", (n - deepzoom) * 100 / n
 
 types=[
     {"type": "DCM", "size": 4196978, "width": 2048, "height": 1024},
@@ -0,0 +1,189 @@
+#! /usr/bin/python
+#
+# Copyright 2014 Medical Research Council Harwell.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# @author Gagarine Yaikhom <g.yaikhom@har.mrc.ac.uk>
+#
+
+# DESCRIPTION:
+#
+# Measures the speedup of concurrent downloads (see workers in the [download]
+# section of phenodcc_media.config). A local HTTP server stands in for the file
+# server of a centre: it serves a synthetic corpus of media files, and waits for
+# the supplied latency before every response, as a remote server would. The
+# corpus is then downloaded by phenodcc_media.py with several numbers of download
+# workers. The media files are shared amongst the workers exactly as in the
+# download phase, but the phase and status of the media files are not recorded,
+# so that no database is required. Every downloaded file is compared with the
+# checksum of the original.
+
+import getopt
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import Queue
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+import media_checksum
+import phenodcc_media
+
+DEFAULT_NUM_FILES = 20
+DEFAULT_FILE_KB = 256
+DEFAULT_LATENCY_MS = 200
+DEFAULT_WORKERS = '1,4,8'
+
+
+class FileRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        time.sleep(self.server.latency_secs)
+        data = self.server.files.get(self.path)
+        if data is None:
+            self.send_error(404, 'File does not exist')
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FileServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, files, latency_secs):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FileRequestHandler)
+        self.files = files
+        self.latency_secs = latency_secs
+
+
+# Downloads the media files in a host queue as download_worker() does, but
+# without updating the database.
+def download_worker(jobs, active_downloads):
+    while True:
+        try:
+            media_id, credentials, url_to_download, file_save_as = jobs.get_nowait()
+        except Queue.Empty:
+            break
+        with active_downloads:
+            try:
+                phenodcc_media.get_file(url_to_download, file_save_as, credentials)
+                phenodcc_media.record_download(os.path.getsize(file_save_as))
+            except IOError as e:
+                print 'Failed to download "' + url_to_download + '": ' + str(e)
+
+
+# Downloads every media file with the supplied number of download workers, and
+# returns the number of seconds taken.
+def benchmark_workers(jobs, workers):
+    phenodcc_media.DOWNLOAD_WORKERS = workers
+    phenodcc_media.download_stats = {'files': 0, 'bytes': 0}
+    start_time = time.time()
+    if workers > 1:
+        phenodcc_media.download_concurrently(jobs, download_worker)
+    else:
+        queue = Queue.Queue()
+        for job in jobs:
+            queue.put(job)
+        download_worker(queue, threading.BoundedSemaphore(1))
+    return time.time() - start_time
+
+
+def print_usage():
+    print 'Usage:'
+    print '    benchmark_download.py [-n <files>] [-s <file size>] [-l <latency>] [-w <workers>]'
+    print '                          [-c <connections per host>]'
+    print ''
+    print ' -n - Number of media files in the synthetic corpus (default ' + str(DEFAULT_NUM_FILES) + ').'
+    print ' -s - Size of each media file in kilobytes (default ' + str(DEFAULT_FILE_KB) + ').'
+    print ' -l - Latency (in milliseconds) of the server before every response (default ' + \
+          str(DEFAULT_LATENCY_MS) + ').'
+    print ' -w - Comma separated list of numbers of download workers (default ' + DEFAULT_WORKERS + ').'
+    print ' -c - Maximum number of simultaneous connections to the server (default is the largest'
+    print '      number of download workers).'
+
+
+def main(argv):
+    num_files = DEFAULT_NUM_FILES
+    file_kb = DEFAULT_FILE_KB
+    latency_ms = DEFAULT_LATENCY_MS
+    workers = DEFAULT_WORKERS
+    connections_per_host = None
+    try:
+        opts, args = getopt.getopt(argv, "n:s:l:w:c:")
+        for opt, arg in opts:
+            if opt == '-n':
+                num_files = int(arg)
+            elif opt == '-s':
+                file_kb = int(arg)
+            elif opt == '-l':
+                latency_ms = int(arg)
+            elif opt == '-w':
+                workers = arg
+            elif opt == '-c':
+                connections_per_host = int(arg)
+        workers = [int(x) for x in workers.split(',')]
+    except (getopt.GetoptError, ValueError):
+        print_usage()
+        sys.exit(2)
+    if connections_per_host is None:
+        connections_per_host = max(workers)
+    phenodcc_media.CONNECTIONS_PER_HOST = connections_per_host
+    phenodcc_media.opt_verbose = False
+
+    files = {}
+    checksums = {}
+    for i in range(num_files):
+        path = '/media/' + str(i) + '.bin'
+        files[path] = os.urandom(file_kb * 1024)
+        checksums[path] = hashlib.sha1(files[path]).hexdigest()
+    server = FileServer(files, latency_ms / 1000.0)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    url_prefix = 'http://127.0.0.1:' + str(server.server_address[1])
+
+    work_dir = tempfile.mkdtemp(prefix='benchmark_download_')
+    try:
+        print 'Downloading ' + str(num_files) + ' files of ' + str(file_kb) + ' KB, with a latency of ' + \
+              str(latency_ms) + ' ms and at most ' + str(connections_per_host) + ' connections...'
+        for num_workers in workers:
+            download_dir = work_dir + '/' + str(num_workers) + '/'
+            os.makedirs(download_dir)
+            jobs = [(i, None, url_prefix + path, download_dir + os.path.basename(path))
+                    for i, path in enumerate(sorted(files))]
+            elapsed_secs = benchmark_workers(jobs, num_workers)
+            num_correct = sum(1 for media_id, credentials, url, save_as in jobs
+                              if media_checksum.get_sha1(save_as) == checksums[url[len(url_prefix):]])
+            megabytes = phenodcc_media.download_stats['bytes'] / 1048576.0
+            print '%2d workers: %7.2f s, %7.2f files/s, %7.2f MB/s, %d of %d files correct' % \
+                  (num_workers, elapsed_secs, num_files / elapsed_secs, megabytes / elapsed_secs,
+                   num_correct, num_files)
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
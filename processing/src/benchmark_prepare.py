@@ -0,0 +1,269 @@
+#! /usr/bin/python
+#
+# Copyright 2014 Medical Research Council Harwell.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# @author Gagarine Yaikhom <g.yaikhom@har.mrc.ac.uk>
+#
+
+# DESCRIPTION:
+#
+# Measures the time taken by the prepare phase of phenodcc_media.py against the
+# number of measurements in the tracker. The tracker tables that the prepare phase
+# reads, and the media database (see phenodcc_media.sql), are created on a local
+# MySQL or MariaDB server, and are seeded with a synthetic set of measurements,
+# some of which are media files. For every number of measurements, the media files
+# are prepared three times:
+#
+#     full      - All of the measurements, with no media files marked for download
+#     watermark - Only the measurements above the watermark (less the margin), after
+#                 adding one percent more measurements
+#     reconcile - All of the measurements again, when every media file is marked
+#
+# The number of seconds taken, and the number of media files added, are reported
+# for every run. Since the databases are created and dropped by the benchmark, it
+# must be run on a scratch server: it refuses to run if any of the databases exist.
+
+import ConfigParser
+import getopt
+import os
+import re
+import sys
+import time
+
+import MySQLdb
+
+import phenodcc_media
+
+DEFAULT_MEASUREMENTS = '10000,100000,1000000'
+DEFAULT_MEDIA_PERCENT = 10
+NUM_PIPELINES = 2
+NUM_PROCEDURES = 20
+NUM_PARAMETERS = 200
+MEASUREMENTS_PER_PROCEDURE = 20
+SEED_BATCH_SIZE = 10000
+DATABASES = ['phenodcc_media', 'phenodcc_overviews', 'impress']
+
+# Only the columns used by the prepare phase.
+TRACKER_SCHEMA = [
+    '''
+create table impress.pipeline (
+       pipeline_id int unsigned not null,
+       pipeline_key varchar(16) not null,
+       primary key (pipeline_id),
+       unique (pipeline_key)
+) engine = innodb
+''', '''
+create table impress.`procedure` (
+       procedure_id int unsigned not null,
+       procedure_key varchar(16) not null,
+       primary key (procedure_id),
+       unique (procedure_key)
+) engine = innodb
+''', '''
+create table impress.parameter (
+       parameter_id int unsigned not null,
+       parameter_key varchar(32) not null,
+       primary key (parameter_id),
+       unique (parameter_key)
+) engine = innodb
+''', '''
+create table phenodcc_overviews.procedure_animal_overview (
+       procedure_occurrence_id bigint unsigned not null,
+       pipeline varchar(16) not null,
+       procedure_id varchar(16) not null,
+       primary key (procedure_occurrence_id)
+) engine = innodb
+''', '''
+create table phenodcc_overviews.measurements_performed (
+       measurement_id bigint unsigned not null,
+       procedure_occurrence_id bigint unsigned not null,
+       centre_id int unsigned not null,
+       genotype_id int unsigned not null,
+       strain_id int unsigned not null,
+       parameter_id varchar(32) not null,
+       measurement_type varchar(32) not null,
+       value text,
+       primary key (measurement_id),
+       index (procedure_occurrence_id)
+) engine = innodb
+''']
+
+DB_ADD_MEASUREMENTS = '''
+insert into phenodcc_overviews.measurements_performed
+(measurement_id, procedure_occurrence_id, centre_id, genotype_id, strain_id, parameter_id, measurement_type, value)
+values (%s, %s, %s, %s, %s, %s, %s, %s)
+'''
+
+# The first of the measurements added later could belong to an existing occurrence.
+DB_ADD_PROCEDURE_OCCURRENCES = '''
+insert ignore into phenodcc_overviews.procedure_animal_overview (procedure_occurrence_id, pipeline, procedure_id)
+values (%s, %s, %s)
+'''
+
+DB_COUNT_MEDIA_FILES = 'select count(*) from phenodcc_media.media_file'
+
+
+# Returns the statements in an SQL script, without the comments.
+def read_sql_statements(sql_file):
+    with open(sql_file) as f:
+        script = re.sub(r'/\*.*?\*/', '', f.read(), flags=re.DOTALL)
+    return [x.strip() for x in script.split(';') if x.strip()]
+
+
+def create_databases(cur):
+    for database in DATABASES:
+        cur.execute('create database ' + database)
+    for statement in read_sql_statements(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                      'phenodcc_media.sql')):
+        cur.execute(statement)
+    cur.execute('use impress')
+    for statement in TRACKER_SCHEMA:
+        cur.execute(statement)
+    cur.executemany('insert into impress.pipeline values (%s, %s)',
+                    [(i, 'PIPE_' + str(i)) for i in range(1, NUM_PIPELINES + 1)])
+    cur.executemany('insert into impress.`procedure` values (%s, %s)',
+                    [(i, 'PROC_' + str(i)) for i in range(1, NUM_PROCEDURES + 1)])
+    cur.executemany('insert into impress.parameter values (%s, %s)',
+                    [(i, 'PARAM_' + str(i)) for i in range(1, NUM_PARAMETERS + 1)])
+
+
+def clear_tables(con):
+    cur = con.cursor()
+    for table in ['phenodcc_media.media_file', 'phenodcc_media.prepare_watermark',
+                  'phenodcc_overviews.measurements_performed', 'phenodcc_overviews.procedure_animal_overview']:
+        cur.execute('delete from ' + table)
+    con.commit()
+
+
+# Adds measurements with ids from first_id, of which the supplied percentage are
+# media files. Every procedure occurrence has a fixed number of measurements.
+def seed_measurements(con, first_id, num_measurements, media_percent):
+    cur = con.cursor()
+    measurements = []
+    occurrences = []
+    for measurement_id in range(first_id, first_id + num_measurements):
+        occurrence_id = measurement_id / MEASUREMENTS_PER_PROCEDURE
+        if measurement_id % MEASUREMENTS_PER_PROCEDURE == 0 or measurement_id == first_id:
+            occurrences.append((occurrence_id, 'PIPE_' + str(occurrence_id % NUM_PIPELINES + 1),
+                                'PROC_' + str(occurrence_id % NUM_PROCEDURES + 1)))
+        parameter = 'PARAM_' + str(measurement_id % NUM_PARAMETERS + 1)
+        if measurement_id % 100 < media_percent:
+            measurements.append((measurement_id, occurrence_id, occurrence_id % 10 + 1, occurrence_id % 500 + 1, 1,
+                                 parameter, 'MEDIAPARAMETER',
+                                 'http://example.org/media/' + str(measurement_id) + '.jpg'))
+        else:
+            measurements.append((measurement_id, occurrence_id, occurrence_id % 10 + 1, occurrence_id % 500 + 1, 1,
+                                 parameter, 'SIMPLEPARAMETER', str(measurement_id % 1000 / 10.0)))
+        if len(measurements) == SEED_BATCH_SIZE:
+            cur.executemany(DB_ADD_MEASUREMENTS, measurements)
+            measurements = []
+    if measurements:
+        cur.executemany(DB_ADD_MEASUREMENTS, measurements)
+    cur.executemany(DB_ADD_PROCEDURE_OCCURRENCES, occurrences)
+    con.commit()
+
+
+def count_media_files():
+    cur = phenodcc_media.connection.cursor()
+    cur.execute(DB_COUNT_MEDIA_FILES)
+    num_media_files = cur.fetchone()[0]
+    # End the transaction, so that the next count is not read from the same snapshot.
+    phenodcc_media.connection.commit()
+    return num_media_files
+
+
+# Runs the prepare phase, and reports the time taken and the media files added.
+def benchmark_prepare(name, num_measurements, full):
+    phenodcc_media.opt_full_prepare = full
+    num_before = count_media_files()
+    start_time = time.time()
+    phenodcc_media.add_files_to_download()
+    elapsed_secs = time.time() - start_time
+    print '%10d measurements, %-9s %8.2f s, %8d media files added' % \
+          (num_measurements, name, elapsed_secs, count_media_files() - num_before)
+    sys.stdout.flush()
+
+
+def print_usage():
+    print 'Usage:'
+    print '    benchmark_prepare.py -x <config file> [-n <measurements>] [-m <media percent>]'
+    print ''
+    print ' -x - Configuration file, whose media section sets the host and user of the scratch server.'
+    print ' -n - Comma separated list of numbers of measurements (default ' + DEFAULT_MEASUREMENTS + ').'
+    print ' -m - Percentage of the measurements that are media files (default ' + \
+          str(DEFAULT_MEDIA_PERCENT) + ').'
+
+
+def main(argv):
+    config_file = None
+    measurements = DEFAULT_MEASUREMENTS
+    media_percent = DEFAULT_MEDIA_PERCENT
+    try:
+        opts, args = getopt.getopt(argv, "x:n:m:")
+        for opt, arg in opts:
+            if opt == '-x':
+                config_file = arg
+            elif opt == '-n':
+                measurements = arg
+            elif opt == '-m':
+                media_percent = int(arg)
+        measurements = [int(x) for x in measurements.split(',')]
+    except (getopt.GetoptError, ValueError):
+        print_usage()
+        sys.exit(2)
+    config = ConfigParser.RawConfigParser()
+    if config_file is None or len(config.read(config_file)) == 0:
+        print_usage()
+        sys.exit(2)
+
+    phenodcc_media.MEDIA_HOSTNAME = config.get('media', 'hostname')
+    phenodcc_media.MEDIA_USERNAME = config.get('media', 'username')
+    phenodcc_media.MEDIA_PASSWORD = config.get('media', 'password')
+    phenodcc_media.MEDIA_DATABASE = 'phenodcc_media'
+    phenodcc_media.opt_verbose = False
+
+    con = MySQLdb.connect(phenodcc_media.MEDIA_HOSTNAME, phenodcc_media.MEDIA_USERNAME,
+                          phenodcc_media.MEDIA_PASSWORD)
+    cur = con.cursor()
+    cur.execute('show databases')
+    existing = [x for (x,) in cur.fetchall() if x in DATABASES]
+    if existing:
+        print 'Databases ' + ', '.join(existing) + ' already exist; please use a scratch server...'
+        sys.exit(1)
+    try:
+        create_databases(cur)
+        con.commit()
+        phenodcc_media.connect_to_database()
+        phenodcc_media.set_phase_status_ids()
+        print 'Preparing media files from ' + ', '.join(str(x) for x in measurements) + \
+              ' measurements, of which ' + str(media_percent) + '% are media files...'
+        for num_measurements in measurements:
+            clear_tables(con)
+            seed_measurements(con, 1, num_measurements, media_percent)
+            benchmark_prepare('full', num_measurements, True)
+            seed_measurements(con, num_measurements + 1, max(1, num_measurements / 100), media_percent)
+            benchmark_prepare('watermark', num_measurements, False)
+            benchmark_prepare('reconcile', num_measurements, True)
+    finally:
+        if phenodcc_media.connection is not None:
+            phenodcc_media.connection.close()
+        for database in DATABASES:
+            cur.execute('drop database if exists ' + database)
+        con.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
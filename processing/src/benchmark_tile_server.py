@@ -0,0 +1,218 @@
+#! /usr/bin/python
+#
+# Copyright 2014 Medical Research Council Harwell.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# @author Gagarine Yaikhom <g.yaikhom@har.mrc.ac.uk>
+#
+
+# DESCRIPTION:
+#
+# Load test for tile_server.py. The tiles of a synthetic corpus of images are
+# generated, and the tile server is started in a separate process. Several
+# client processes then request every tile once, in a random order, and this is
+# done three times: with the cache of the server empty (cold), with the tiles in
+# the cache (warm), and with the ETags of the tiles (conditional). The median and
+# 99th percentile latency, and the number of requests per second, are reported
+# for every pass. Note that the tiles could still be in the page cache of the
+# operating system when the cache of the server is cold.
+
+import getopt
+import httplib
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import time
+from subprocess import Popen
+
+import benchmark_tiling
+import image_tiler
+import media_checksum
+import tile_container
+
+DEFAULT_CLIENTS = 8
+DEFAULT_CACHE_MB = 256
+
+
+def get_free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def wait_for_server(port, process):
+    while process.poll() is None:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return True
+        except socket.error:
+            time.sleep(0.1)
+    return False
+
+
+# Requests the supplied paths on a persistent connection. Returns the latency of
+# every request in milliseconds, and the number of responses by status.
+# job - (port, paths, conditional), where the ETag is sent if conditional
+def run_client(job):
+    port, paths, conditional = job
+    connection = httplib.HTTPConnection('127.0.0.1', port)
+    latencies = []
+    statuses = {}
+    etags = {}
+    try:
+        for path, etag in paths:
+            headers = {'If-None-Match': etag} if conditional else {}
+            start_time = time.time()
+            connection.request('GET', path, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            latencies.append((time.time() - start_time) * 1000.0)
+            statuses[response.status] = statuses.get(response.status, 0) + 1
+            etags[path] = response.getheader('ETag')
+    finally:
+        connection.close()
+    return latencies, statuses, etags
+
+
+def get_percentile(values, fraction):
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+# Sends the requests from several client processes, and reports the latency and
+# the throughput. Returns the ETags of the tiles.
+def load_test(name, port, requests, clients, conditional):
+    jobs = [(port, requests[i::clients], conditional) for i in range(clients)]
+    pool = multiprocessing.Pool(clients)
+    try:
+        start_time = time.time()
+        results = pool.map(run_client, jobs, 1)
+        elapsed_secs = time.time() - start_time
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+    latencies = sorted(x for result in results for x in result[0])
+    statuses = {}
+    etags = {}
+    for result in results:
+        for status, count in result[1].items():
+            statuses[status] = statuses.get(status, 0) + count
+        etags.update(result[2])
+    print '%-12s %6d requests, %8.1f requests/s, p50 %6.2f ms, p99 %6.2f ms, responses %s' % \
+          (name, len(latencies), len(latencies) / elapsed_secs, get_percentile(latencies, 0.5),
+           get_percentile(latencies, 0.99), ', '.join(str(x) + ' x' + str(statuses[x]) for x in sorted(statuses)))
+    return etags
+
+
+# Returns the request paths of every tile and thumbnail in a random order, using
+# the manifests of the tiles sets.
+def get_tile_requests(files, tiles_dir):
+    requests = []
+    for path in files:
+        tiles_path = image_tiler.get_tiles_path(tiles_dir, media_checksum.get_sha1(path))
+        checksum_path = tiles_path[len(tiles_dir) - 1:]
+        requests.append(checksum_path + 'thumbnail.' + image_tiler.PREFERRED_FORMAT)
+        for level in image_tiler.read_manifest(tiles_path)['levels']:
+            for row in range(level['rows']):
+                for col in range(level['columns']):
+                    requests.append(checksum_path + str(level['tile_size']) + '/' + str(level['scale']) + '/' +
+                                    image_tiler.get_tile_name(level['columns'], level['rows'], row, col))
+    random.Random(0).shuffle(requests)
+    return requests
+
+
+def print_usage():
+    print 'Usage:'
+    print '    benchmark_tile_server.py [-n <images>] [-w <width>] [-h <height>] [-t <tile size>] [-s <scales>]'
+    print '                             [-c <clients>] [-m <cache size>] [-k]'
+    print ''
+    print ' -n - Number of images in the synthetic corpus (default ' + \
+          str(benchmark_tiling.DEFAULT_NUM_IMAGES) + ').'
+    print ' -w - Width of each image in pixels (default ' + str(benchmark_tiling.DEFAULT_WIDTH) + ').'
+    print ' -h - Height of each image in pixels (default ' + str(benchmark_tiling.DEFAULT_HEIGHT) + ').'
+    print ' -t - Tile size (default ' + benchmark_tiling.DEFAULT_TILE_SIZE + ').'
+    print ' -s - Comma separated list of scales (default ' + benchmark_tiling.DEFAULT_SCALES + ').'
+    print ' -c - Number of client processes (default ' + str(DEFAULT_CLIENTS) + ').'
+    print ' -m - Maximum size (in megabytes) of the tiles kept in memory (default ' + str(DEFAULT_CACHE_MB) + ').'
+    print ' -k - Store the tiles of every image in a container.'
+
+
+def main(argv):
+    num_images = benchmark_tiling.DEFAULT_NUM_IMAGES
+    width = benchmark_tiling.DEFAULT_WIDTH
+    height = benchmark_tiling.DEFAULT_HEIGHT
+    tile_size = benchmark_tiling.DEFAULT_TILE_SIZE
+    scales = benchmark_tiling.DEFAULT_SCALES
+    clients = DEFAULT_CLIENTS
+    cache_mb = DEFAULT_CACHE_MB
+    writer_class = image_tiler.TileWriter
+    try:
+        opts, args = getopt.getopt(argv, "n:w:h:t:s:c:m:k")
+        for opt, arg in opts:
+            if opt == '-n':
+                num_images = int(arg)
+            elif opt == '-w':
+                width = int(arg)
+            elif opt == '-h':
+                height = int(arg)
+            elif opt == '-t':
+                tile_size = arg
+            elif opt == '-s':
+                scales = arg
+            elif opt == '-c':
+                clients = int(arg)
+            elif opt == '-m':
+                cache_mb = int(arg)
+            elif opt == '-k':
+                writer_class = tile_container.ContainerTileWriter
+    except (getopt.GetoptError, ValueError):
+        print_usage()
+        sys.exit(2)
+
+    work_dir = tempfile.mkdtemp(prefix='benchmark_tile_server_')
+    server = None
+    try:
+        os.makedirs(work_dir + '/corpus')
+        print 'Creating ' + str(num_images) + ' images of ' + str(width) + 'x' + str(height) + ' pixels...'
+        files = benchmark_tiling.create_corpus(work_dir + '/corpus', num_images, width, height)
+        tiles_dir = work_dir + '/tiles/'
+        benchmark_tiling.benchmark_python(files, tiles_dir, tile_size, scales, writer_class=writer_class)
+        requests = get_tile_requests(files, tiles_dir)
+
+        port = get_free_port()
+        server = Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tile_server.py'),
+                        '-p', str(port), '-c', str(cache_mb), tiles_dir])
+        if not wait_for_server(port, server):
+            print 'Failed to start the tile server...'
+            return
+
+        etags = load_test('cold', port, [(x, None) for x in requests], clients, False)
+        load_test('warm', port, [(x, None) for x in requests], clients, False)
+        load_test('conditional', port, [(x, etags[x]) for x in requests], clients, True)
+    finally:
+        if server is not None and server.poll() is None:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
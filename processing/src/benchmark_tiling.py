@@ -0,0 +1,733 @@
+#! /usr/bin/python
+#
+# Copyright 2014 Medical Research Council Harwell.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# @author Gagarine Yaikhom <g.yaikhom@har.mrc.ac.uk>
+#
+
+# DESCRIPTION:
+#
+# Compares the in-process Pillow tiler (image_tiler.py) with the ImageMagick
+# pipeline (generate_tiles_for_image.sh) on a synthetic corpus of images.
+# The shell pipeline is only timed if ImageMagick's convert is available.
+# The Pillow tiler could also be timed with several numbers of tiling
+# processes, to measure the speedup of phenodcc_media.py --workers, and
+# with and without the cascaded pyramid, to measure the CPU time per
+# megapixel and the PSNR of the cascaded scales against direct resampling.
+# JPEG images could be tiled with and without reducing them whilst decoding,
+# to measure the speedup for the thumbnail and the low zoom scales. Synthetic
+# DICOM images with 12-bit samples could be tiled by both tilers, to compare
+# their throughput and peak memory.
+# Finally, a single very large image could be tiled in bands by image_tiler.py
+# with a limit on the memory of the process, to check that the memory used is
+# bounded by the width of the image instead of its area. The tiles could also be
+# stored in a container for every image (tile_container.py), to compare the
+# number of inodes, the time to write the tiles, and the latency of reading
+# random tiles with a file for every tile. Some of the scales could be tiled
+# on demand instead (tile_cache.py), to measure the storage saved, and the
+# latency of the first request for a tile of these scales. Images with a large
+# uniform background, as in X-ray images, could be tiled with and without
+# recording the uniform tiles in the manifest, to measure the time, bytes and
+# files saved. The scales could be compared with a Deep Zoom pyramid of power-of-
+# two levels (tile_deepzoom.py), tiled from the original images, and converted
+# from the tiles of the 100% scale.
+
+import getopt
+import math
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from cStringIO import StringIO
+from PIL import Image, ImageChops, ImageDraw, ImageStat
+from subprocess import call, Popen
+
+import image_tiler
+import media_checksum
+import tile_cache
+import tile_container
+import tile_deepzoom
+
+# pydicom and NumPy are only required for creating the DICOM images.
+try:
+    import numpy
+    import pydicom
+except ImportError:
+    numpy = pydicom = None
+
+DEFAULT_NUM_IMAGES = 10
+DEFAULT_WIDTH = 4000
+DEFAULT_HEIGHT = 3000
+DEFAULT_TILE_SIZE = '256'
+DEFAULT_SCALES = '10,25,50,75,100'
+DEFAULT_MEMORY_LIMIT_MB = 512
+DEFAULT_LOW_ZOOM_SCALES = '10,25'
+DEFAULT_DICOM_FRAMES = 1
+DEFAULT_RANDOM_READS = 10000
+DEFAULT_LAZY_SCALES = '75,100'
+DEFAULT_STAMPEDE_THREADS = 16
+
+# Formats in the synthetic corpus, similar to those submitted by the centres.
+CORPUS_FORMATS = ['jpg', 'png', 'tif']
+
+
+# Draw a synthetic image with gradients and shapes, so that the JPEG encoder
+# does a realistic amount of work.
+def create_image(path, width, height, seed, draw=None):
+    (draw or draw_image)(width, height, seed).save(path)
+
+
+def draw_image(width, height, seed):
+    img = Image.new('RGB', (width, height))
+    draw = ImageDraw.Draw(img)
+    for y in range(0, height, 4):
+        draw.rectangle([0, y, width, y + 3], fill=((y + seed * 37) % 256, (y // 4) % 256, seed * 53 % 256))
+    for i in range(50):
+        x = (i * 7919 + seed * 104729) % width
+        y = (i * 6271 + seed * 130363) % height
+        r = 20 + (i * 97) % (min(width, height) // 8)
+        draw.ellipse([x - r, y - r, x + r, y + r], fill=((i * 71) % 256, (i * 113) % 256, (i * 29) % 256))
+    return img
+
+
+# Draw a synthetic greyscale image of a specimen on a dark background with a
+# little noise, as in X-ray images, where the specimen covers about a third of
+# the image.
+def draw_xray(width, height, seed):
+    img = Image.effect_noise((width, height), 2).point(lambda x: max(0, x - 128))
+    mask = Image.new('L', (width, height))
+    x = width // 2 + (seed * 7919) % (width // 8)
+    y = height // 2 + (seed * 6271) % (height // 8)
+    ImageDraw.Draw(mask).ellipse([x - width // 4, y - height * 3 // 8, x + width // 4, y + height * 3 // 8],
+                                 fill=255)
+    img.paste(draw_image(width, height, seed).convert('L'), (0, 0), mask)
+    return img
+
+
+# Write a synthetic DICOM image with 12-bit samples stored in 16 bits, where
+# every frame is drawn as for the other images.
+def create_dicom(path, width, height, seed, num_frames):
+    frames = [numpy.asarray(draw_image(width, height, seed + i).convert('L'), dtype=numpy.uint16) * 16 + i
+              for i in range(num_frames)]
+    file_meta = pydicom.dataset.Dataset()
+    file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.7'  # Secondary Capture
+    file_meta.MediaStorageSOPInstanceUID = pydicom.uid.generate_uid()
+    file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+    dataset = pydicom.dataset.FileDataset(path, {}, file_meta=file_meta, preamble='\0' * 128)
+    dataset.is_little_endian = True
+    dataset.is_implicit_VR = False
+    dataset.SOPClassUID = file_meta.MediaStorageSOPClassUID
+    dataset.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    dataset.Modality = 'OT'
+    dataset.Rows = height
+    dataset.Columns = width
+    dataset.SamplesPerPixel = 1
+    dataset.PhotometricInterpretation = 'MONOCHROME2'
+    dataset.BitsAllocated = 16
+    dataset.BitsStored = 12
+    dataset.HighBit = 11
+    dataset.PixelRepresentation = 0
+    if num_frames > 1:
+        dataset.NumberOfFrames = num_frames
+    dataset.PixelData = numpy.concatenate(frames).tobytes()
+    dataset.save_as(path)
+
+
+def create_corpus(corpus_dir, num_images, width, height, formats=CORPUS_FORMATS, draw=None):
+    files = []
+    for i in range(num_images):
+        path = corpus_dir + '/image_' + str(i) + '.' + formats[i % len(formats)]
+        create_image(path, width, height, i, draw)
+        files.append(path)
+    return files
+
+
+def count_tiles(tiles_dir):
+    return sum(len(files) for root, dirs, files in os.walk(tiles_dir))
+
+
+def report(name, files, tiles_dir, elapsed_secs):
+    print '%-12s %4d images, %6d files, %8.2f seconds, %6.2f images/s' % \
+          (name, len(files), count_tiles(tiles_dir), elapsed_secs, len(files) / elapsed_secs)
+
+
+def tile_file(job):
+    path, tiles_dir, tile_size, scales, cascade, reduce_jpeg, writer_class, lazy_scales, uniform_tolerance = job
+    image_tiler.generate_tiles(path, tiles_dir, media_checksum.get_sha1(path),
+                               image_tiler.parse_int_list(tile_size),
+                               image_tiler.parse_int_list(scales), cascade,
+                               reduce_jpeg=reduce_jpeg, writer_class=writer_class,
+                               lazy_scales=lazy_scales, uniform_tolerance=uniform_tolerance)
+
+
+def benchmark_python(files, tiles_dir, tile_size, scales, workers=1, cascade=True, reduce_jpeg=True,
+                     writer_class=image_tiler.TileWriter, lazy_scales=None, uniform_tolerance=None):
+    jobs = [(path, tiles_dir, tile_size, scales, cascade, reduce_jpeg, writer_class, lazy_scales,
+             uniform_tolerance) for path in files]
+    start_time = time.time()
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            pool.map(tile_file, jobs, 1)
+            pool.close()
+            pool.join()
+        finally:
+            pool.terminate()
+    else:
+        for job in jobs:
+            tile_file(job)
+    return time.time() - start_time
+
+
+def get_cpu_secs():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+# Peak signal-to-noise ratio (in dB) between two images of the same size.
+def get_psnr(a, b):
+    mean_squares = ImageStat.Stat(ImageChops.difference(a, b)).rms
+    mse = sum(x * x for x in mean_squares) / len(mean_squares)
+    if mse == 0:
+        return float('inf')
+    return 10 * math.log10(255.0 * 255.0 / mse)
+
+
+# Compares the cascaded pyramid with direct resampling of the original image.
+# Reports the CPU time per megapixel for tiling, and the lowest PSNR of every
+# cascaded scale against the same scale resampled directly from the original.
+def compare_cascade(files, work_dir, tile_size, scales):
+    megapixels = 0.0
+    lowest_psnr = {}
+    for path in files:
+        img = image_tiler.open_image(path)
+        megapixels += img.size[0] * img.size[1] / 1000000.0
+        direct = image_tiler.get_pyramid(img, image_tiler.parse_int_list(scales), False)
+        cascaded = image_tiler.get_pyramid(img, image_tiler.parse_int_list(scales), True)
+        for (scale, direct_scaled), (scale, cascaded_scaled) in zip(direct, cascaded):
+            psnr = get_psnr(direct_scaled, cascaded_scaled)
+            lowest_psnr[scale] = min(psnr, lowest_psnr.get(scale, psnr))
+
+    for cascade in (False, True):
+        start_cpu_secs = get_cpu_secs()
+        benchmark_python(files, work_dir + '/cascade_' + str(cascade), tile_size, scales, 1, cascade)
+        cpu_secs = get_cpu_secs() - start_cpu_secs
+        print '%-12s %8.2f CPU seconds, %6.3f CPU seconds per megapixel' % \
+              ('cascade' if cascade else 'direct', cpu_secs, cpu_secs / megapixels)
+    for scale in sorted(lowest_psnr, reverse=True):
+        print '%-12s lowest PSNR of cascaded scale %3d%% against direct: %.2f dB' % ('', scale, lowest_psnr[scale])
+
+
+# Compares tiling JPEG images after decoding them entirely with reducing them
+# whilst decoding. Reports the time taken, and the lowest PSNR of the tiles and
+# thumbnails of every scale against those generated from the decoded image.
+def compare_reduced_decoding(files, work_dir, tile_size, scales):
+    elapsed_secs = {}
+    for reduce_jpeg in (False, True):
+        tiles_dir = work_dir + '/reduce_' + str(reduce_jpeg)
+        elapsed_secs[reduce_jpeg] = benchmark_python(files, tiles_dir, tile_size, scales, 1, True, reduce_jpeg)
+        report('reduced' if reduce_jpeg else 'decoded', files, tiles_dir, elapsed_secs[reduce_jpeg])
+    print '%-12s speedup %.2f over decoding the entire image' % ('', elapsed_secs[False] / elapsed_secs[True])
+
+    lowest_psnr = {}
+    decoded_dir = work_dir + '/reduce_False'
+    for root, dirs, names in os.walk(decoded_dir):
+        for name in names:
+            decoded_path = os.path.join(root, name)
+            reduced_path = work_dir + '/reduce_True' + decoded_path[len(decoded_dir):]
+            psnr = get_psnr(Image.open(decoded_path), Image.open(reduced_path))
+            level = 'thumbnail' if name.startswith('thumbnail') else 'scale ' + os.path.basename(root) + '%'
+            lowest_psnr[level] = min(psnr, lowest_psnr.get(level, psnr))
+    for level in sorted(lowest_psnr):
+        print '%-12s lowest PSNR of %s against decoding the entire image: %.2f dB' % ('', level, lowest_psnr[level])
+
+
+def count_inodes(tiles_dir):
+    return sum(len(dirs) + len(files) for root, dirs, files in os.walk(tiles_dir))
+
+
+# Returns num_reads random tiles as (tiles path, tile size, scale, columns, rows,
+# row, column) tuples, using the manifests of the tiles sets.
+def get_random_tiles(files, tiles_dir, num_reads):
+    levels = []
+    for path in files:
+        tiles_path = image_tiler.get_tiles_path(tiles_dir, media_checksum.get_sha1(path))
+        for level in image_tiler.read_manifest(tiles_path)['levels']:
+            levels.append((tiles_path, level['tile_size'], level['scale'], level['columns'], level['rows']))
+    generator = random.Random(0)
+    tiles = []
+    for i in range(num_reads):
+        level = generator.choice(levels)
+        tiles.append(level + (generator.randrange(level[4]), generator.randrange(level[3])))
+    return tiles
+
+
+def read_tile_file(tiles_path, tile_size, scale, num_cols, num_rows, row, col):
+    with open(tiles_path + str(tile_size) + '/' + str(scale) + '/' +
+              image_tiler.get_tile_name(num_cols, num_rows, row, col), 'rb') as f:
+        return f.read()
+
+
+def read_container_tile(tiles_path, tile_size, scale, num_cols, num_rows, row, col):
+    with tile_container.ContainerReader(tile_container.get_container_path(tiles_path)) as reader:
+        return reader.read_tile(tile_size, scale, row, col)
+
+
+# Returns the mean time in microseconds to read a tile.
+def time_reads(read_tile, tiles):
+    start_time = time.time()
+    for tile in tiles:
+        if not read_tile(*tile):
+            raise IOError('Failed to read tile ' + str(tile))
+    return (time.time() - start_time) * 1000000.0 / len(tiles)
+
+
+# Compares storing a file for every tile with a container for every image. Reports
+# the number of inodes (files and directories), the time to tile the images, and
+# the mean latency of reading random tiles. For the container, this is reported
+# both with the containers kept open (e.g., by a tile server) and opened for every
+# tile. The same tiles are read from both, in the same order.
+def compare_storage(files, work_dir, tile_size, scales, num_reads):
+    tiles_dirs = {}
+    for name, writer_class in (('directory', image_tiler.TileWriter),
+                               ('container', tile_container.ContainerTileWriter)):
+        tiles_dirs[name] = work_dir + '/' + name
+        elapsed_secs = benchmark_python(files, tiles_dirs[name], tile_size, scales, writer_class=writer_class)
+        print '%-12s %4d images, %7d inodes, %8.2f seconds, %6.2f images/s' % \
+              (name, len(files), count_inodes(tiles_dirs[name]), elapsed_secs, len(files) / elapsed_secs)
+
+    tiles = get_random_tiles(files, tiles_dirs['directory'], num_reads)
+    print '%-12s %6.1f us per random tile read' % \
+          ('directory', time_reads(read_tile_file, tiles))
+
+    container_tiles = [(tiles_dirs['container'] + x[0][len(tiles_dirs['directory']):],) + x[1:] for x in tiles]
+    readers = {}
+    for tile in container_tiles:
+        if tile[0] not in readers:
+            readers[tile[0]] = tile_container.ContainerReader(tile_container.get_container_path(tile[0]))
+    try:
+        cached_secs = time_reads(lambda tiles_path, tile_size, scale, num_cols, num_rows, row, col:
+                               readers[tiles_path].read_tile(tile_size, scale, row, col), container_tiles)
+    finally:
+        for reader in readers.values():
+            reader.close()
+    print '%-12s %6.1f us per random tile read (%.1f us when opened for every tile)' % \
+          ('container', cached_secs, time_reads(read_container_tile, container_tiles))
+
+
+def count_bytes(tiles_dir):
+    return sum(os.path.getsize(os.path.join(root, x)) for root, dirs, files in os.walk(tiles_dir) for x in files)
+
+
+# Compares tiling every scale with tiling the lazy scales on demand. Reports the
+# number of files and bytes of both, and the latency of the first request for a
+# tile of every lazy scale, which generates all of the tiles of that scale, and of
+# the next request for a tile of the same scale. Finally, several threads request
+# the same tile of a scale that is not in the cache, to check that the scale is
+# generated only once.
+def compare_lazy(files, work_dir, tile_size, scales, lazy_scales):
+    lazy_scales = image_tiler.parse_int_list(lazy_scales)
+    eager_scales = ','.join(str(x) for x in image_tiler.parse_int_list(scales) if x not in lazy_scales)
+    tiles_dirs = {}
+    for name, tiled_scales, lazy in (('all', scales, None), ('lazy', eager_scales, lazy_scales)):
+        tiles_dirs[name] = work_dir + '/' + name + '/'
+        elapsed_secs = benchmark_python(files, tiles_dirs[name], tile_size, tiled_scales, lazy_scales=lazy)
+        print '%-12s %4d images, %6d files, %8.1f MB, %8.2f seconds, %6.2f images/s' % \
+              (name, len(files), count_tiles(tiles_dirs[name]), count_bytes(tiles_dirs[name]) / 1048576.0,
+               elapsed_secs, len(files) / elapsed_secs)
+    all_bytes = count_bytes(tiles_dirs['all'])
+    saved_bytes = all_bytes - count_bytes(tiles_dirs['lazy'])
+    print '%-12s %.1f MB (%.1f%%) saved by tiling scales %s on demand' % \
+          ('', saved_bytes / 1048576.0, saved_bytes * 100.0 / all_bytes, ','.join(str(x) for x in lazy_scales))
+
+    cache = tile_cache.TileCache(work_dir + '/cache', 1 << 40)
+    tile_sizes = image_tiler.parse_int_list(tile_size)
+    generator = random.Random(0)
+    for scale in lazy_scales:
+        first_secs = []
+        next_secs = []
+        for path in files:
+            tiles_path = image_tiler.get_tiles_path(tiles_dirs['lazy'], media_checksum.get_sha1(path))
+            manifest = image_tiler.read_manifest(tiles_path)
+            size = (manifest['width'], manifest['height'])
+            for ts in tile_sizes:
+                num_cols, num_rows = image_tiler.get_tile_grid(image_tiler.get_scaled_size(size, scale), ts)
+                for secs in (first_secs, next_secs):
+                    tile = (ts, scale, num_cols, num_rows, generator.randrange(num_rows),
+                            generator.randrange(num_cols))
+                    start_time = time.time()
+                    if not cache.get_tile(tiles_path, tiles_path[len(tiles_dirs['lazy']):], *tile):
+                        raise IOError('Failed to generate tile ' + str(tile))
+                    secs.append(time.time() - start_time)
+        print '%-12s scale %3d: first request %7.1f ms (max %7.1f ms), next request %6.1f us' % \
+              ('', scale, sum(first_secs) * 1000.0 / len(first_secs), max(first_secs) * 1000.0,
+               sum(next_secs) * 1000000.0 / len(next_secs))
+
+    cache = tile_cache.TileCache(work_dir + '/stampede', 1 << 40)
+    tiles_path = image_tiler.get_tiles_path(tiles_dirs['lazy'], media_checksum.get_sha1(files[0]))
+    manifest = image_tiler.read_manifest(tiles_path)
+    scale = lazy_scales[-1]
+    num_cols, num_rows = image_tiler.get_tile_grid(
+        image_tiler.get_scaled_size((manifest['width'], manifest['height']), scale), tile_sizes[0])
+    tile = (tile_sizes[0], scale, num_cols, num_rows, 0, 0)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(
+        cache.get_tile(tiles_path, tiles_path[len(tiles_dirs['lazy']):], *tile)))
+        for i in range(DEFAULT_STAMPEDE_THREADS)]
+    start_time = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print '%-12s %d threads requested the same tile in %.1f ms: %d served, %s' % \
+          ('stampede', len(threads), (time.time() - start_time) * 1000.0, len([x for x in results if x]),
+           cache.summary())
+
+
+# Compares writing every tile with recording the uniform tiles in the manifest.
+# Reports the number of files and bytes, the time to tile the images, and the
+# number of uniform tiles. The tiles that were not written are compared with the
+# tiles of a single colour that are served in their place (see tile_server.py).
+def compare_uniform(files, work_dir, tile_size, scales, tolerance):
+    tiles_dirs = {}
+    for name, uniform_tolerance in (('written', None), ('uniform', tolerance)):
+        tiles_dirs[name] = work_dir + '/' + name + '/'
+        elapsed_secs = benchmark_python(files, tiles_dirs[name], tile_size, scales,
+                                        uniform_tolerance=uniform_tolerance)
+        print '%-12s %4d images, %6d files, %8.1f MB, %8.2f seconds, %6.2f images/s' % \
+              (name, len(files), count_tiles(tiles_dirs[name]), count_bytes(tiles_dirs[name]) / 1048576.0,
+               elapsed_secs, len(files) / elapsed_secs)
+
+    num_tiles = num_uniform = 0
+    lowest_psnr = float('inf')
+    for path in files:
+        checksum = media_checksum.get_sha1(path)
+        manifest = image_tiler.read_manifest(image_tiler.get_tiles_path(tiles_dirs['uniform'], checksum))
+        size = (manifest['width'], manifest['height'])
+        written_path = image_tiler.get_tiles_path(tiles_dirs['written'], checksum)
+        for level in manifest['levels']:
+            num_tiles += level['columns'] * level['rows']
+            for row, col, colour in level.get('uniform', []):
+                num_uniform += 1
+                tile = Image.open(written_path + str(level['tile_size']) + '/' + str(level['scale']) + '/' +
+                                  image_tiler.get_tile_name(level['columns'], level['rows'], row, col))
+                tile_dimensions = image_tiler.get_tile_size(image_tiler.get_scaled_size(size, level['scale']),
+                                                            level['tile_size'], row, col)
+                placeholder = Image.open(StringIO(image_tiler.create_uniform_tile(tile_dimensions, colour)))
+                lowest_psnr = min(lowest_psnr, get_psnr(tile.convert(placeholder.mode), placeholder))
+    print '%-12s %d of %d tiles (%.1f%%) are uniform within %d; lowest PSNR of their placeholders %.2f dB' % \
+          ('', num_uniform, num_tiles, num_uniform * 100.0 / num_tiles, tolerance, lowest_psnr)
+
+
+# Compares tiling the scales with tiling a Deep Zoom pyramid from the original
+# images, and with converting the scales to a pyramid (deleting the scales). The
+# number of files and bytes of every tiles directory are reported, and the lowest
+# PSNR of the tiles of the largest level converted from the 100% scale against
+# those tiled from the original images.
+def compare_deepzoom(files, work_dir, tile_size, scales):
+    tiles_dirs = {}
+    tiles_dirs['scales'] = work_dir + '/scales/'
+    elapsed_secs = benchmark_python(files, tiles_dirs['scales'], tile_size, scales)
+    scales_bytes = count_bytes(tiles_dirs['scales'])
+    print '%-12s %4d images, %6d files, %8.1f MB, %8.2f seconds' % \
+          ('scales', len(files), count_tiles(tiles_dirs['scales']), scales_bytes / 1048576.0, elapsed_secs)
+
+    tile_size = image_tiler.parse_int_list(tile_size)[0]
+    tiles_dirs['deepzoom'] = work_dir + '/deepzoom/'
+    start_time = time.time()
+    for path in files:
+        tile_deepzoom.generate_tiles(path, tiles_dirs['deepzoom'], media_checksum.get_sha1(path), tile_size)
+    elapsed_secs = time.time() - start_time
+    deepzoom_bytes = count_bytes(tiles_dirs['deepzoom'])
+    print '%-12s %4d images, %6d files, %8.1f MB, %8.2f seconds, %.1f%% fewer bytes than the scales' % \
+          ('deepzoom', len(files), count_tiles(tiles_dirs['deepzoom']), deepzoom_bytes / 1048576.0, elapsed_secs,
+           100.0 - deepzoom_bytes * 100.0 / scales_bytes)
+
+    start_time = time.time()
+    for path in files:
+        tiles_path = image_tiler.get_tiles_path(tiles_dirs['scales'], media_checksum.get_sha1(path))
+        tile_deepzoom.convert_tile_set(tiles_path, tile_size, True)
+    elapsed_secs = time.time() - start_time
+    converted_bytes = count_bytes(tiles_dirs['scales'])
+    print '%-12s %4d images, %6d files, %8.1f MB, %8.2f seconds, %.1f%% fewer bytes than the scales' % \
+          ('converted', len(files), count_tiles(tiles_dirs['scales']), converted_bytes / 1048576.0, elapsed_secs,
+           100.0 - converted_bytes * 100.0 / scales_bytes)
+
+    lowest_psnr = float('inf')
+    for path in files:
+        checksum = media_checksum.get_sha1(path)
+        converted_path = tile_deepzoom.get_files_path(image_tiler.get_tiles_path(tiles_dirs['scales'], checksum))
+        original_path = tile_deepzoom.get_files_path(image_tiler.get_tiles_path(tiles_dirs['deepzoom'], checksum))
+        level = str(max(int(x) for x in os.listdir(original_path))) + '/'
+        for tile in os.listdir(original_path + level):
+            lowest_psnr = min(lowest_psnr, get_psnr(Image.open(original_path + level + tile),
+                                                    Image.open(converted_path + level + tile)))
+    print '%-12s lowest PSNR of the converted tiles of the largest level %.2f dB' % ('', lowest_psnr)
+
+
+# Tiles the files in a separate process, so that the peak resident memory of the
+# process, and of the processes that it runs, could be reported.
+def measure_tiling(function, args):
+    queue = multiprocessing.Queue()
+
+    def run():
+        start_time = time.time()
+        function(*args)
+        peak_kb = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                      resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        queue.put((time.time() - start_time, peak_kb / 1024.0))
+
+    process = multiprocessing.Process(target=run)
+    process.start()
+    elapsed_secs, peak_mb = queue.get()
+    process.join()
+    return elapsed_secs, peak_mb
+
+
+# Compares the throughput and the peak memory of both tilers on DICOM images.
+def compare_dicom(files, work_dir, tile_size, scales):
+    tilers = [('python', benchmark_python)]
+    if has_imagemagick():
+        tilers.append(('script', benchmark_script))
+    else:
+        print 'ImageMagick convert is not available... will not benchmark the tiling script'
+    for name, function in tilers:
+        tiles_dir = work_dir + '/' + name
+        elapsed_secs, peak_mb = measure_tiling(function, (files, tiles_dir, tile_size, scales))
+        report(name, files, tiles_dir, elapsed_secs)
+        print '%-12s peak memory %.1f MB' % ('', peak_mb)
+
+
+# Write a synthetic greyscale PGM image band by band, so that the image is never
+# held in memory.
+def create_large_image(path, width, height):
+    band_rows = 256
+    gradient = Image.linear_gradient('L').resize((width, band_rows))
+    with open(path, 'wb') as f:
+        f.write('P5\n' + str(width) + ' ' + str(height) + '\n255\n')
+        for y in range(0, height, band_rows):
+            band = ImageChops.offset(gradient, (y * 7) % width, 0)
+            ImageDraw.Draw(band).ellipse([y % width, 0, y % width + band_rows, band_rows], fill=(y // band_rows) % 256)
+            f.write(band.crop((0, 0, width, min(band_rows, height - y))).tobytes())
+
+
+# Tile a large image using image_tiler.py in a separate process whose address
+# space is limited, and report the peak resident memory of that process.
+def tile_large_image(work_dir, width, height, tile_size, scales, memory_limit_mb):
+    path = work_dir + '/large.pgm'
+    print 'Creating ' + str(width) + 'x' + str(height) + ' pixels greyscale image...'
+    create_large_image(path, width, height)
+    address_space_limit = memory_limit_mb * 1048576
+
+    def limit_address_space():
+        resource.setrlimit(resource.RLIMIT_AS, (address_space_limit, address_space_limit))
+
+    tiler = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'image_tiler.py')
+    start_time = time.time()
+    process = Popen([sys.executable, tiler, '-m', str(memory_limit_mb), path, work_dir + '/large',
+                     tile_size, scales, '0' * 40], preexec_fn=limit_address_space)
+    return_code = process.wait()
+    elapsed_secs = time.time() - start_time
+    peak_mb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0
+    print '%-12s %d megapixels, %6d files, %8.2f seconds, peak memory %.1f MB (limit %d MB), %s' % \
+          ('bands', width * height / 1000000, count_tiles(work_dir + '/large'), elapsed_secs,
+           peak_mb, memory_limit_mb, 'succeeded' if return_code == 0 else 'FAILED')
+
+
+def benchmark_script(files, tiles_dir, tile_size, scales):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'generate_tiles_for_image.sh')
+    start_time = time.time()
+    for path in files:
+        call([script, path, tiles_dir, tile_size, scales])
+    return time.time() - start_time
+
+
+def has_imagemagick():
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        if os.access(os.path.join(path, 'convert'), os.X_OK):
+            return True
+    return False
+
+
+def print_usage():
+    print 'Usage:'
+    print '    benchmark_tiling.py [-n <images>] [-w <width>] [-h <height>] [-t <tile size>] [-s <scales>]'
+    print '                        [-p <processes>] [-c] [-d] [-D [-f <frames>]] [-g <width>x<height> [-m <memory limit>]]'
+    print '                        [-k [-r <reads>]] [-l <lazy scales>] [-u <tolerance>] [-z]'
+    print ''
+    print ' -n - Number of images in the synthetic corpus (default ' + str(DEFAULT_NUM_IMAGES) + ').'
+    print ' -w - Width of each image in pixels (default ' + str(DEFAULT_WIDTH) + ').'
+    print ' -h - Height of each image in pixels (default ' + str(DEFAULT_HEIGHT) + ').'
+    print ' -t - Comma separated list of tile sizes (default ' + DEFAULT_TILE_SIZE + ').'
+    print ' -s - Comma separated list of scales (default ' + DEFAULT_SCALES + ').'
+    print ' -p - Comma separated list of numbers of tiling processes, e.g., 1,2,4,8 (default 1).'
+    print ' -c - Compare the cascaded pyramid with resampling every scale from the original.'
+    print ' -d - Compare tiling JPEG images with and without reducing them whilst decoding'
+    print '      (default scales ' + DEFAULT_LOW_ZOOM_SCALES + ').'
+    print ' -D - Compare both tilers on DICOM images with 12-bit samples (requires pydicom).'
+    print ' -f - Number of frames in each DICOM image (default ' + str(DEFAULT_DICOM_FRAMES) + ').'
+    print ' -g - Tile a single large image of the given size in bands, e.g., 50000x50000.'
+    print ' -m - Memory limit (in megabytes) for tiling the large image (default ' + \
+          str(DEFAULT_MEMORY_LIMIT_MB) + ').'
+    print ' -k - Compare a file for every tile with a container for every image.'
+    print ' -r - Number of random tiles to read when comparing the storage (default ' + \
+          str(DEFAULT_RANDOM_READS) + ').'
+    print ' -l - Compare tiling every scale with tiling these scales on demand, e.g., ' + DEFAULT_LAZY_SCALES + '.'
+    print ' -u - Compare writing every tile with recording the tiles that are uniform within this tolerance'
+    print '      (e.g., 8), on images with a uniform background.'
+    print ' -z - Compare the scales with a Deep Zoom pyramid, tiled from the original images and converted'
+    print '      from the scales.'
+
+
+def main(argv):
+    num_images = DEFAULT_NUM_IMAGES
+    width = DEFAULT_WIDTH
+    height = DEFAULT_HEIGHT
+    tile_size = DEFAULT_TILE_SIZE
+    scales = None
+    processes = [1]
+    compare = False
+    compare_decoding = False
+    dicom_frames = None
+    large_size = None
+    memory_limit_mb = DEFAULT_MEMORY_LIMIT_MB
+    compare_containers = False
+    num_reads = DEFAULT_RANDOM_READS
+    lazy_scales = None
+    uniform_tolerance = None
+    compare_pyramids = False
+    try:
+        opts, args = getopt.getopt(argv, "n:w:h:t:s:p:cdDf:g:m:kr:l:u:z")
+        for opt, arg in opts:
+            if opt == '-n':
+                num_images = int(arg)
+            elif opt == '-w':
+                width = int(arg)
+            elif opt == '-h':
+                height = int(arg)
+            elif opt == '-t':
+                tile_size = arg
+            elif opt == '-s':
+                scales = arg
+            elif opt == '-p':
+                processes = image_tiler.parse_int_list(arg)
+            elif opt == '-c':
+                compare = True
+            elif opt == '-d':
+                compare_decoding = True
+            elif opt == '-D':
+                dicom_frames = dicom_frames or DEFAULT_DICOM_FRAMES
+            elif opt == '-f':
+                dicom_frames = int(arg)
+            elif opt == '-g':
+                large_size = [int(x) for x in arg.split('x')]
+            elif opt == '-m':
+                memory_limit_mb = int(arg)
+            elif opt == '-k':
+                compare_containers = True
+            elif opt == '-r':
+                num_reads = int(arg)
+            elif opt == '-l':
+                lazy_scales = arg
+            elif opt == '-u':
+                uniform_tolerance = int(arg)
+            elif opt == '-z':
+                compare_pyramids = True
+    except (getopt.GetoptError, ValueError):
+        print_usage()
+        sys.exit(2)
+
+    work_dir = tempfile.mkdtemp(prefix='benchmark_tiling_')
+    try:
+        if compare_decoding:
+            os.makedirs(work_dir + '/corpus')
+            print 'Creating ' + str(num_images) + ' JPEG images of ' + str(width) + 'x' + str(height) + ' pixels...'
+            files = create_corpus(work_dir + '/corpus', num_images, width, height, ['jpg'])
+            compare_reduced_decoding(files, work_dir, tile_size, scales or DEFAULT_LOW_ZOOM_SCALES)
+            return
+
+        scales = scales or DEFAULT_SCALES
+        if dicom_frames:
+            if pydicom is None:
+                print 'pydicom and NumPy are required for creating DICOM images...'
+                return
+            os.makedirs(work_dir + '/corpus')
+            print 'Creating ' + str(num_images) + ' DICOM images of ' + str(width) + 'x' + str(height) + \
+                  ' pixels with ' + str(dicom_frames) + ' frames...'
+            files = []
+            for i in range(num_images):
+                files.append(work_dir + '/corpus/image_' + str(i) + '.dcm')
+                create_dicom(files[-1], width, height, i, dicom_frames)
+            compare_dicom(files, work_dir, tile_size, scales)
+            return
+
+        if large_size:
+            tile_large_image(work_dir, large_size[0], large_size[1], tile_size, scales, memory_limit_mb)
+            return
+
+        if uniform_tolerance is not None:
+            os.makedirs(work_dir + '/corpus')
+            print 'Creating ' + str(num_images) + ' images of ' + str(width) + 'x' + str(height) + \
+                  ' pixels with a uniform background...'
+            files = create_corpus(work_dir + '/corpus', num_images, width, height, draw=draw_xray)
+            compare_uniform(files, work_dir, tile_size, scales, uniform_tolerance)
+            return
+
+        os.makedirs(work_dir + '/corpus')
+        print 'Creating ' + str(num_images) + ' images of ' + str(width) + 'x' + str(height) + ' pixels...'
+        files = create_corpus(work_dir + '/corpus', num_images, width, height)
+
+        if compare:
+            compare_cascade(files, work_dir, tile_size, scales)
+            return
+
+        if compare_containers:
+            compare_storage(files, work_dir, tile_size, scales, num_reads)
+            return
+
+        if lazy_scales:
+            compare_lazy(files, work_dir, tile_size, scales, lazy_scales)
+            return
+
+        if compare_pyramids:
+            compare_deepzoom(files, work_dir, tile_size, scales)
+            return
+
+        single_process_secs = None
+        for workers in processes:
+            tiles_dir = work_dir + '/python_' + str(workers)
+            elapsed_secs = benchmark_python(files, tiles_dir, tile_size, scales, workers)
+            report('python x' + str(workers), files, tiles_dir, elapsed_secs)
+            if workers == 1:
+                single_process_secs = elapsed_secs
+            elif single_process_secs:
+                print '%-12s speedup %.2f over a single process' % ('', single_process_secs / elapsed_secs)
+        if has_imagemagick():
+            report('script', files, work_dir + '/script',
+                   benchmark_script(files, work_dir + '/script', tile_size, scales))
+        else:
+            print 'ImageMagick convert is not available... will not benchmark the tiling script'
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -21,13 +21,11 @@
 import MySQLdb
 import os
 import re
-import hashlib
 import ConfigParser
+import image_tiler
+import media_checksum
 from PIL import Image
 
-# Hashing block size
-HASH_BLOCK_SIZE = 65536
-
 # Get all of the media files that have been marked for download.
 GET_FILES_MARKED_FOR_DOWNLOADED = '''
 select f.id as media_id, f.cid, f.lid, f.gid, f.sid, f.pid, f.qid, f.url,
@@ -40,8 +38,7 @@ order by f.cid, f.lid, f.gid, f.sid, f.pid, f.qid, f.mid
 
 GET_PHASE_ID = "select id from phenodcc_media.phase where short_name = %s limit 1"
 GET_STATUS_ID = "select id from phenodcc_media.a_status where short_name = %s limit 1"
-UPDATE_PHASE_STATUS = 'update phenodcc_media.media_file set phase_id = %s, status_id = %s where id = %s'
-UPDATE_CHECKSUM = 'update phenodcc_media.media_file set checksum = %s where id = %s'
+UPDATE_PHASE_STATUS = 'update phenodcc_media.media_file set phase_id = %s, status_id = %s where id in ({0})'
 UPDATE_IMAGE_SIZE = 'update phenodcc_media.media_file set width = %s, height = %s where id = %s'
 
 # get phases used
@@ -67,21 +64,6 @@ def create_media_path(cid, lid, gid, sid, pid, qid):
     return path
 
 
-# Calculate the SHA1 checksum of the file that was successfully downloaded.
-# Note that this checksum is used to link file to their thumbnails and tiles.
-def get_sha1(file_path):
-    has_generator = hashlib.sha1()
-    try:
-        with open(file_path, 'rb') as f:
-            buf = f.read(HASH_BLOCK_SIZE)
-            while len(buf) > 0:
-                has_generator.update(buf)
-                buf = f.read(HASH_BLOCK_SIZE)
-    except IOError:
-        return None
-    return has_generator.hexdigest()
-
-
 # Determine width and height of an image file
 def get_image_size(image_file):
     size = None
@@ -96,6 +78,11 @@ def get_image_size(image_file):
 
 # Determine the width and height of the original image in pixels
 def get_image_width_height(tiles_path, tile_size):
+    # The manifest of the tiles records the size of the original image.
+    manifest = image_tiler.read_manifest(tiles_path)
+    if manifest is not None:
+        return manifest['width'], manifest['height']
+
     # See if the converted original JPEG file still exists.
     # For later versions of the tile generation script, the original will be available.
     size = get_image_size(tiles_path + 'original.jpg')
@@ -126,10 +113,26 @@ def get_image_width_height(tiles_path, tile_size):
                         break
         except (OSError):
             print 'Tiles directory', original_scale_tiles_path, 'does not exist'
+
+    # Write the manifest, so that the tiles need not be scanned again.
+    if size is not None:
+        try:
+            image_tiler.scan_manifest(tiles_path, size)
+        except (IOError, OSError):
+            print 'Failed to write the manifest of tiles in', tiles_path
     return size
 
 
+# Updates the phase and status of media files, grouped by the (phase, status) pair.
+def update_phase_status(cur, phase_status_updates):
+    for (phase_id, status_id), media_ids in phase_status_updates.items():
+        if len(media_ids) > 0:
+            cur.execute(UPDATE_PHASE_STATUS.format(', '.join(['%s'] * len(media_ids))),
+                        [phase_id, status_id] + media_ids)
+
+
 # Fix data context associated with media files that have been marked for download.
+# The checksums are calculated in parallel, and the updates are made in batches.
 def fix_marked_files():
     connection = MySQLdb.connect(MEDIA_HOSTNAME,
                                  MEDIA_USERNAME,
@@ -138,6 +141,8 @@ def fix_marked_files():
     with connection:
         cur = connection.cursor(MySQLdb.cursors.DictCursor)
         cur.execute(GET_FILES_MARKED_FOR_DOWNLOADED)
+        records = {}
+        media_files = []
         for i in range(cur.rowcount):
             record = cur.fetchone()
             media_id = record['media_id']
@@ -146,29 +151,49 @@ def fix_marked_files():
             path = create_media_path(record['cid'], record['lid'],
                                      record['gid'], record['sid'],
                                      record['pid'], record['qid'])
-            original_media = path + record['media_id'] + '.' + record['ext']
-            checksum = get_sha1(original_media)
+            records[media_id] = (record['is_image'], record['phase_id'], record['status_id'])
+            media_files.append((media_id, path + str(media_id) + '.' + record['ext']))
+
+        stats = media_checksum.ChecksumStats()
+        checksums = []
+        phase_status_updates = {}
+        for media_id, original_media, checksum in media_checksum.calculate_checksums(media_files, stats,
+                                                                                   CHECKSUM_WORKERS):
+            is_image, phase_id, status_id = records.pop(media_id)
             if checksum is None:
                 # Try to download the file again unless it failed in previous attempt
-                if not (record['phase_id'] == DOWNLOAD_PHASE and record['status_id'] == FAILED_STATUS):
-                    cur.execute(UPDATE_PHASE_STATUS, (DOWNLOAD_PHASE, PENDING_STATUS, media_id))
+                if not (phase_id == DOWNLOAD_PHASE and status_id == FAILED_STATUS):
+                    phase_status_updates.setdefault((DOWNLOAD_PHASE, PENDING_STATUS), []).append(media_id)
             else:
-                cur.execute(UPDATE_CHECKSUM, (checksum, media_id))
+                checksums.append((media_id, checksum))
 
                 # If media file is not an image, we are done
-                if record['is_image'] == 0:
-                    cur.execute(UPDATE_PHASE_STATUS, (CHECKSUM_PHASE, DONE_STATUS, media_id))
+                if is_image == 0:
+                    phase_status_updates.setdefault((CHECKSUM_PHASE, DONE_STATUS), []).append(media_id)
                 else:
                     # See if we managed to generate the tiles
                     checksum_path = re.sub(r'(.{4})', '\\1/', checksum, 0, re.DOTALL)
                     tiles_path = IMAGE_TILES_DIR + checksum_path
                     image_size = get_image_width_height(tiles_path, TILE_SIZE)
                     if image_size is None:
-                        cur.execute(UPDATE_PHASE_STATUS, (TILE_GENERATION_PHASE, FAILED_STATUS, media_id))
+                        phase_status_updates.setdefault((TILE_GENERATION_PHASE, FAILED_STATUS),
+                                                        []).append(media_id)
                     else:
                         cur.execute(UPDATE_IMAGE_SIZE, image_size + (media_id,))
-                        cur.execute(UPDATE_PHASE_STATUS, (TILE_GENERATION_PHASE, DONE_STATUS, media_id))
-            connection.commit()
+                        phase_status_updates.setdefault((TILE_GENERATION_PHASE, DONE_STATUS),
+                                                        []).append(media_id)
+
+            if len(checksums) + sum(len(x) for x in phase_status_updates.values()) >= 2 * CHECKSUM_BATCH_SIZE:
+                media_checksum.update_checksums(cur, checksums)
+                update_phase_status(cur, phase_status_updates)
+                connection.commit()
+                checksums = []
+                phase_status_updates = {}
+
+        media_checksum.update_checksums(cur, checksums)
+        update_phase_status(cur, phase_status_updates)
+        connection.commit()
+        print stats.summary()
 
 
 # Get primary key identifiers from phase and status short names.
@@ -205,6 +230,7 @@ def get_configuration():
     global MEDIA_DATABASE, MEDIA_HOSTNAME, MEDIA_USERNAME, MEDIA_PASSWORD
     global ORIGINAL_MEDIA_FILES_DIR, IMAGE_TILES_DIR
     global TILE_SIZE, IMAGE_SCALES
+    global CHECKSUM_WORKERS, CHECKSUM_BATCH_SIZE
 
     config = ConfigParser.RawConfigParser()
     config.read('phenodcc_media.config')
@@ -233,6 +259,14 @@ def get_configuration():
     TILE_SIZE = config.get('tiling', 'tile_size')
     IMAGE_SCALES = config.get('tiling', 'image_scales')
 
+    # Concerning checksum calculation
+    CHECKSUM_WORKERS = media_checksum.DEFAULT_WORKERS
+    if config.has_option('checksum', 'workers'):
+        CHECKSUM_WORKERS = config.getint('checksum', 'workers')
+    CHECKSUM_BATCH_SIZE = media_checksum.DEFAULT_BATCH_SIZE
+    if config.has_option('checksum', 'batch_size'):
+        CHECKSUM_BATCH_SIZE = config.getint('checksum', 'batch_size')
+
 
 get_configuration()
 set_phase_status_ids()
@@ -62,38 +62,54 @@ esac
 # <total columns>_<total rows>_<row>_<column>.<preferred extension>
 #
 # where row and column indices start from 0.
+#
+# @param $1 Directory that contains the scaled image
+# @param $2 Maximum size of a tile in pixels
+# @param $3 Scale in percentage
 function generate_tiles() {
+    tiles_dir=$1$2/$3;
+    if [[ ! -d "${tiles_dir}" ]]
+    then
+        #echo "    Directory $tiles_dir for $2x$2 tiles at $3% scale does not exists...";
+        mkdir -p ${tiles_dir};
+    fi;
+
     # Uses ImageMagick to generate tiles
-    (cd $1; convert scaled.${extension} -crop $2x$2 -set filename:tile "%[fx:ceil(page.width/$2)]_%[fx:ceil(page.height/$2)]_%[fx:page.y/$2]_%[fx:page.x/$2]" +repage +adjoin "%[filename:tile].$extension"; )
+    (cd ${tiles_dir}; convert ../../scaled_$3.${extension} -crop $2x$2 -set filename:tile "%[fx:ceil(page.width/$2)]_%[fx:ceil(page.height/$2)]_%[fx:page.y/$2]_%[fx:page.x/$2]" +repage +adjoin "%[filename:tile].$extension"; )
+}
 
-    # Delete the scaled image to reduce space.
-    (cd $1; rm -f scaled.${extension}; )
+# Dimension of the original image after scaling by the supplied percentage,
+# rounded to the nearest pixel.
+#
+# @param $1 Dimension of the original image in pixels
+# @param $2 Scale in percentage
+function scaled_dimension() {
+    echo "$1 $2" | awk '{ d = int($1 * $2 / 100 + 0.5); print (d < 1 ? 1 : d) }';
 }
 
-# Scales the original image and then generates the tiles
+# Scales an image to the dimensions of the original image at the supplied
+# scale, and then generates the tiles for every tile size.
 #
 # @param $1 Directory that contains the image
-# @param $2 Maximum size of a tile in pixels
+# @param $2 Comma separated list of maximum sizes of tiles in pixels
 # @param $3 Scale in percentage
+# @param $4 Image to scale, which is either the original or a larger scale
 #
-# E.g., scale_and_generate_tiles b5eaf5627beae587bc779b68ec8f41b30caa4015 64 80
+# E.g., scale_and_generate_tiles b5eaf5627beae587bc779b68ec8f41b30caa4015 64 80 original.jpg
 # will first scale the image by 80% and then generate tiles where each
 # tile is smaller or equal to 64x64.
 function scale_and_generate_tiles() {
-    tiles_dir=$1$2/$3;
-    if [[ ! -d "${tiles_dir}" ]]
-    then
-        #echo "    Directory $tiles_dir for $2x$2 tiles at $3% scale does not exists...";
-        mkdir -p ${tiles_dir};
-    fi;
-    
+    scaled_width=`scaled_dimension ${original_width} $3`;
+    scaled_height=`scaled_dimension ${original_height} $3`;
+
     # Uses ImageMagick to scale the image
-    if [[ ! -z "$3" ]]
-    then
-        (cd ${tiles_dir}; convert ../../original.${extension} -resize $3% scaled.${extension}; )
-    fi;
+    (cd $1; convert $4 -resize ${scaled_width}x${scaled_height}! scaled_$3.${extension}; )
 
-    generate_tiles ${tiles_dir} $2;
+    for tile_size in `echo "$2" | tr ',' ' '`
+    do
+        #echo "    Generating ${tile_size} x ${tile_size} tiles...";
+        generate_tiles $1 ${tile_size} $3;
+    done;
 }
 
 # Generates tile set from an original image using supplied tile sizes
@@ -110,8 +126,13 @@ function generate_tiles_set() {
         #echo "    Converting DICOM to preferred image format...";
         (cd ${checksum_dir}; convert -define dcm:display-range=reset original.${extension} -normalize original.${pref_format}; )
     else
+        # Choose the largest frame by its dimensions, which are read from the
+        # headers, so that only that frame is decoded (e.g., for multi-page and
+        # pyramidal TIF). The first of the largest frames is chosen.
+        frame=`cd ${checksum_dir}; identify -format "%p %w %h\n" original.${extension} | awk 'BEGIN { largest = -1; frame = 0 } { if ($2 * $3 > largest) { largest = $2 * $3; frame = $1 } } END { print frame }'`;
+
         #echo "    Converting image to preferred image format...";
-        (cd ${checksum_dir}; convert original.${extension} original.${pref_format}; )
+        (cd ${checksum_dir}; convert "original.${extension}[${frame}]" original.${pref_format}; )
     fi;
 
     # Capture return code of last comand
@@ -133,10 +154,10 @@ function generate_tiles_set() {
     # we convert all images to preferred image format before processing
     extension="$pref_format";
 
-    # If there were multiple extracted files generated (e.g., TIF), choose
-    # the largest file as original image.
+    # If there were multiple extracted files generated (e.g., DICOM with
+    # multiple frames), choose the largest file as original image.
     #
-    # NOTE: we are assuming TIF files may contain the same image at
+    # NOTE: we are assuming these files may contain the same image at
     # different zooms; but not different images.
     if [[ `find ${checksum_dir} -maxdepth 1 -iname "*.${pref_format}" -type f | wc -l` -gt 1 ]]
     then
@@ -153,17 +174,33 @@ function generate_tiles_set() {
     #echo "    Generating thumbnail...";
     (cd ${checksum_dir}; convert original.${pref_format} -resize 300x thumbnail.${pref_format}; )
 
-    echo "$2" | sed -n 1'p' | tr ',' '\n' |
-    while read tile_size;
+    # The dimensions at every scale are calculated from the original image.
+    original_size=`cd ${checksum_dir}; identify -format "%w %h" original.${pref_format}`;
+    original_width=`echo ${original_size} | cut -d " " -f 1`;
+    original_height=`echo ${original_size} | cut -d " " -f 2`;
+
+    # Generate the largest scale first, so that every smaller scale is resampled
+    # from the previous scale, instead of the original image.
+    previous="original.${pref_format}";
+    for scale in `echo "$3" | sed -n 1'p' | tr ',' '\n' | sort -nru`
     do
-        #echo "    Generating ${tile_size} x ${tile_size} tiles...";
-        echo "$3" | sed -n 1'p' | tr ',' '\n' |
-        while read scale;
-        do
-            #echo "    Generating tiles at scale $scale%...";
-            scale_and_generate_tiles ${checksum_dir} ${tile_size} ${scale};
-        done;
+        #echo "    Generating tiles at scale $scale%...";
+        if [[ ${scale} -gt 100 ]]
+        then
+            scale_and_generate_tiles ${checksum_dir} $2 ${scale} original.${pref_format};
+            (cd ${checksum_dir}; rm -f scaled_${scale}.${extension}; )
+        else
+            scale_and_generate_tiles ${checksum_dir} $2 ${scale} ${previous};
+
+            # Delete the previous scaled image to reduce space.
+            if [[ "${previous}" != "original.${pref_format}" ]]
+            then
+                (cd ${checksum_dir}; rm -f ${previous}; )
+            fi;
+            previous="scaled_${scale}.${extension}";
+        fi;
     done;
+    (cd ${checksum_dir}; rm -f scaled_*.${extension}; )
 
     # Delete converted original media file since tiles have been generated.
     (cd ${checksum_dir}; rm -f original.${pref_format}; )
@@ -0,0 +1,829 @@
+#! /usr/bin/python
+#
+# Copyright 2014 Medical Research Council Harwell.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# @author Gagarine Yaikhom <g.yaikhom@har.mrc.ac.uk>
+#
+
+# DESCRIPTION:
+#
+# Generates a well organised set of tiles from the supplied image file using
+# Pillow. This produces the same tiles set as generate_tiles_for_image.sh,
+# but the original image is decoded only once, and the thumbnail and the
+# tiles for every tile size and scale are generated in memory. The scales
+# are generated as a cascade, where every scale is resampled from the next
+# larger scale instead of the original image.
+#
+# JPEG images are reduced by 1/2, 1/4 or 1/8 whilst decoding when the largest
+# scale that is required allows it, and the scales are then resampled from the
+# reduced image.
+#
+# Images that are too large to tile in memory are tiled in horizontal bands,
+# so that the memory used is proportional to the width of the image, and not
+# its area. This requires an image format whose rows could be read directly
+# from the file (e.g., uncompressed TIFF, PPM/PGM and BMP).
+#
+# DICOM images are decoded with pydicom into NumPy arrays, and their contrast
+# is stretched as done by ImageMagick with -define dcm:display-range=reset and
+# -normalize, before they are tiled like any other image.
+#
+# Once all of the tiles have been generated, a manifest (manifest.json) is
+# written next to the thumbnail. It records the size of the original image,
+# the grid of tiles and their total size for every tile size and scale, and
+# the encoder settings, so that these never require a scan of the tiles.
+#
+# Tiles whose samples are all within a tolerance of each other (e.g., the
+# background of X-ray and histology images) could be recorded in the manifest
+# with their colour, instead of being encoded and written. These are served by
+# tile_server.py as a placeholder of that colour.
+#
+# For multi-page and pyramidal TIFF images, the largest page is chosen using
+# the dimensions in the headers of the pages, and only that page is decoded.
+#
+# Images that this module does not handle (e.g., DICOM images when pydicom is
+# not installed, images other than TIFF with multiple frames, and images that are too large
+# to tile in memory but cannot be read in bands) raise UnsupportedImage, so
+# that the caller could fall back to generate_tiles_for_image.sh.
+
+import json
+import math
+import os
+import re
+import shutil
+import sys
+from PIL import Image
+from cStringIO import StringIO
+
+import getopt
+import media_checksum
+
+# pydicom and NumPy are optional. Without them, DICOM images are tiled by
+# generate_tiles_for_image.sh instead.
+try:
+    import numpy
+    import pydicom
+except ImportError:
+    numpy = pydicom = None
+
+# Preferred image format
+PREFERRED_FORMAT = 'jpg'
+JPEG_QUALITY = 92
+
+# Width of the thumbnail in pixels
+THUMBNAIL_WIDTH = 300
+
+# The manifest of a tiles set is written atomically, once all of the tiles
+# have been generated. The version is incremented if its contents change.
+MANIFEST_FILE = 'manifest.json'
+MANIFEST_VERSION = 1
+
+# <total columns>_<total rows>_<row>_<column>.jpg
+TILE_NAME_PATTERN = re.compile(r'^(\d+)_(\d+)_\d+_\d+\.' + PREFERRED_FORMAT + '$')
+
+# Pillow image modes that could be saved as JPEG without any conversion.
+JPEG_MODES = ('L', 'RGB')
+
+# Pillow image modes with more than 8 bits per sample. These need the
+# windowing applied by ImageMagick, hence, they are not handled here.
+HIGH_BIT_DEPTH_MODES = ('I', 'I;16', 'I;16B', 'I;16L', 'F')
+
+# The size of images is limited by the memory limit instead.
+Image.MAX_IMAGE_PIXELS = None
+
+# When tiling in bands, the number of rows read from the original image at
+# a time, and the support of the Lanczos filter in pixels.
+BAND_ROWS = 256
+LANCZOS_SUPPORT = 3
+
+# Contrast stretch of DICOM images, as done by ImageMagick's -normalize: the
+# darkest 2% of the pixels become black and the brightest 1% become white.
+NORMALIZE_BLACK_POINT = 0.02
+NORMALIZE_WHITE_POINT = 0.99
+
+
+class UnsupportedImage(Exception):
+    pass
+
+
+# Decompose the 40 character checksum into a path that is 10 levels deep,
+# where each directory name contains four characters.
+def get_tiles_path(tiles_dir, checksum):
+    if not tiles_dir.endswith('/'):
+        tiles_dir += '/'
+    return tiles_dir + re.sub(r'(.{4})', '\\1/', checksum, 0, re.DOTALL)
+
+
+# Parse comma separated list of integers, e.g., "10,25,50,75,100".
+def parse_int_list(values):
+    return [int(x) for x in str(values).split(',') if len(x.strip()) > 0]
+
+
+# Dimension of the image after scaling by the supplied percentage. This is
+# rounded to the nearest pixel, as done by ImageMagick's -resize.
+def get_scaled_size(size, scale):
+    return (max(1, int(math.floor(size[0] * scale / 100.0 + 0.5))),
+            max(1, int(math.floor(size[1] * scale / 100.0 + 0.5))))
+
+
+# Dimension of the thumbnail, which is THUMBNAIL_WIDTH pixels wide.
+def get_thumbnail_size(size):
+    return (THUMBNAIL_WIDTH,
+            max(1, int(math.floor(size[1] * THUMBNAIL_WIDTH / float(size[0]) + 0.5))))
+
+
+# Number of columns and rows of tiles of the supplied size for a scaled image.
+def get_tile_grid(size, tile_size):
+    return int(math.ceil(size[0] / float(tile_size))), int(math.ceil(size[1] / float(tile_size)))
+
+
+# The file name of a tile contains the number of columns and rows in the tile grid,
+# and the row and column of the tile.
+def get_tile_name(num_cols, num_rows, row, col):
+    return str(num_cols) + '_' + str(num_rows) + '_' + str(row) + '_' + str(col) + '.' + PREFERRED_FORMAT
+
+
+# Convert an image to a mode that could be saved as JPEG.
+def to_jpeg_mode(img):
+    if img.mode not in JPEG_MODES:
+        img = img.convert('L' if img.mode in ('1', 'LA') else 'RGB')
+    return img
+
+
+# Returns the colour of a tile, as a list with a value for every band, if the
+# difference between the lowest and highest value of every band is within the
+# tolerance. Otherwise, returns None. The extrema, and the mean colour of uniform
+# tiles, are calculated by Pillow in a single pass over the pixels, which is much
+# cheaper than encoding the tile.
+def get_uniform_colour(img, tolerance):
+    extrema = img.getextrema()
+    if img.mode == 'L':
+        extrema = [extrema]
+    for low, high in extrema:
+        if high - low > tolerance:
+            return None
+    colour = img.resize((1, 1), Image.BOX).getpixel((0, 0))
+    return [colour] if img.mode == 'L' else list(colour)
+
+
+# Returns the size of a tile in a tile grid. The tiles in the last column and row
+# could be smaller than the tile size.
+def get_tile_size(size, tile_size, row, col):
+    return min(tile_size, size[0] - col * tile_size), min(tile_size, size[1] - row * tile_size)
+
+
+# Returns the JPEG data of a tile of a single colour.
+def create_uniform_tile(size, colour):
+    if len(colour) == 1:
+        img = Image.new('L', size, colour[0])
+    else:
+        img = Image.new('RGB', size, tuple(colour))
+    buf = StringIO()
+    img.save(buf, 'JPEG', quality=JPEG_QUALITY)
+    return buf.getvalue()
+
+
+def is_dicom(image_file):
+    return image_file.lower().endswith('.dcm')
+
+
+# Seek to the first of the largest frames of a multi-page TIFF image. Seeking
+# only reads the header of every page, without decoding any of the pages.
+def select_largest_frame(img):
+    largest_frame = largest_area = -1
+    for frame in range(img.n_frames):
+        img.seek(frame)
+        if img.size[0] * img.size[1] > largest_area:
+            largest_frame = frame
+            largest_area = img.size[0] * img.size[1]
+    img.seek(largest_frame)
+
+
+# Open the original image without decoding it.
+def open_original(image_file):
+    if is_dicom(image_file):
+        raise UnsupportedImage('DICOM image "' + image_file + '"')
+    img = Image.open(image_file)
+    if getattr(img, 'n_frames', 1) > 1:
+        if img.format != 'TIFF':
+            raise UnsupportedImage('Image "' + image_file + '" has multiple frames')
+        select_largest_frame(img)
+    if img.mode in HIGH_BIT_DEPTH_MODES:
+        raise UnsupportedImage('Image "' + image_file + '" has mode ' + img.mode)
+    return img
+
+
+# Open the original image and convert it to a mode that could be saved as JPEG.
+def open_image(image_file):
+    if is_dicom(image_file):
+        return open_dicom(image_file)
+    img = open_original(image_file)
+    img.load()
+    return to_jpeg_mode(img)
+
+
+# The largest image that is resampled from the original, i.e., the largest
+# scale or the thumbnail, whichever is larger.
+def get_largest_scaled_size(size, scales):
+    sizes = [get_scaled_size(size, scale) for scale in scales] + [get_thumbnail_size(size)]
+    return max(x[0] for x in sizes), max(x[1] for x in sizes)
+
+
+# Let the JPEG decoder reduce the image by 1/2, 1/4 or 1/8 by scaling the DCT
+# coefficients, if the reduced image is still at least as large as the supplied
+# size. This is much cheaper than decoding the entire image and resampling it.
+# Must be called before the image is loaded. Returns True if the image was reduced.
+def reduce_while_decoding(img, size):
+    if img.format != 'JPEG' or size[0] * 2 > img.size[0] or size[1] * 2 > img.size[1]:
+        return False
+    img.draft(img.mode, size)
+    return True
+
+
+# Values at the supplied fractions of the sorted pixel values. Integer pixels of
+# up to 16 bits are counted in a histogram, a band of rows at a time, instead
+# of sorting a copy of the pixels.
+def get_pixel_percentiles(pixels, fractions):
+    if pixels.dtype.kind not in 'iu' or pixels.dtype.itemsize > 2:
+        return numpy.percentile(pixels, [x * 100 for x in fractions])
+    num_values = 1 << (8 * pixels.dtype.itemsize)
+    unsigned = pixels.view(numpy.dtype('u' + str(pixels.dtype.itemsize)))
+    counts = numpy.zeros(num_values, dtype=numpy.int64)
+    for y in range(0, unsigned.shape[0], BAND_ROWS):
+        counts += numpy.bincount(unsigned[y:y + BAND_ROWS].ravel(), minlength=num_values)
+    values = numpy.arange(num_values)
+    if pixels.dtype.kind == 'i':
+        # Negative values follow the positive values in the unsigned view
+        counts = numpy.roll(counts, num_values // 2)
+        values -= num_values // 2
+    cumulative = numpy.cumsum(counts)
+    indices = numpy.searchsorted(cumulative, [x * cumulative[-1] for x in fractions])
+    return [values[min(i, num_values - 1)] for i in indices]
+
+
+# Maps the pixel values of a DICOM frame to 8 bits. The window in the file is
+# ignored, and the values are stretched linearly between the black and white
+# points. Integer pixels of up to 16 bits are mapped with a lookup table that
+# has an entry for every possible value.
+def normalize_pixels(pixels, invert):
+    low, high = get_pixel_percentiles(pixels, (NORMALIZE_BLACK_POINT, NORMALIZE_WHITE_POINT))
+    scale = 255.0 / max(high - low, 1)
+    if pixels.dtype.kind not in 'iu' or pixels.dtype.itemsize > 2:
+        normalized = numpy.clip((pixels.astype(numpy.float32) - low) * scale + 0.5, 0, 255).astype(numpy.uint8)
+        return 255 - normalized if invert else normalized
+
+    num_values = 1 << (8 * pixels.dtype.itemsize)
+    values = numpy.arange(num_values, dtype=numpy.float64)
+    if pixels.dtype.kind == 'i':
+        values[num_values // 2:] -= num_values
+    lookup = numpy.clip((values - low) * scale + 0.5, 0, 255).astype(numpy.uint8)
+    if invert:
+        lookup = 255 - lookup
+    unsigned = pixels.view(numpy.dtype('u' + str(pixels.dtype.itemsize)))
+    normalized = numpy.empty(pixels.shape, dtype=numpy.uint8)
+    for y in range(0, pixels.shape[0], BAND_ROWS):
+        normalized[y:y + BAND_ROWS] = lookup[unsigned[y:y + BAND_ROWS]]
+    return normalized
+
+
+# Decode a DICOM image and convert it to an 8-bit greyscale or RGB image. For
+# images with multiple frames, the frame with the most contrast is chosen.
+# Images that require more memory (in bytes) than the supplied limit, or that
+# could not be decoded by pydicom (e.g., compressed images without a suitable
+# handler), raise UnsupportedImage.
+def open_dicom(image_file, memory_limit=None):
+    if pydicom is None:
+        raise UnsupportedImage('DICOM image "' + image_file + '" (pydicom is not installed)')
+    try:
+        dataset = pydicom.dcmread(image_file, defer_size='1 MB')
+        photometric = dataset.get('PhotometricInterpretation', 'MONOCHROME2')
+        if photometric not in ('MONOCHROME1', 'MONOCHROME2', 'RGB'):
+            raise UnsupportedImage('DICOM image "' + image_file + '" is ' + photometric)
+        width, height = dataset.Columns, dataset.Rows
+        num_frames = int(dataset.get('NumberOfFrames', 1))
+        bytes_per_sample = (dataset.BitsAllocated + 7) // 8
+        samples = dataset.get('SamplesPerPixel', 1)
+        memory_required = width * height * samples * (num_frames * bytes_per_sample + 2)
+        if memory_limit and memory_required > memory_limit:
+            raise UnsupportedImage('DICOM image "' + image_file + '" requires ' +
+                                   str(memory_required // 1048576) + ' MB')
+        pixels = dataset.pixel_array
+    except (pydicom.errors.InvalidDicomError, AttributeError, KeyError,
+            NotImplementedError, RuntimeError, ValueError) as e:
+        raise UnsupportedImage('DICOM image "' + image_file + '" could not be decoded: ' + str(e))
+
+    if num_frames > 1:
+        pixels = max(pixels, key=lambda frame: frame.std())
+    normalized = normalize_pixels(pixels, photometric == 'MONOCHROME1')
+    return Image.fromarray(normalized, 'RGB' if samples == 3 else 'L')
+
+
+# Estimate the memory required for tiling the image in memory: the decoded
+# original and the largest scaled image, in bytes.
+def get_memory_required(size, mode):
+    bytes_per_pixel = 1 if mode in ('1', 'L') else 3
+    return 2 * size[0] * size[1] * bytes_per_pixel
+
+
+# Reads horizontal bands of rows directly from an image file. This is only
+# possible if the image data is stored uncompressed in strips that span the
+# width of the image, as described by the tile descriptors of the image.
+class BandReader(object):
+    def __init__(self, img):
+        width = img.size[0]
+        self.img = img
+        self.strips = []
+        for decoder, extents, offset, args in img.tile:
+            if decoder != 'raw' or extents[0] != 0 or extents[2] != width:
+                raise UnsupportedImage('Image with ' + decoder + ' data cannot be read in bands')
+            if not isinstance(args, tuple):
+                args = (args,)
+            rawmode, stride, orientation = (args + (0, 1))[:3]
+            try:
+                if stride <= 0:
+                    stride = len(Image.new(img.mode, (width, 1)).tobytes('raw', rawmode))
+            except (ValueError, SystemError):
+                raise UnsupportedImage('Image with raw mode ' + rawmode + ' cannot be read in bands')
+            self.strips.append((extents[1], extents[3], offset, rawmode, stride, orientation))
+        self.file = open(img.filename, 'rb')
+
+    # Returns rows [y0, y1) of the image, in a mode that could be saved as JPEG.
+    def read(self, y0, y1):
+        width = self.img.size[0]
+        band = Image.new(self.img.mode, (width, y1 - y0))
+        for strip_y0, strip_y1, offset, rawmode, stride, orientation in self.strips:
+            top = max(y0, strip_y0)
+            bottom = min(y1, strip_y1)
+            if top >= bottom:
+                continue
+            if orientation < 0:
+                # Rows are stored bottom-up
+                self.file.seek(offset + (strip_y1 - bottom) * stride)
+            else:
+                self.file.seek(offset + (top - strip_y0) * stride)
+            data = self.file.read((bottom - top) * stride)
+            band.paste(Image.frombytes(self.img.mode, (width, bottom - top), data,
+                                       'raw', rawmode, stride, orientation), (0, top - y0))
+        if band.mode == 'P':
+            band.putpalette(self.img.getpalette())
+        return to_jpeg_mode(band)
+
+    def close(self):
+        self.file.close()
+
+
+# Writes the thumbnail and tiles into the tiles directory of the image using
+# the following filename template:
+#
+# <tile size>/<scale>/<total columns>_<total rows>_<row>_<column>.jpg
+#
+# where row and column indices start from 0.
+#
+# The grid and the number of bytes of the tiles written for every tile size and
+# scale are recorded, so that the manifest could be written once they are done.
+# The scales that are tiled on demand (see tile_cache.py) are recorded in the
+# manifest with the original image they are tiled from. If a tolerance is given,
+# uniform tiles are only recorded in the manifest, with their colour.
+class TileWriter(object):
+    def __init__(self, tiles_path, lazy=None, uniform_tolerance=None):
+        self.tiles_path = tiles_path
+        self.lazy = lazy
+        self.uniform_tolerance = uniform_tolerance
+        self.num_tiles = 0
+        self.num_uniform = 0
+        self.thumbnail = None
+        self.levels = {}
+
+    def save(self, img, file_path):
+        with open(file_path, 'wb') as f:
+            img.save(f, 'JPEG', quality=JPEG_QUALITY)
+            return f.tell()
+
+    def write_thumbnail(self, img):
+        num_bytes = self.save(img, self.tiles_path + 'thumbnail.' + PREFERRED_FORMAT)
+        self.thumbnail = {'width': img.size[0], 'height': img.size[1], 'bytes': num_bytes}
+
+    def write_tile(self, tile_size, scale, num_cols, num_rows, row, col, img):
+        path = self.tiles_path + str(tile_size) + '/' + str(scale) + '/'
+        level = self.levels.get((tile_size, scale))
+        if level is None:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            level = self.levels[(tile_size, scale)] = create_manifest_level(tile_size, scale, num_cols, num_rows)
+        if self.add_uniform_tile(level, row, col, img):
+            return
+        level['bytes'] += self.save(img, path + get_tile_name(num_cols, num_rows, row, col))
+        level['tiles'] += 1
+        self.num_tiles += 1
+
+    # Returns True if the tile is uniform, and was recorded instead of being written.
+    def add_uniform_tile(self, level, row, col, img):
+        if self.uniform_tolerance is None:
+            return False
+        colour = get_uniform_colour(img, self.uniform_tolerance)
+        if colour is None:
+            return False
+        level.setdefault('uniform', []).append([row, col, colour])
+        self.num_uniform += 1
+        return True
+
+    def create_manifest(self, size):
+        manifest = create_manifest(size, 'pillow', JPEG_QUALITY, self.thumbnail, self.levels.values())
+        if self.lazy:
+            manifest['lazy'] = self.lazy
+        return manifest
+
+    # Write the manifest, once all of the tiles and the thumbnail were written.
+    def write_manifest(self, size):
+        write_manifest(self.tiles_path, self.create_manifest(size))
+
+    def close(self):
+        pass
+
+
+def get_manifest_path(tiles_path):
+    return os.path.join(tiles_path, MANIFEST_FILE)
+
+
+def create_manifest_level(tile_size, scale, num_cols, num_rows):
+    return {'tile_size': tile_size, 'scale': scale, 'columns': num_cols, 'rows': num_rows,
+            'tiles': 0, 'bytes': 0}
+
+
+# The manifest of a tiles set.
+# size - Width and height of the original image
+# encoder - The encoder of the tiles, and its JPEG quality (None, if not known)
+# thumbnail - Width, height and bytes of the thumbnail
+# levels - Grid, number of tiles and bytes for every tile size and scale
+def create_manifest(size, encoder, quality, thumbnail, levels):
+    return {'version': MANIFEST_VERSION, 'width': size[0], 'height': size[1],
+            'format': PREFERRED_FORMAT, 'encoder': encoder, 'quality': quality,
+            'thumbnail': thumbnail,
+            'levels': sorted(levels, key=lambda x: (x['tile_size'], -x['scale']))}
+
+
+# Write the manifest to a temporary file, and rename it, so that a manifest that
+# exists is always complete.
+def write_manifest(tiles_path, manifest):
+    manifest_path = get_manifest_path(tiles_path)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, sort_keys=True, separators=(',', ':'))
+    os.rename(manifest_path + '.tmp', manifest_path)
+
+
+# Returns the manifest of a tiles set, or None if there is no valid manifest.
+def read_manifest(tiles_path):
+    try:
+        with open(get_manifest_path(tiles_path)) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if not isinstance(manifest, dict) or manifest.get('version') != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+# Returns the grid of the supplied tile size and scale in the manifest, or None.
+def get_manifest_level(manifest, tile_size, scale):
+    for level in manifest['levels']:
+        if level['tile_size'] == int(tile_size) and level['scale'] == int(scale):
+            return level
+    return None
+
+
+# Returns the colours of the uniform tiles that were not written, by tile size,
+# scale, row and column.
+def get_uniform_tiles(manifest):
+    tiles = {}
+    for level in manifest['levels']:
+        for row, col, colour in level.get('uniform', []):
+            tiles[(level['tile_size'], level['scale'], row, col)] = colour
+    return tiles
+
+
+# Write the manifest of a tiles set that was generated by another tiler (e.g.,
+# generate_tiles_for_image.sh), by scanning the tiles of every tile size and scale.
+# tiles_path - Directory that contains the tiles set
+# size - Width and height of the original image
+def scan_manifest(tiles_path, size):
+    levels = []
+    for tile_size in os.listdir(tiles_path):
+        if not tile_size.isdigit():
+            continue
+        for scale in os.listdir(os.path.join(tiles_path, tile_size)):
+            scale_path = os.path.join(tiles_path, tile_size, scale)
+            if not scale.isdigit() or not os.path.isdir(scale_path):
+                continue
+            level = None
+            for tile in os.listdir(scale_path):
+                grid = TILE_NAME_PATTERN.match(tile)
+                if grid is None:
+                    continue
+                if level is None:
+                    level = create_manifest_level(int(tile_size), int(scale), int(grid.group(1)),
+                                                  int(grid.group(2)))
+                level['tiles'] += 1
+                level['bytes'] += os.path.getsize(os.path.join(scale_path, tile))
+            if level is not None:
+                levels.append(level)
+    thumbnail = None
+    thumbnail_path = os.path.join(tiles_path, 'thumbnail.' + PREFERRED_FORMAT)
+    if os.path.isfile(thumbnail_path):
+        thumbnail_size = Image.open(thumbnail_path).size
+        thumbnail = {'width': thumbnail_size[0], 'height': thumbnail_size[1],
+                     'bytes': os.path.getsize(thumbnail_path)}
+    manifest = create_manifest(size, 'imagemagick', None, thumbnail, levels)
+    write_manifest(tiles_path, manifest)
+    return manifest
+
+
+# Crop the scaled image into tiles of the supplied size.
+def write_tiles(writer, img, tile_size, scale):
+    width, height = img.size
+    num_cols, num_rows = get_tile_grid(img.size, tile_size)
+    for row in range(num_rows):
+        y = row * tile_size
+        for col in range(num_cols):
+            x = col * tile_size
+            tile = img.crop((x, y, min(x + tile_size, width), min(y + tile_size, height)))
+            writer.write_tile(tile_size, scale, num_cols, num_rows, row, col, tile)
+
+
+# Generates the scaled images for the supplied scales in descending order of scale.
+# When cascading, every scale below 100% is resampled from the next larger scale,
+# which is considerably cheaper than resampling the original image every time.
+# The dimensions of every scale are always calculated from the original image,
+# whose size must be supplied if the image was reduced whilst decoding.
+#
+# Yields (scale, scaled image) tuples. Only the previous scale is kept in memory.
+def get_pyramid(img, scales, cascade=True, original_size=None):
+    previous = img
+    for scale in sorted(set(scales), reverse=True):
+        size = get_scaled_size(original_size or img.size, scale)
+        if size == img.size:
+            scaled = img
+        elif scale > 100 or not cascade:
+            scaled = img.resize(size, Image.LANCZOS)
+        else:
+            scaled = previous.resize(size, Image.LANCZOS)
+        if scale <= 100:
+            previous = scaled
+        yield scale, scaled
+
+
+# A scaled image that is generated in horizontal bands whilst tiling in bands.
+# Only the rows that are still required for generating tiles, or for generating
+# the next rows of the smaller scales resampled from this one, are kept.
+#
+# scale - Scale in percentage
+# size - Width and height of the scaled image
+# parent - The larger scale this scale is resampled from
+# tile_sizes - Tile sizes to generate tiles for; none if only used for resampling
+# keep_rows - Keep all of the rows (e.g., for the thumbnail)
+class PyramidLevel(object):
+    def __init__(self, scale, size, parent, tile_sizes, keep_rows=False):
+        self.scale = scale
+        self.size = size
+        self.parent = parent
+        self.tile_sizes = tile_sizes
+        self.keep_rows = keep_rows
+        self.children = []
+        self.rows = None
+        self.first_row = 0
+        self.next_tile_row = dict((tile_size, 0) for tile_size in tile_sizes)
+        if parent:
+            parent.children.append(self)
+            # Number of rows in the parent for every row in this scale, and the
+            # number of rows required above and below for the resampling filter.
+            self.ratio = parent.size[1] / float(size[1])
+            self.margin = int(math.ceil(LANCZOS_SUPPORT * max(self.ratio, 1.0))) + 2
+
+    def num_rows_produced(self):
+        return self.first_row + (self.rows.size[1] if self.rows else 0)
+
+    def append(self, band, writer):
+        if self.rows is None:
+            self.rows = band
+        else:
+            rows = Image.new(band.mode, (self.size[0], self.rows.size[1] + band.size[1]))
+            rows.paste(self.rows, (0, 0))
+            rows.paste(band, (0, self.rows.size[1]))
+            self.rows = rows
+        self.write_tiles(writer)
+        for child in self.children:
+            child.resample_from_parent(writer)
+        self.discard_rows()
+
+    # Write all of the rows of tiles that are covered by the rows produced so far.
+    def write_tiles(self, writer):
+        width, height = self.size
+        num_produced = self.num_rows_produced()
+        for tile_size in self.tile_sizes:
+            num_cols, num_rows = get_tile_grid(self.size, tile_size)
+            while self.next_tile_row[tile_size] < num_rows:
+                row = self.next_tile_row[tile_size]
+                y0 = row * tile_size
+                y1 = min(y0 + tile_size, height)
+                if num_produced < y1:
+                    break
+                for col in range(num_cols):
+                    x = col * tile_size
+                    tile = self.rows.crop((x, y0 - self.first_row, min(x + tile_size, width),
+                                           y1 - self.first_row))
+                    writer.write_tile(tile_size, self.scale, num_cols, num_rows, row, col, tile)
+                self.next_tile_row[tile_size] += 1
+
+    # Resample as many rows as possible from the rows produced by the parent. The
+    # resampling box is in the coordinates of the whole image, so that the rows are
+    # identical to those produced by resampling the whole image at once.
+    def resample_from_parent(self, writer):
+        parent = self.parent
+        width, height = self.size
+        while self.num_rows_produced() < height:
+            y0 = self.num_rows_produced()
+            y1 = min(height, y0 + BAND_ROWS)
+            required = min(parent.size[1], int(math.ceil(y1 * self.ratio)) + self.margin)
+            if parent.num_rows_produced() < required:
+                break
+            box = (0, y0 * self.ratio - parent.first_row, parent.size[0], y1 * self.ratio - parent.first_row)
+            self.append(parent.rows.resize((width, y1 - y0), Image.LANCZOS, box), writer)
+
+    def discard_rows(self):
+        if self.keep_rows or self.rows is None:
+            return
+        first_required = self.num_rows_produced()
+        for tile_size in self.tile_sizes:
+            first_required = min(first_required, self.next_tile_row[tile_size] * tile_size)
+        for child in self.children:
+            first_required = min(first_required,
+                                 max(0, int(math.floor(child.num_rows_produced() * child.ratio)) - child.margin))
+        if first_required > self.first_row:
+            self.rows = self.rows.crop((0, first_required - self.first_row, self.size[0], self.rows.size[1]))
+            self.first_row = first_required
+
+
+# Generate the thumbnail and tiles from an image in horizontal bands. Every scale
+# is resampled band by band from the next larger scale (or the original, if not
+# cascading), so that only a few bands of every scale are held in memory.
+def generate_tiles_in_bands(reader, size, writer, tile_sizes, scales, cascade=True):
+    scales = sorted(set(scales), reverse=True)
+    original = PyramidLevel(100, size, None, tile_sizes if 100 in scales else [])
+    previous = original
+    thumbnail_source = original
+    for scale in scales:
+        if scale == 100:
+            continue
+        scaled_size = get_scaled_size(size, scale)
+        parent = previous if cascade and scale < 100 else original
+        level = PyramidLevel(scale, scaled_size, parent, tile_sizes)
+        if scale < 100:
+            previous = level
+            if cascade and scaled_size[0] >= THUMBNAIL_WIDTH:
+                thumbnail_source = level
+    thumbnail = PyramidLevel(None, get_thumbnail_size(size), thumbnail_source, [], True)
+
+    for y in range(0, size[1], BAND_ROWS):
+        original.append(reader.read(y, min(y + BAND_ROWS, size[1])), writer)
+    writer.write_thumbnail(thumbnail.rows)
+
+
+# Open an image for tiling at the supplied scales. JPEG images are reduced whilst
+# decoding if the largest scale allows it, and images that require more memory
+# than the limit (in bytes) are read in bands.
+#
+# Returns the image, the width and height of the original image, and the
+# BandReader of the image (or None, if the image was loaded).
+def open_for_tiling(image_file, scales, memory_limit=None, reduce_jpeg=True):
+    if is_dicom(image_file):
+        img = open_dicom(image_file, memory_limit)
+        return img, img.size, None
+    img = open_original(image_file)
+    original_size = img.size
+    if reduce_jpeg and reduce_while_decoding(img, get_largest_scaled_size(original_size, scales)):
+        print 'Decoding "' + image_file + '" at ' + str(img.size[0]) + 'x' + str(img.size[1]) + '...'
+    if memory_limit and get_memory_required(img.size, img.mode) > memory_limit:
+        return img, original_size, BandReader(img)
+    img.load()
+    return to_jpeg_mode(img), original_size, None
+
+
+# Generate the thumbnail and tiles set from an image.
+#
+# image_file - The original image file
+# tiles_dir - Root directory for all of the tiles
+# checksum - SHA1 checksum of the original image file
+# tile_sizes - List of maximum sizes of tiles in pixels
+# scales - List of scales in percentage
+# cascade - Resample every scale from the next larger scale
+# memory_limit - If the image requires more memory (in bytes), it is tiled in bands
+# reduce_jpeg - Let the JPEG decoder reduce the image if the largest scale allows it
+# writer_class - Writes the tiles set, e.g., tile_container.ContainerTileWriter
+# lazy_scales - List of scales that are not tiled now, but on demand from the
+#               original image (see tile_cache.py)
+# uniform_tolerance - Record the tiles whose samples differ by at most this much
+#                     in the manifest, instead of writing them
+#
+# Any existing tiles for the image are deleted. Returns the width and height
+# of the original image.
+def generate_tiles(image_file, tiles_dir, checksum, tile_sizes, scales, cascade=True, memory_limit=None,
+                   reduce_jpeg=True, writer_class=TileWriter, lazy_scales=None, uniform_tolerance=None):
+    img, original_size, reader = open_for_tiling(image_file, scales, memory_limit, reduce_jpeg)
+    tiles_path = get_tiles_path(tiles_dir, checksum)
+    if os.path.isdir(tiles_path):
+        print 'Tiles directory "' + tiles_path + '" exists... will delete and redo tiling'
+        shutil.rmtree(tiles_path)
+    print 'Processing "' + image_file + '"...'
+    os.makedirs(tiles_path)
+
+    lazy = None
+    if lazy_scales:
+        lazy = {'original': os.path.abspath(image_file), 'tile_sizes': sorted(set(tile_sizes)),
+                'scales': sorted(set(lazy_scales))}
+    writer = writer_class(tiles_path, lazy, uniform_tolerance)
+    if reader:
+        print 'Tiling "' + image_file + '" in bands of ' + str(BAND_ROWS) + ' rows...'
+        try:
+            generate_tiles_in_bands(reader, img.size, writer, tile_sizes, scales, cascade)
+            writer.write_manifest(original_size)
+        finally:
+            reader.close()
+            writer.close()
+        return img.size
+
+    try:
+        # The thumbnail is resampled from the smallest scale that is still wider than it.
+        thumbnail_source = img
+        for scale, scaled in get_pyramid(img, scales, cascade, original_size):
+            for tile_size in tile_sizes:
+                write_tiles(writer, scaled, tile_size, scale)
+            if cascade and scale <= 100 and scaled.size[0] >= THUMBNAIL_WIDTH:
+                thumbnail_source = scaled
+        writer.write_thumbnail(thumbnail_source.resize(get_thumbnail_size(original_size), Image.LANCZOS))
+        writer.write_manifest(original_size)
+    finally:
+        writer.close()
+    return original_size
+
+
+def print_usage():
+    print 'Usage:'
+    print '    image_tiler.py [-m <memory limit>] <file> <destination> <sizes> <scales> [checksum]'
+    print ''
+    print ' E.g., image_tiler.py example.jpg tiles 256 10,25,50,75,100'
+    print ''
+    print '        file - Original image file to process.'
+    print ' destination - Destination directory to store image tiles set.'
+    print '       sizes - Comma separated list of tile sizes (in pixels).'
+    print '      scales - Comma separated list of scales (in percentage).'
+    print '    checksum - SHA1 checksum of the file, if already known.'
+    print ''
+    print ' -m - Tile images that require more memory (in megabytes) in bands.'
+
+
+def main(argv):
+    memory_limit = None
+    try:
+        opts, argv = getopt.getopt(argv, "m:")
+        for opt, arg in opts:
+            if opt == '-m':
+                memory_limit = int(arg) * 1048576
+    except (getopt.GetoptError, ValueError):
+        print_usage()
+        sys.exit(1)
+
+    if len(argv) not in (4, 5):
+        print_usage()
+        sys.exit(1)
+
+    image_file = argv[0]
+    if not os.path.isfile(image_file):
+        print 'Abort tiling... "' + image_file + '" does not exists...'
+        sys.exit(1)
+
+    if len(argv) == 5:
+        checksum = argv[4]
+    else:
+        checksum = media_checksum.get_sha1(image_file)
+
+    try:
+        generate_tiles(image_file, argv[1], checksum, parse_int_list(argv[2]), parse_int_list(argv[3]),
+                       memory_limit=memory_limit)
+    except (IOError, UnsupportedImage) as e:
+        print 'Failed to generate tiles:', str(e)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
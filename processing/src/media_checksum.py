@@ -0,0 +1,131 @@
+#
+# Copyright 2014 Medical Research Council Harwell.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# @author Gagarine Yaikhom <g.yaikhom@har.mrc.ac.uk>
+#
+
+# DESCRIPTION:
+#
+# Calculates the SHA1 checksums of media files using a pool of threads.
+# This is shared by phenodcc_media.py and fix_tile_metadata.py.
+
+import hashlib
+import time
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+
+# Files are read in large blocks. Since hashlib releases the global interpreter
+# lock whilst hashing large buffers, and file reads also release the lock,
+# several files are hashed in parallel by the threads in the pool.
+HASH_BLOCK_SIZE = 4194304  # 4 MiB
+DEFAULT_WORKERS = 4
+DEFAULT_BATCH_SIZE = 500
+
+# Number of files queued for every thread in the pool at any one time.
+FILES_PER_WORKER = 64
+
+UPDATE_CHECKSUMS = '''
+update phenodcc_media.media_file
+set checksum = case id {0} end
+where id in ({1})
+'''
+
+
+# Calculate the SHA1 checksum of a file. Returns the checksum and the number
+# of bytes read, where the checksum is None if the file could not be read.
+def get_sha1_and_size(file_path):
+    hash_generator = hashlib.sha1()
+    num_bytes = 0
+    try:
+        with open(file_path, 'rb') as f:
+            buf = f.read(HASH_BLOCK_SIZE)
+            while len(buf) > 0:
+                hash_generator.update(buf)
+                num_bytes += len(buf)
+                buf = f.read(HASH_BLOCK_SIZE)
+    except IOError:
+        return None, num_bytes
+    return hash_generator.hexdigest(), num_bytes
+
+
+# Calculate the SHA1 checksum of the file that was successfully downloaded.
+# Note that this checksum is used to link file to their thumbnails and tiles.
+def get_sha1(file_path):
+    return get_sha1_and_size(file_path)[0]
+
+
+def hash_file(media_file):
+    media_id, file_path = media_file
+    sha1, num_bytes = get_sha1_and_size(file_path)
+    return media_id, file_path, sha1, num_bytes
+
+
+class ChecksumStats(object):
+    def __init__(self):
+        self.start_time = time.time()
+        self.num_files = 0
+        self.num_failed = 0
+        self.num_bytes = 0
+
+    def add(self, sha1, num_bytes):
+        self.num_files += 1
+        self.num_bytes += num_bytes
+        if sha1 is None:
+            self.num_failed += 1
+
+    def summary(self):
+        elapsed_secs = time.time() - self.start_time
+        gigabytes = self.num_bytes / 1073741824.0
+        msg = 'Calculated checksums for ' + str(self.num_files - self.num_failed) + ' of ' + \
+              str(self.num_files) + ' files (' + '%.3f' % gigabytes + ' GB) in ' + \
+              '%.2f' % elapsed_secs + ' seconds'
+        if elapsed_secs > 0:
+            msg += ': ' + '%.3f' % (gigabytes / elapsed_secs) + ' GB/s'
+        return msg
+
+
+# Calculates the checksums of media files using a pool of threads.
+#
+# media_files - Iterable of (media_id, file_path) tuples
+# stats - Accumulates the number of files and bytes hashed
+# workers - Number of files to hash in parallel
+#
+# Yields (media_id, file_path, sha1) tuples in order of completion, where sha1
+# is None if the file could not be read. Only a limited number of files are
+# queued at any one time, so that the media files could be streamed.
+def calculate_checksums(media_files, stats, workers=DEFAULT_WORKERS):
+    media_files = iter(media_files)
+    pool = ThreadPool(workers)
+    try:
+        while True:
+            chunk = list(islice(media_files, workers * FILES_PER_WORKER))
+            if not chunk:
+                break
+            for media_id, file_path, sha1, num_bytes in pool.imap_unordered(hash_file, chunk):
+                stats.add(sha1, num_bytes)
+                yield media_id, file_path, sha1
+    finally:
+        pool.terminate()
+
+
+# Updates the checksums of a batch of media files using a single statement.
+# checksums - List of (media_id, sha1) tuples
+def update_checksums(cur, checksums):
+    if len(checksums) > 0:
+        cases = ' '.join(['when %s then %s'] * len(checksums))
+        ids = ', '.join(['%s'] * len(checksums))
+        cur.execute(UPDATE_CHECKSUMS.format(cases, ids),
+                    [x for y in checksums for x in y] + [media_id for media_id, sha1 in checksums])
@@ -20,19 +20,32 @@
 
 import ConfigParser
 import MySQLdb
+import ftplib
 import getopt
 import os
 import re
+import multiprocessing
+import resource
 import shutil
+import signal
 import urllib2
 from urlparse import urlparse
 import paramiko
 import hashlib
+import image_tiler
+import media_checksum
+import tile_container
+import tile_deepzoom
+import tile_index
+import tile_verify
 import sys
 from subprocess import call
 from PIL import Image
 import fcntl
+import socket
 import time
+import threading
+import Queue
 from datetime import datetime
 
 VERSION = '0.8.9'
@@ -40,17 +53,75 @@ VERSION = '0.8.9'
 # Settings
 MAX_DOWNLOAD_RETRIES = 1
 SLEEP_SECS_BEFORE_RETRY = 20  # 20 seconds
+DEFAULT_DOWNLOAD_WORKERS = 1
+DEFAULT_CONNECTIONS_PER_HOST = 2
+SFTP_PRIVATE_KEY_FILE = '/home/dcccrawler/.ssh/id_rsa'
+FTP_TIMEOUT_SECS = 60
+PREPARE_BATCH_SIZE = 500
+DEFAULT_PREPARE_WATERMARK_MARGIN = 100000
+STREAM_FETCH_SIZE = 1000
+STREAM_NET_WRITE_TIMEOUT_SECS = 86400  # 1 day
+DEFAULT_TILER = 'python'
+DEFAULT_TILE_STORAGE = 'directory'
+DEFAULT_TILE_PYRAMID = 'scales'
+DEFAULT_TILING_MEMORY_LIMIT_MB = 2048
+TILE_JOBS_PER_WORKER = 2
+DEFAULT_TILING_TIMEOUT_SECS = 3600  # 1 hour
+TILING_POLL_SECS = 1
+DEFAULT_LEASE_SECS = 600  # 10 minutes
+DEFAULT_HEARTBEAT_SECS = 60
+DEFAULT_CLAIM_BATCH_SIZE = 50
+MAX_CLAIM_ATTEMPTS = 5
+PARTIAL_DOWNLOAD_SUFFIX = '.part'
+
+# MySQL error codes for transactions that should be retried
+ER_LOCK_WAIT_TIMEOUT = 1205
+ER_LOCK_DEADLOCK = 1213
 
 # Global variables
 sleep_message = None
-HASH_BLOCK_SIZE = 65536
 opt_verbose = True
 opt_specified_centre = None
 download_centre_id = None
 opt_config_file = None
 opt_lock_dir = None
+opt_full_prepare = False
+opt_rescan = False
+opt_verify = False
 what_to_do = None
 connection = None
+worker_state = threading.local()
+output_lock = threading.Lock()
+download_stats_lock = threading.Lock()
+download_stats = None
+session_pool_lock = threading.Lock()
+idle_sessions = {}
+session_stats = {}
+sftp_private_key = None
+failed_logins = {}
+file_extension_ids = {}
+lease_owner = socket.gethostname() + ':' + str(os.getpid())
+lease_heartbeat = None
+tiling_pids = None
+PREPARE_WATERMARK_MARGIN = DEFAULT_PREPARE_WATERMARK_MARGIN
+DOWNLOAD_WORKERS = DEFAULT_DOWNLOAD_WORKERS
+CHECKSUM_WORKERS = media_checksum.DEFAULT_WORKERS
+CHECKSUM_BATCH_SIZE = media_checksum.DEFAULT_BATCH_SIZE
+CONNECTIONS_PER_HOST = DEFAULT_CONNECTIONS_PER_HOST
+HOST_CONNECTION_LIMITS = {}
+TILER = DEFAULT_TILER
+TILE_STORAGE = DEFAULT_TILE_STORAGE
+TILE_PYRAMID = DEFAULT_TILE_PYRAMID
+LAZY_SCALES = []
+UNIFORM_TOLERANCE = None
+TILE_WORKERS = 1
+TILING_MEMORY_LIMIT_MB = DEFAULT_TILING_MEMORY_LIMIT_MB
+TILING_TIMEOUT_SECS = DEFAULT_TILING_TIMEOUT_SECS
+TILE_SCAN_WORKERS = tile_index.DEFAULT_WORKERS
+TILE_VERIFY_WORKERS = tile_verify.DEFAULT_WORKERS
+LEASE_SECS = DEFAULT_LEASE_SECS
+HEARTBEAT_SECS = DEFAULT_HEARTBEAT_SECS
+CLAIM_BATCH_SIZE = DEFAULT_CLAIM_BATCH_SIZE
 MEDIA_HOSTNAME = MEDIA_USERNAME = MEDIA_PASSWORD = MEDIA_DATABASE = \
     ORIGINAL_MEDIA_FILES_DIR = IMAGE_TILES_DIR = TILE_SIZE = IMAGE_SCALES = None
 
@@ -69,6 +140,9 @@ where short_name = %s
 limit 1
 '''
 
+# Media files that have not been marked for download yet. Existing media files
+# are excluded by joining on the data context unique key of media_file, so that
+# the difference is computed by the database in one query.
 DB_GET_MEDIA_FILES = '''
 select mp.centre_id as cid,
     pi.pipeline_id as lid,
@@ -79,27 +153,54 @@ select mp.centre_id as cid,
     mp.measurement_id as mid,
     mp.value as url
 from
-    phenodcc_overviews.measurements_performed as mp,
-    phenodcc_overviews.procedure_animal_overview as pao,
-    impress.pipeline as pi,
-    impress.`procedure` as p,
-    impress.parameter as q
+    phenodcc_overviews.measurements_performed as mp
+    join phenodcc_overviews.procedure_animal_overview as pao
+        on (mp.procedure_occurrence_id = pao.procedure_occurrence_id)
+    join impress.pipeline as pi on (pi.pipeline_key = pao.pipeline)
+    join impress.`procedure` as p on (p.procedure_key = pao.procedure_id)
+    join impress.parameter as q on (q.parameter_key = mp.parameter_id)
+    left join phenodcc_media.media_file as f on (
+        f.cid = mp.centre_id
+        and f.lid = pi.pipeline_id
+        and f.gid = mp.genotype_id
+        and f.sid = mp.strain_id
+        and f.pid = p.procedure_id
+        and f.qid = q.parameter_id
+        and f.mid = mp.measurement_id
+    )
 where
     (mp.measurement_type = 'MEDIAPARAMETER' or mp.measurement_type = 'SERIESMEDIAPARAMETERVALUE')
-    and mp.procedure_occurrence_id = pao.procedure_occurrence_id
-    and pi.pipeline_key = pao.pipeline
-    and p.procedure_key = pao.procedure_id
-    and q.parameter_key = mp.parameter_id
     and length(substring_index(mp.value, '.', -1)) < 8
+    and mp.measurement_id > %s
+    and f.id is null
 order by cid, lid, gid, sid, pid, qid, mid
 '''
 
-DB_ADD_FILE_TO_DOWNLOAD = '''
+# The prepare phase only considers measurements that were recorded after the
+# last run. The highest measurement id considered so far is the watermark.
+# Measurement ids are not committed in order, and the rows the media files are
+# joined with could arrive after the measurement, so every run re-scans a margin
+# of ids below the watermark; the media files already marked are excluded by the
+# join on media_file. Anything older is found by a full prepare (see --full).
+DB_GET_PREPARE_WATERMARK = '''
+select measurement_id from phenodcc_media.prepare_watermark where id = 1
+'''
+
+DB_SET_PREPARE_WATERMARK = '''
+insert into phenodcc_media.prepare_watermark (id, measurement_id) values (1, %s)
+on duplicate key update measurement_id = greatest(measurement_id, values(measurement_id))
+'''
+
+# Media files are added in batches using multi-row inserts. The values
+# clause is repeated for every media file in the batch.
+DB_ADD_FILES_TO_DOWNLOAD = '''
 insert into phenodcc_media.media_file
 (cid, lid, gid, sid, pid, qid, mid, url, extension_id, is_image, phase_id, status_id, created)
-values (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, now())
+values
 '''
 
+DB_ADD_FILE_TO_DOWNLOAD_VALUES = '(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, now())'
+
 # Note that many resubmissions might be happening, which should all point to
 # the latest successful download. This is why we order them in descending order by
 # the id (because lower ids are the oldest entries) and limit result by one.
@@ -117,22 +218,9 @@ order by id desc
 limit 1
 '''
 
-DB_CHECK_IF_FILE_ALREADY_EXISTS = '''
-select id from phenodcc_media.media_file
-where
-    cid = %s
-    and lid = %s
-    and gid = %s
-    and sid = %s
-    and pid = %s
-    and qid = %s
-    and mid = %s
-'''
-
-DB_CHECK_IF_EXTENSION_EXISTS = '''
-select id
+DB_GET_FILE_EXTENSIONS = '''
+select id, extension
 from phenodcc_media.file_extension
-where extension = %s
 '''
 
 DB_ADD_FILE_EXTENSION = '''
@@ -145,77 +233,162 @@ from phenodcc_tracker.file_source
 where centre_id = %s
 '''
 
-DB_GET_FILES_TO_BE_DOWNLOADED = '''
+# Media files are claimed by a worker before they are processed, so that several
+# workers on different hosts could share the work. A worker claims a batch of
+# media files by setting itself as the lease owner in a single update, and renews
+# the lease until the media files are processed. If a worker is terminated, its
+# media files are left in the running state, and are claimed by another worker
+# once the lease has expired.
+DB_CLAIM_FILES_TO_DOWNLOAD = '''
+update phenodcc_media.media_file
+set status_id = %s, lease_owner = %s, lease_expiry = now() + interval %s second
+where
+    cid = %s
+    and phase_id = %s
+    and (
+        status_id = %s
+        or (status_id = %s and (lease_expiry is null or lease_expiry < now()))
+    )
+order by id
+limit %s
+'''
+
+DB_GET_CLAIMED_FILES_TO_DOWNLOAD = '''
 select f.id, f.cid, f.lid, f.gid, f.sid, f.pid, f.qid, f.url, e.extension
 from
     phenodcc_media.media_file f
-    left join phenodcc_media.phase p on (f.phase_id = p.id)
-    left join phenodcc_media.a_status s on (f.status_id = s.id)
     left join phenodcc_media.file_extension e on (f.extension_id = e.id)
 where
-    f.cid = %s
-    and p.short_name = "download"
-    and s.short_name = "pending"
+    f.lease_owner = %s
+    and f.phase_id = %s
+    and f.status_id = %s
 order by f.id
 '''
 
-DB_GET_IMAGE_FILES_TO_TILE = '''
-select f.id, f.cid, f.lid, f.gid, f.sid, f.pid, f.qid, e.extension, f.checksum
+# Images are tiled a checksum at a time, since media files with the same checksum
+# share the same tiles. Checksums that are being tiled by another worker are skipped.
+DB_GET_CHECKSUMS_TO_TILE = '''
+select f.checksum
 from
     phenodcc_media.media_file f
-    left join phenodcc_media.phase p on (f.phase_id = p.id)
-    left join phenodcc_media.a_status s on (f.status_id = s.id)
-    left join phenodcc_media.file_extension e on (f.extension_id = e.id)
+    left join phenodcc_media.checksum_lease l on (f.checksum = l.checksum)
 where
     f.is_image = 1
     and f.checksum is not null
-    and p.short_name = "checksum"
-    and s.short_name = "done"
-order by f.id
+    and (
+        (f.phase_id = %s and f.status_id = %s)
+        or (f.phase_id = %s and f.status_id = %s and (f.lease_expiry is null or f.lease_expiry < now()))
+    )
+    and (l.checksum is null or l.lease_expiry < now())
+group by f.checksum
+order by min(f.id)
+limit %s
+'''
+
+# Claims the checksum, unless another worker holds an unexpired claim. The lease
+# owner is assigned first, so that the expiry is only renewed if it was claimed.
+DB_CLAIM_CHECKSUM = '''
+insert into phenodcc_media.checksum_lease (checksum, lease_owner, lease_expiry)
+values (%s, %s, now() + interval %s second)
+on duplicate key update
+    lease_owner = if(lease_expiry < now(), values(lease_owner), lease_owner),
+    lease_expiry = if(lease_owner = values(lease_owner), values(lease_expiry), lease_expiry)
+'''
+
+DB_GET_CHECKSUM_LEASE_OWNER = '''
+select lease_owner from phenodcc_media.checksum_lease where checksum = %s
+'''
+
+DB_RELEASE_CHECKSUM = '''
+delete from phenodcc_media.checksum_lease where checksum = %s and lease_owner = %s
+'''
+
+DB_CLAIM_IMAGE_FILES_WITH_CHECKSUM = '''
+update phenodcc_media.media_file
+set phase_id = %s, status_id = %s, lease_owner = %s, lease_expiry = now() + interval %s second
+where
+    checksum = %s
+    and is_image = 1
+    and (
+        (phase_id = %s and status_id = %s)
+        or (phase_id = %s and status_id = %s and (lease_expiry is null or lease_expiry < now()))
+    )
 '''
 
-DB_GET_INTERRUPTED_DOWNLOADS = '''
+DB_GET_CLAIMED_IMAGE_FILES_WITH_CHECKSUM = '''
 select f.id, f.cid, f.lid, f.gid, f.sid, f.pid, f.qid, e.extension
 from
     phenodcc_media.media_file f
-    left join phenodcc_media.phase p on (f.phase_id = p.id)
-    left join phenodcc_media.a_status s on (f.status_id = s.id)
     left join phenodcc_media.file_extension e on (f.extension_id = e.id)
 where
-    f.cid = %s
-    and p.short_name = "download"
-    and s.short_name = "running"
+    f.lease_owner = %s
+    and f.checksum = %s
+    and f.phase_id = %s
+    and f.status_id = %s
+order by f.id
 '''
 
-DB_GET_INTERRUPTED_CHECKSUM = '''
-select f.id
-from
-    phenodcc_media.media_file f
-    left join phenodcc_media.phase p on (f.phase_id = p.id)
-    left join phenodcc_media.a_status s on (f.status_id = s.id)
+# Size of an image with the same checksum that was already tiled.
+DB_GET_TILED_IMAGE_SIZE = '''
+select width, height
+from phenodcc_media.media_file
 where
-    f.cid = %s and
-    (
-        p.short_name = "checksum"
-        and s.short_name = "running"
-    )
-    or (
-        p.short_name = "download"
-        and s.short_name = "done"
+    checksum = %s
+    and phase_id = %s
+    and status_id = %s
+    and width is not null
+    and height is not null
+limit 1
+'''
+
+DB_CLAIM_IMAGE_FILE_TO_REGENERATE = '''
+update phenodcc_media.media_file
+set status_id = %s, lease_owner = %s, lease_expiry = now() + interval %s second
+where id = %s and phase_id = %s and status_id = %s
+'''
+
+# A download is followed by the checksum calculation (checksum/pending). If the
+# downloader was terminated between the two, or during the calculation, the
+# checksum must be calculated again once the lease has expired.
+DB_CLAIM_INTERRUPTED_CHECKSUM = '''
+update phenodcc_media.media_file
+set phase_id = %s, status_id = %s, lease_owner = %s, lease_expiry = now() + interval %s second
+where
+    cid = %s
+    and (
+        (phase_id = %s and (status_id = %s or status_id = %s))
+        or (phase_id = %s and status_id = %s)
     )
+    and (lease_expiry is null or lease_expiry < now())
 '''
 
-DB_GET_INTERRUPTED_TILING = '''
-select f.id, f.checksum
+DB_GET_CLAIMED_CHECKSUM = '''
+select f.id, f.cid, f.lid, f.gid, f.sid, f.pid, f.qid, e.extension
 from
     phenodcc_media.media_file f
-    left join phenodcc_media.phase p on (f.phase_id = p.id)
-    left join phenodcc_media.a_status s on (f.status_id = s.id)
-where p.short_name = "tile" and s.short_name = "running"
+    left join phenodcc_media.file_extension e on (f.extension_id = e.id)
+where
+    f.lease_owner = %s
+    and f.cid = %s
+    and f.phase_id = %s
+    and f.status_id = %s
+order by f.id
+'''
+
+DB_RENEW_LEASES = '''
+update phenodcc_media.media_file
+set lease_expiry = now() + interval %s second
+where lease_owner = %s and status_id = %s
+'''
+
+DB_RENEW_CHECKSUM_LEASES = '''
+update phenodcc_media.checksum_lease
+set lease_expiry = now() + interval %s second
+where lease_owner = %s
 '''
 
 DB_GET_TILING_DONE = '''
-select f.id, f.cid, f.lid, f.gid, f.sid, f.pid, f.qid, e.extension, f.checksum
+select f.id, f.cid, f.lid, f.gid, f.sid, f.pid, f.qid, e.extension, f.checksum, f.width, f.height
 from
     phenodcc_media.media_file f
     left join phenodcc_media.phase p on (f.phase_id = p.id)
@@ -227,6 +400,10 @@ where
 order by f.id
 '''
 
+DB_SET_STREAM_TIMEOUT = '''
+set session net_write_timeout = %s
+'''
+
 DB_GET_PHASE_ID = '''
 select id from phenodcc_media.phase where short_name = %s limit 1
 '''
@@ -243,8 +420,12 @@ DB_UPDATE_CHECKSUM = '''
 update phenodcc_media.media_file set checksum = %s where id = %s
 '''
 
-DB_UPDATE_IMAGE_SIZE = '''
-update phenodcc_media.media_file set width = %s, height = %s where id = %s
+DB_UPDATE_PHASE_STATUS_OF_MEDIA_FILES = '''
+update phenodcc_media.media_file set phase_id = %s, status_id = %s where id in ({0})
+'''
+
+DB_UPDATE_IMAGE_SIZE_OF_MEDIA_FILES = '''
+update phenodcc_media.media_file set width = %s, height = %s where id in ({0})
 '''
 
 DOWNLOAD_PHASE = -1
@@ -258,19 +439,22 @@ FAILED_STATUS = -1
 
 def info(msg):
     if opt_verbose:
-        print msg
-        sys.stdout.flush()
+        with output_lock:
+            print msg
+            sys.stdout.flush()
 
 
 def info_nonewline(msg):
     if opt_verbose:
-        print msg,
-        sys.stdout.flush()
+        with output_lock:
+            print msg,
+            sys.stdout.flush()
 
 
 def error(msg):
-    print '[ERROR]: ' + msg
-    sys.stdout.flush()
+    with output_lock:
+        print '[ERROR]: ' + msg
+        sys.stdout.flush()
 
 
 def cleanup_and_exit(exit_status):
@@ -293,6 +477,119 @@ def connect_to_database():
     connection = MySQLdb.connect(MEDIA_HOSTNAME, MEDIA_USERNAME, MEDIA_PASSWORD, MEDIA_DATABASE)
 
 
+# Streams the results of a query using a server-side cursor on a separate
+# connection. Rows are returned as tuples and fetched in small batches, so that
+# the result set is never held in memory, and updates can be committed on the
+# main connection whilst the stream is still open.
+def stream_query(query, args=None):
+    stream = MySQLdb.connect(MEDIA_HOSTNAME, MEDIA_USERNAME, MEDIA_PASSWORD, MEDIA_DATABASE)
+    try:
+        cur = stream.cursor(MySQLdb.cursors.SSCursor)
+        # The server waits for us to consume the rows, which could take a while
+        # if every row takes a long time to process (e.g., tiling).
+        cur.execute(DB_SET_STREAM_TIMEOUT, (STREAM_NET_WRITE_TIMEOUT_SECS,))
+        cur.execute(query, args)
+        while True:
+            rows = cur.fetchmany(STREAM_FETCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        stream.close()
+
+
+# Report the peak resident memory of this process, and of any child processes.
+# On Linux, the maximum resident set size is reported in kilobytes.
+def log_peak_memory():
+    peak_self = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    peak_children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0
+    message = 'Peak memory: ' + '%.1f' % peak_self + ' MB'
+    if peak_children > 0:
+        message += ' (largest child process: ' + '%.1f' % peak_children + ' MB)'
+    info(message)
+
+
+# MySQLdb connections cannot be shared between threads. Download workers open
+# their own connection, which is returned here; otherwise, use the main one.
+def get_connection():
+    return getattr(worker_state, 'connection', None) or connection
+
+
+# Executes and commits a claim. Concurrent claims by several workers could deadlock;
+# if so, the claim is attempted again.
+def execute_claim(cur, claim_query, claim_args):
+    attempt = 1
+    while True:
+        try:
+            cur.execute(claim_query, claim_args)
+            connection.commit()
+            return
+        except MySQLdb.OperationalError as e:
+            connection.rollback()
+            if e.args[0] not in (ER_LOCK_DEADLOCK, ER_LOCK_WAIT_TIMEOUT) or attempt == MAX_CLAIM_ATTEMPTS:
+                raise
+            attempt += 1
+
+
+# Claims media files for this worker using the supplied update, and returns the
+# claimed media files that were not claimed previously by this worker.
+# claimed_ids - Primary keys of media files already claimed by this worker
+def claim_media_files(claim_query, claim_args, claimed_query, claimed_args, claimed_ids):
+    cur = connection.cursor()
+    execute_claim(cur, claim_query, claim_args)
+    cur.execute(claimed_query, claimed_args)
+    rows = [row for row in cur.fetchall() if row[0] not in claimed_ids]
+    claimed_ids.update([row[0] for row in rows])
+    return rows
+
+
+# Renews the leases on all of the running media files, and the checksums, claimed by this worker, until
+# stopped. This uses its own connection, since it runs in a separate thread.
+class LeaseHeartbeat(threading.Thread):
+    def __init__(self):
+        threading.Thread.__init__(self, name='lease-heartbeat')
+        self.daemon = True
+        self.stopped = threading.Event()
+
+    def run(self):
+        con = None
+        while not self.stopped.wait(HEARTBEAT_SECS):
+            try:
+                if con is None:
+                    con = MySQLdb.connect(MEDIA_HOSTNAME, MEDIA_USERNAME, MEDIA_PASSWORD, MEDIA_DATABASE)
+                cur = con.cursor()
+                cur.execute(DB_RENEW_LEASES, (LEASE_SECS, lease_owner, RUNNING_STATUS))
+                cur.execute(DB_RENEW_CHECKSUM_LEASES, (LEASE_SECS, lease_owner))
+                con.commit()
+            except MySQLdb.Error as e:
+                error('Failed to renew leases held by ' + lease_owner)
+                error(str(e))
+                if con is not None:
+                    con.close()
+                con = None
+        if con is not None:
+            con.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def start_lease_heartbeat():
+    global lease_heartbeat
+    info('Claiming media files as ' + lease_owner + '...')
+    lease_heartbeat = LeaseHeartbeat()
+    lease_heartbeat.start()
+
+
+def stop_lease_heartbeat():
+    global lease_heartbeat
+    if lease_heartbeat:
+        lease_heartbeat.stop()
+        lease_heartbeat = None
+
+
 def get_media_storage_path(centre_id, pipeline_id, genotype_id, strain_id, procedure_id, parameter_id):
     return ORIGINAL_MEDIA_FILES_DIR + str(centre_id) + '/' + str(pipeline_id) + '/' + \
            str(genotype_id) + '/' + str(strain_id) + '/' + str(procedure_id) + '/' + str(parameter_id) + '/'
@@ -307,14 +604,20 @@ def get_original_media_path(centre_id, pipeline_id, genotype_id, strain_id,
 def create_media_storage_path(centre_id, pipeline_id, genotype_id, strain_id, procedure_id, parameter_id):
     path = get_media_storage_path(centre_id, pipeline_id, genotype_id, strain_id, procedure_id, parameter_id)
     if not os.path.exists(path):
-        os.makedirs(path)
+        try:
+            os.makedirs(path)
+        except OSError:
+            # Another download worker might have created it in the meantime
+            if not os.path.isdir(path):
+                raise
     return path
 
 
 def log_error(media_id, phase_id, error_msg):
-    cur = connection.cursor()
+    con = get_connection()
+    cur = con.cursor()
     cur.execute(DB_LOG_ERROR, (media_id, phase_id, error_msg))
-    connection.commit()
+    con.commit()
 
 
 def set_phase_status_ids():
@@ -348,77 +651,109 @@ def get_file_type(url):
         extension = matches.group(1).lower()
         if re.match(r'^(bmp|dcm|jpeg|jpg|png|tif|tiff)$', extension):
             is_image = 1
-        cur = connection.cursor(MySQLdb.cursors.DictCursor)
-        cur.execute(DB_CHECK_IF_EXTENSION_EXISTS, (extension,))
-        if cur.rowcount:
-            extension_id = cur.fetchone()['id']
+        if not file_extension_ids:
+            cur = connection.cursor()
+            cur.execute(DB_GET_FILE_EXTENSIONS)
+            for existing_id, existing_extension in cur.fetchall():
+                file_extension_ids[existing_extension] = existing_id
+        if extension in file_extension_ids:
+            extension_id = file_extension_ids[extension]
         else:
+            cur = connection.cursor()
             cur.execute(DB_ADD_FILE_EXTENSION, (extension,))
             connection.commit()
             extension_id = connection.insert_id()
+            file_extension_ids[extension] = extension_id
     else:
         info('Invalid media file name in "' + url + '" ...')
     return extension_id, is_image
 
 
+def get_prepare_watermark():
+    cur = connection.cursor()
+    cur.execute(DB_GET_PREPARE_WATERMARK)
+    if cur.rowcount:
+        return cur.fetchone()[0]
+    return 0
+
+
+def set_prepare_watermark(measurement_id):
+    cur = connection.cursor()
+    cur.execute(DB_SET_PREPARE_WATERMARK, (measurement_id,))
+    connection.commit()
+
+
+# Inserts a batch of media files with one multi-row insert and commits them.
+def add_batch_to_download(cur, batch):
+    if len(batch) > 0:
+        cur.execute(DB_ADD_FILES_TO_DOWNLOAD + ',\n'.join([DB_ADD_FILE_TO_DOWNLOAD_VALUES] * len(batch)),
+                    [x for y in batch for x in y])
+        connection.commit()
+    return len(batch)
+
+
 # Adds a URL into the list of files to be downloaded and processed
 # Note that the actual downloading and processing of the files are
 # handled by a different process. This prevents the download and
 # processing of files from blocking the crawler.
 def add_files_to_download():
     ignore_mousephenotype_org = re.compile(r"^http[s]?://(?:www.)?mousephenotype.org/.*$")
-    tracker_cur = connection.cursor(MySQLdb.cursors.DictCursor)
-    tracker_cur.execute(DB_GET_MEDIA_FILES)
-    if tracker_cur.rowcount > 0:
-        info(str(tracker_cur.rowcount) + ' media files found...')
-        to_download = 0
-        already_downloaded = 0
-        media_cur = connection.cursor(MySQLdb.cursors.DictCursor)
-        already_cur = connection.cursor(MySQLdb.cursors.DictCursor)
-        for i in range(tracker_cur.rowcount):
-            record = tracker_cur.fetchone()
-            centre_id = record['cid']
-            pipeline_id = record['lid']
-            genotype_id = record['gid']
-            strain_id = record['sid']
-            procedure_id = record['pid']
-            parameter_id = record['qid']
-            measurement_id = record['mid']
-            url_to_download = record['url']
-
-            if ignore_mousephenotype_org.match(url_to_download):
-                info('Ignoring URL: ' + url_to_download + '; file hosted at mousephenotype.org')
-                continue
-
-            # We ignore files that have already been processed, or is
-            # mark for processing. We do this to avoid race condition.
-            # This script is run by the crawler, and the download and
-            # processing is run by a different process. Since download
-            # and processing only works on files that are already marked,
-            # restricting this script to additions prevents a race.
-            already_cur.execute(DB_CHECK_IF_FILE_ALREADY_EXISTS, (
-                centre_id, pipeline_id, genotype_id, strain_id,
-                procedure_id, parameter_id, measurement_id
-            ))
-            temp = '    Url "' + url_to_download
-            if already_cur.rowcount == 0:
-                extension_id, is_image = get_file_type(url_to_download)
-                if extension_id is None:
-                    info(temp + '" has invalid filename extension...')
-                else:
-                    media_cur.execute(DB_ADD_FILE_TO_DOWNLOAD, (
-                        centre_id, pipeline_id, genotype_id, strain_id,
-                        procedure_id, parameter_id, measurement_id,
-                        url_to_download, extension_id, is_image,
-                        DOWNLOAD_PHASE, PENDING_STATUS
-                    ))
-                    connection.commit()
-                    to_download += 1
-                    info(temp + '" has been added for download and processing...')
-            else:
-                already_downloaded += 1
-        info(str(already_downloaded) + ' media files already downloaded...')
+    watermark = 0
+    lowest_measurement_id = 0
+    if opt_full_prepare:
+        info('Considering all of the measurements...')
+    else:
+        watermark = get_prepare_watermark()
+        lowest_measurement_id = max(0, watermark - PREPARE_WATERMARK_MARGIN)
+        info('Considering measurements with id greater than ' + str(lowest_measurement_id) +
+             ' (watermark ' + str(watermark) + ')...')
+    num_media_files = 0
+    to_download = 0
+    highest_measurement_id = watermark
+    batch = []
+    last_data_context = None
+    media_cur = connection.cursor()
+    for (centre_id, pipeline_id, genotype_id, strain_id, procedure_id, parameter_id,
+         measurement_id, url_to_download) in stream_query(DB_GET_MEDIA_FILES, (lowest_measurement_id,)):
+        num_media_files += 1
+        highest_measurement_id = max(highest_measurement_id, measurement_id)
+
+        if ignore_mousephenotype_org.match(url_to_download):
+            info('Ignoring URL: ' + url_to_download + '; file hosted at mousephenotype.org')
+            continue
+
+        # We only add files that have not already been processed, or marked
+        # for processing. We do this to avoid race condition. This script is
+        # run by the crawler, and the download and processing is run by a
+        # different process. Since download and processing only works on files
+        # that are already marked, restricting this script to additions
+        # prevents a race. Since the results are ordered by data context,
+        # any duplicate in the tracker is adjacent to the first occurrence.
+        data_context = (centre_id, pipeline_id, genotype_id, strain_id,
+                        procedure_id, parameter_id, measurement_id)
+        if data_context == last_data_context:
+            continue
+        last_data_context = data_context
+
+        temp = '    Url "' + url_to_download
+        extension_id, is_image = get_file_type(url_to_download)
+        if extension_id is None:
+            info(temp + '" has invalid filename extension...')
+        else:
+            batch.append(data_context + (url_to_download, extension_id, is_image,
+                                         DOWNLOAD_PHASE, PENDING_STATUS))
+            info(temp + '" has been added for download and processing...')
+            if len(batch) == PREPARE_BATCH_SIZE:
+                to_download += add_batch_to_download(media_cur, batch)
+                batch = []
+    if num_media_files > 0:
+        to_download += add_batch_to_download(media_cur, batch)
+        info(str(num_media_files) + ' new media files found...')
         info(str(to_download) + ' new media files added to download queue...')
+
+        # Only move the watermark once all of the new media files have been
+        # committed, so that an interrupted run is repeated in the next run.
+        set_prepare_watermark(highest_measurement_id)
     else:
         info('No new media files added. None recorded for download...')
 
@@ -434,16 +769,47 @@ def get_credential(centre_id):
     return credential
 
 
+# Saves the downloaded bytes to a file whilst calculating their SHA1 checksum,
+# so that the file does not have to be read back to calculate the checksum.
+class HashingFile(object):
+    def __init__(self, save_as):
+        self.save_as = save_as
+        self.file = open(save_as + PARTIAL_DOWNLOAD_SUFFIX, 'wb')
+        self.hash_generator = hashlib.sha1()
+
+    def write(self, data):
+        self.hash_generator.update(data)
+        self.file.write(data)
+
+    def hexdigest(self):
+        return self.hash_generator.hexdigest()
+
+    def __enter__(self):
+        return self
+
+    # The file is only moved into place once it has been written completely, so that
+    # a media file that exists is never incomplete, even if the worker is terminated.
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.file.close()
+        if exc_type is None:
+            os.rename(self.file.name, self.save_as)
+        elif os.path.exists(self.file.name):
+            os.remove(self.file.name)
+
+
+# Returns the SHA1 checksum of the downloaded file.
 def download_file(url, save_as, max_attempts):
     num_retries = 1
+    sha1 = None
     while num_retries <= max_attempts:
         info_nonewline('Attempt ' + str(num_retries))
         r = None
         success = False
         try:
             r = urllib2.urlopen(url)
-            with open(save_as, 'wb') as f:
+            with HashingFile(save_as) as f:
                 shutil.copyfileobj(r, f)
+            sha1 = f.hexdigest()
             success = True
             info('[ SUCCESS ]')
         except (urllib2.URLError, IOError) as e:
@@ -460,49 +826,129 @@ def download_file(url, save_as, max_attempts):
             if r:
                 r.close()
         if success:
-            return
-
-
-def get_ftp_file(url, save_as, cred):
-    try:
-        loc = "ftp://"
-        # temporary hack to proceed with anonymous download if processing Jax
-        if opt_specified_centre != 'J' \
-                and cred["username"] is not None \
-                and cred["accesskey"] is not None:
-            loc = loc + cred["username"] + ":" + cred["accesskey"] + "@"
-        loc = loc + url.netloc + url.path
-        download_file(loc, save_as, MAX_DOWNLOAD_RETRIES)
-    except (urllib2.URLError, IOError) as e:
-        if opt_specified_centre == 'Tcp': # To prevent incorrect login ban
-            raise e
-            return
-        error('Download with username/password failed')
-        error(str(e))
-        info('Will attempt anonymous download')
+            return sha1
+
+
+# Authenticated sessions with the file servers are kept open for the duration
+# of the download phase, so that subsequent files from the same server do not
+# have to repeat the connection handshake and authentication. A session is
+# only used by one download worker at a time.
+def get_session_key(url, username, accesskey):
+    return url.scheme, url.netloc.split(':')[0], url.port, username, accesskey
+
+
+def count_session(scheme, what):
+    with session_pool_lock:
+        if scheme not in session_stats:
+            session_stats[scheme] = {'handshakes': 0, 'reused': 0}
+        session_stats[scheme][what] += 1
+
+
+# Returns an idle session for the supplied key, or None if there are none.
+# Sessions that are no longer alive are discarded.
+def acquire_session(key):
+    while True:
+        with session_pool_lock:
+            sessions = idle_sessions.get(key)
+            session = sessions.pop() if sessions else None
+        if session is None or session.is_alive():
+            return session
+        session.close()
+
+
+def release_session(key, session):
+    if session.is_alive():
+        with session_pool_lock:
+            if key not in idle_sessions:
+                idle_sessions[key] = []
+            idle_sessions[key].append(session)
+    else:
+        session.close()
+
+
+def close_sessions():
+    with session_pool_lock:
+        sessions = [x for y in idle_sessions.values() for x in y]
+        idle_sessions.clear()
+    for session in sessions:
+        session.close()
+    for scheme in sorted(session_stats):
+        stats = session_stats[scheme]
+        info(scheme.upper() + ' sessions: ' + str(stats['handshakes']) + ' handshakes, ' +
+             str(stats['reused']) + ' handshakes saved by reusing sessions...')
+    session_stats.clear()
+    failed_logins.clear()
+
+
+def get_sftp_private_key():
+    global sftp_private_key
+    with session_pool_lock:
+        if sftp_private_key is None:
+            sftp_private_key = paramiko.RSAKey.from_private_key_file(SFTP_PRIVATE_KEY_FILE)
+        return sftp_private_key
+
+
+class SftpSession(object):
+    def __init__(self, url, cred):
+        self.sftp = None
+        self.transport = paramiko.Transport((url.netloc.split(':')[0], url.port or 22))
         try:
-            loc = "ftp://" + url.netloc + url.path
-            download_file(loc, save_as, 1)
-        except (urllib2.URLError, IOError):
-            raise e  # We wish to record the first exception (as that is the expected one)
+            self.transport.connect(username=cred["username"], password=cred["accesskey"],
+                                   pkey=get_sftp_private_key())
+            self.sftp = paramiko.SFTPClient.from_transport(self.transport)
+        except:
+            self.transport.close()
+            raise
+        count_session('sftp', 'handshakes')
+
+    def is_alive(self):
+        return self.transport.is_active()
+
+    # Returns the SHA1 checksum of the retrieved file.
+    def retrieve(self, path, save_as):
+        with HashingFile(save_as) as f:
+            self.sftp.getfo(path, f)
+        return f.hexdigest()
+
+    def close(self):
+        try:
+            if self.sftp:
+                self.sftp.close()
+        except (IOError, EOFError, paramiko.SSHException):
+            pass
+        if self.transport.isAlive():
+            self.transport.close()
 
 
 def get_sftp_file(url, save_as, cred):
+    key = get_session_key(url, cred["username"], cred["accesskey"])
     num_retries = 1
     while num_retries <= MAX_DOWNLOAD_RETRIES:
         info_nonewline('Attempt ' + str(num_retries))
-        success = False
-        sftp = None
-        transport = None
+        session = None
         try:
-            pkey = paramiko.RSAKey.from_private_key_file('/home/dcccrawler/.ssh/id_rsa')
-            transport = paramiko.Transport((url.netloc.split(':')[0], 22))
-            transport.connect(username=cred["username"], password=cred["accesskey"], pkey=pkey)
-            sftp = paramiko.SFTPClient.from_transport(transport)
-            sftp.get(url.path, save_as)
-            success = True
+            session = acquire_session(key)
+            if session is None:
+                session = SftpSession(url, cred)
+            else:
+                count_session('sftp', 'reused')
+                try:
+                    sha1 = session.retrieve(url.path, save_as)
+                    release_session(key, session)
+                    info('[ SUCCESS ]')
+                    return sha1
+                except (EOFError, socket.error, paramiko.SSHException):
+                    # The server might have dropped the session whilst it was idle.
+                    # Reconnect and try again, without counting this as an attempt.
+                    session.close()
+                    session = SftpSession(url, cred)
+            sha1 = session.retrieve(url.path, save_as)
+            release_session(key, session)
             info('[ SUCCESS ]')
-        except (IOError, paramiko.PasswordRequiredException, paramiko.SSHException) as e:
+            return sha1
+        except (IOError, EOFError, paramiko.PasswordRequiredException, paramiko.SSHException) as e:
+            if session:
+                release_session(key, session)
             info('[ FAIL ]')
             error(str(e))
             num_retries += 1
@@ -512,25 +958,134 @@ def get_sftp_file(url, save_as, cred):
             else:
                 info(sleep_message)
                 time.sleep(SLEEP_SECS_BEFORE_RETRY)
-        finally:
-            if sftp:
-                sftp.close()
-            if transport and transport.isAlive():
-                transport.close()
-        if success:
-            return
 
 
+class FtpSession(object):
+    def __init__(self, url, username, password):
+        self.ftp = ftplib.FTP()
+        try:
+            self.ftp.connect(url.netloc.split(':')[0], url.port or ftplib.FTP_PORT, FTP_TIMEOUT_SECS)
+            if username is None:
+                self.ftp.login()
+            else:
+                self.ftp.login(username, password)
+            self.ftp.set_pasv(True)
+            self.ftp.voidcmd('TYPE I')
+        except ftplib.all_errors:
+            self.ftp.close()
+            raise
+        count_session('ftp', 'handshakes')
+
+    def is_alive(self):
+        return self.ftp.sock is not None
+
+    def close(self):
+        try:
+            self.ftp.quit()
+        except ftplib.all_errors:
+            self.ftp.close()
+
+    # Paths are relative to the login directory, as with urllib2. Since we never
+    # change the working directory, this remains the same for reused sessions.
+    # Returns the SHA1 checksum of the retrieved file.
+    def retrieve(self, path, save_as):
+        with HashingFile(save_as) as f:
+            self.ftp.retrbinary('RETR ' + urllib2.unquote(path).lstrip('/'), f.write)
+        return f.hexdigest()
+
+
+def open_ftp_session(key, url, username, password):
+    if key in failed_logins:
+        raise failed_logins[key]
+    try:
+        return FtpSession(url, username, password)
+    except ftplib.error_perm as e:
+        # Do not attempt to login again with the same credentials in this run,
+        # since repeated login failures could get us banned by the server.
+        failed_logins[key] = e
+        raise
+
+
+def get_ftp_file_using(url, save_as, username, password, max_attempts):
+    key = get_session_key(url, username, password)
+    num_retries = 1
+    while num_retries <= max_attempts:
+        info_nonewline('Attempt ' + str(num_retries))
+        session = None
+        try:
+            session = acquire_session(key)
+            if session is None:
+                session = open_ftp_session(key, url, username, password)
+            else:
+                count_session('ftp', 'reused')
+                try:
+                    sha1 = session.retrieve(url.path, save_as)
+                    release_session(key, session)
+                    info('[ SUCCESS ]')
+                    return sha1
+                except (EOFError, socket.error, ftplib.error_temp):
+                    # The server might have closed the control connection whilst
+                    # it was idle. Reconnect without counting this as an attempt.
+                    session.close()
+                    session = None
+                    session = open_ftp_session(key, url, username, password)
+            sha1 = session.retrieve(url.path, save_as)
+            release_session(key, session)
+            info('[ SUCCESS ]')
+            return sha1
+        except ftplib.all_errors as e:
+            # Only a permanent error reply (e.g., 550 on RETR) leaves the control
+            # connection in a known state. After any other error, a reply (e.g.,
+            # 226 or 426 for an aborted transfer) might still be pending, which
+            # the next command on a reused session would read as its own.
+            if session:
+                if isinstance(e, ftplib.error_perm):
+                    release_session(key, session)
+                else:
+                    session.close()
+            info('[ FAIL ]')
+            error(str(e))
+            num_retries += 1
+            if num_retries > max_attempts or key in failed_logins:
+                info('Giving up the download, maximum retries reached')
+                raise e
+            else:
+                info(sleep_message)
+                time.sleep(SLEEP_SECS_BEFORE_RETRY)
+
+
+def get_ftp_file(url, save_as, cred):
+    username = password = None
+    # temporary hack to proceed with anonymous download if processing Jax
+    if opt_specified_centre != 'J' \
+            and cred["username"] is not None \
+            and cred["accesskey"] is not None:
+        username = cred["username"]
+        password = cred["accesskey"]
+    try:
+        return get_ftp_file_using(url, save_as, username, password, MAX_DOWNLOAD_RETRIES)
+    except ftplib.all_errors as e:
+        error('Download with username/password failed')
+        error(str(e))
+        info('Will attempt anonymous download')
+        try:
+            return get_ftp_file_using(url, save_as, None, None, 1)
+        except ftplib.all_errors:
+            raise e  # We wish to record the first exception (as that is the expected one)
+
+
+# Returns the SHA1 checksum of the downloaded file, which is calculated as the
+# bytes are received.
 def get_file(url_to_download, save_as, cred):
     # make the supplied url safe for download
     url = urlparse(urllib2.quote(url_to_download, safe="%/:=&?~#+!$,;'@()*[]"))
     info('Downloading "' + url_to_download + '" and saving as file "' + save_as + '"')
     if url.scheme == "http" or url.scheme == "https":
-        download_file(url.geturl(), save_as, MAX_DOWNLOAD_RETRIES)
+        return download_file(url.geturl(), save_as, MAX_DOWNLOAD_RETRIES)
     elif url.scheme == "ftp":
-        get_ftp_file(url, save_as, cred)
+        return get_ftp_file(url, save_as, cred)
     elif url.scheme == "sftp":
-        get_sftp_file(url, save_as, cred)
+        return get_sftp_file(url, save_as, cred)
     else:
         raise urllib2.URLError("Unsupported internet transport protocol: " + url.scheme)
 
@@ -538,31 +1093,27 @@ def get_file(url_to_download, save_as, cred):
 # Calculate the SHA1 checksum of the file that was successfully downloaded.
 # Note that this checksum is used to link file to their thumbnails and tiles.
 def get_sha1(file_path):
-    has_generator = hashlib.sha1()
-    try:
-        with open(file_path, 'rb') as f:
-            buf = f.read(HASH_BLOCK_SIZE)
-            while len(buf) > 0:
-                has_generator.update(buf)
-                buf = f.read(HASH_BLOCK_SIZE)
-    except IOError as e:
-        error(str(e))
-        return None
-    return has_generator.hexdigest()
+    sha1 = media_checksum.get_sha1(file_path)
+    if sha1 is None:
+        error('Failed to read file "' + file_path + '" for calculating checksum')
+    return sha1
 
 
-# Set the checksum of the media file record by calculating the SHA1 checksum of the downloaded file.
-def set_checksum(media_id, file_saved_as):
-    modify = connection.cursor()
-    modify.execute(DB_UPDATE_PHASE_STATUS, (CHECKSUM_PHASE, RUNNING_STATUS, media_id))
-    connection.commit()
-    sha1 = get_sha1(file_saved_as)
+# Set the checksum of the media file record. If the checksum was not calculated
+# during the download, calculate the SHA1 checksum of the downloaded file.
+def set_checksum(media_id, file_saved_as, sha1=None):
+    con = get_connection()
+    modify = con.cursor()
+    if sha1 is None:
+        modify.execute(DB_UPDATE_PHASE_STATUS, (CHECKSUM_PHASE, RUNNING_STATUS, media_id))
+        con.commit()
+        sha1 = get_sha1(file_saved_as)
     if sha1 is None:
         modify.execute(DB_UPDATE_PHASE_STATUS, (CHECKSUM_PHASE, FAILED_STATUS, media_id))
     else:
         modify.execute(DB_UPDATE_CHECKSUM, (sha1, media_id))
         modify.execute(DB_UPDATE_PHASE_STATUS, (CHECKSUM_PHASE, DONE_STATUS, media_id))
-    connection.commit()
+    con.commit()
     return sha1
 
 
@@ -571,9 +1122,13 @@ def set_checksum(media_id, file_saved_as):
 # the same URL is marked as a new media file. Since downloading files is
 # really expensive in terms of bandwidth and storage space, we try to optimise this
 # by instead creating a symbolic link to the existing file.
+#
+# Returns the SHA1 checksum of the downloaded file, or None if a symbolic link
+# was created instead (the checksum must then be calculated from the file).
 def check_and_download(url_to_download, file_save_as, credentials):
+    sha1 = None
     download_file_as_new = False
-    cur = connection.cursor(MySQLdb.cursors.DictCursor)
+    cur = get_connection().cursor(MySQLdb.cursors.DictCursor)
     cur.execute(DB_CHECK_IF_URL_ALREADY_DOWNLOADED, (url_to_download,))
     if cur.rowcount == 0:
         download_file_as_new = True
@@ -610,7 +1165,8 @@ def check_and_download(url_to_download, file_save_as, credentials):
                   + '" to "' + existing_file + '"')
             download_file_as_new = True
     if download_file_as_new:
-        get_file(url_to_download, file_save_as, credentials)
+        sha1 = get_file(url_to_download, file_save_as, credentials)
+    return sha1
 
 
 # Download file that has not been downloaded and update download status.
@@ -619,68 +1175,203 @@ def check_and_download(url_to_download, file_save_as, credentials):
 # credentials - Credentials for accessing the file server
 # url_to_download - URL to download
 # file_save_as - Where to save the file once downloaded
+#
+# Returns whether the download was successful, and the SHA1 checksum of the file
+# if this was calculated during the download.
 def retrieve_file(media_id, credentials, url_to_download, file_save_as):
     download_successful = False
+    sha1 = None
     if os.path.exists(file_save_as):
         info('File "' + file_save_as + '" already exists... will skip')
         download_successful = True
     else:
-        cur = connection.cursor()
+        con = get_connection()
+        cur = con.cursor()
         try:
             cur.execute(DB_UPDATE_PHASE_STATUS, (DOWNLOAD_PHASE, RUNNING_STATUS, media_id))
-            connection.commit()
-            check_and_download(url_to_download, file_save_as, credentials)
+            con.commit()
+            sha1 = check_and_download(url_to_download, file_save_as, credentials)
             cur.execute(DB_UPDATE_PHASE_STATUS, (CHECKSUM_PHASE, PENDING_STATUS, media_id))
-            connection.commit()
+            con.commit()
             download_successful = True
-        except (MySQLdb.Error, OSError, IOError, urllib2.URLError,
+        except (MySQLdb.Error, OSError, IOError, EOFError, urllib2.URLError, ftplib.Error,
                 paramiko.PasswordRequiredException, paramiko.SSHException) as e:
             cur.execute(DB_UPDATE_PHASE_STATUS, (DOWNLOAD_PHASE, FAILED_STATUS, media_id))
-            connection.commit()
+            con.commit()
             log_error(media_id, DOWNLOAD_PHASE, str(e))
-    return download_successful
+    return download_successful, sha1
 
 
-def download_media():
+# Claims a batch of media files that are pending download for the centre, so that
+# they can either be processed in order or shared amongst the download workers.
+# claimed_ids - Primary keys of media files already claimed by this worker
+def claim_download_jobs(claimed_ids):
+    jobs = []
     centre = -1
     credentials = None
-    cur = connection.cursor(MySQLdb.cursors.DictCursor)
-    cur.execute(DB_GET_FILES_TO_BE_DOWNLOADED, (download_centre_id,))
-    if cur.rowcount > 0:
-        info('Downloading ' + str(cur.rowcount) + ' media files...')
-        for i in range(cur.rowcount):
-            record = cur.fetchone()
-            media_id = record['id']
-            centre_id = record['cid']
-            pipeline_id = record['lid']
-            genotype_id = record['gid']
-            strain_id = record['sid']
-            procedure_id = record['pid']
-            parameter_id = record['qid']
-            url_to_download = record['url']
-            file_extension = record['extension']
+    for (media_id, centre_id, pipeline_id, genotype_id, strain_id, procedure_id,
+         parameter_id, url_to_download, file_extension) in claim_media_files(
+            DB_CLAIM_FILES_TO_DOWNLOAD,
+            (RUNNING_STATUS, lease_owner, LEASE_SECS, download_centre_id, DOWNLOAD_PHASE,
+             PENDING_STATUS, RUNNING_STATUS, CLAIM_BATCH_SIZE),
+            DB_GET_CLAIMED_FILES_TO_DOWNLOAD, (lease_owner, DOWNLOAD_PHASE, RUNNING_STATUS),
+            claimed_ids):
+        # All of the claimed media files belong to the same centre.
+        if centre != centre_id:
+            centre = centre_id
+            credentials = get_credential(centre)
+
+        # Get path for systematically storing the original media file that will be downloaded.
+        create_media_storage_path(centre_id, pipeline_id, genotype_id,
+                                  strain_id, procedure_id, parameter_id)
+        file_save_as = get_original_media_path(centre_id, pipeline_id,
+                                               genotype_id, strain_id,
+                                               procedure_id, parameter_id,
+                                               media_id, file_extension)
+        jobs.append((media_id, credentials, url_to_download, file_save_as))
+    return jobs
+
+
+def record_download(num_bytes):
+    with download_stats_lock:
+        download_stats['files'] += 1
+        download_stats['bytes'] += num_bytes
+
+
+# Download a media file and calculate its checksum. This could be run
+# concurrently by several download workers, each with its own connection.
+def download_one(media_id, credentials, url_to_download, file_save_as):
+    info('---------------------------------')
+    info('Processing media id: ' + str(media_id))
+    info('---------------------------------')
+    already_exists = os.path.lexists(file_save_as)
+    download_successful, sha1 = retrieve_file(media_id, credentials,
+                                              url_to_download, file_save_as)
+    if download_successful:
+        set_checksum(media_id, file_save_as, sha1)
+        if not (already_exists or os.path.islink(file_save_as)):
+            record_download(os.path.getsize(file_save_as))
+
+
+def get_download_host(url_to_download):
+    host = urlparse(url_to_download).hostname
+    return host if host else ''
+
+
+def get_host_connection_limit(host):
+    return HOST_CONNECTION_LIMITS.get(host, CONNECTIONS_PER_HOST)
+
+
+# Marks a media file as failed when its download raised an unexpected error, so
+# that it is not left running, with its lease renewed, until the process exits.
+def fail_download(media_id, e):
+    con = get_connection()
+    try:
+        con.rollback()
+        cur = con.cursor()
+        cur.execute(DB_UPDATE_PHASE_STATUS, (DOWNLOAD_PHASE, FAILED_STATUS, media_id))
+        con.commit()
+        log_error(media_id, DOWNLOAD_PHASE, str(e))
+    except MySQLdb.Error as e:
+        error('Failed to update status of media id ' + str(media_id))
+        error(str(e))
 
-            info('---------------------------------')
-            info('Processing media id: ' + str(media_id))
-            info('---------------------------------')
 
-            # this assumes that all of the media files for a centre are processed in groups.
-            # See the ordering in GET_FILES_TO_BE_DOWNLOADED.
-            if centre != centre_id:
-                centre = centre_id
-                credentials = get_credential(centre)
-
-            # Get path for systematically storing the original media file that will be downloaded.
-            create_media_storage_path(centre_id, pipeline_id, genotype_id,
-                                      strain_id, procedure_id, parameter_id)
-            file_save_as = get_original_media_path(centre_id, pipeline_id,
-                                                   genotype_id, strain_id,
-                                                   procedure_id, parameter_id,
-                                                   media_id, file_extension)
-            download_successful = retrieve_file(media_id, credentials,
-                                                url_to_download, file_save_as)
-            if download_successful:
-                set_checksum(media_id, file_save_as)
+# A download worker takes media files from the queue for a specific host until
+# there are none left. The number of simultaneous downloads across all of the
+# hosts is limited by the active downloads semaphore. Any error is confined to
+# the media file being downloaded, so that the rest of the queue is processed.
+def download_worker(jobs, active_downloads):
+    try:
+        worker_state.connection = MySQLdb.connect(MEDIA_HOSTNAME, MEDIA_USERNAME,
+                                                  MEDIA_PASSWORD, MEDIA_DATABASE)
+    except MySQLdb.Error as e:
+        error('Download worker failed to connect to the database')
+        error(str(e))
+        return
+    try:
+        while True:
+            try:
+                job = jobs.get_nowait()
+            except Queue.Empty:
+                break
+            with active_downloads:
+                try:
+                    download_one(*job)
+                except Exception as e:
+                    error('Failed to download media id ' + str(job[0]))
+                    error(str(e))
+                    fail_download(job[0], e)
+    finally:
+        worker_state.connection.close()
+
+
+# Shares the media files amongst download workers that are grouped by host.
+# worker - Function that downloads the media files in a host queue, which is
+#          replaced by benchmark_download.py to download without a database
+def download_concurrently(jobs, worker=download_worker):
+    host_queues = {}
+    for job in jobs:
+        host = get_download_host(job[2])
+        if host not in host_queues:
+            host_queues[host] = Queue.Queue()
+        host_queues[host].put(job)
+
+    active_downloads = threading.BoundedSemaphore(DOWNLOAD_WORKERS)
+    workers = []
+    for host, host_queue in host_queues.items():
+        num_workers = min(get_host_connection_limit(host), DOWNLOAD_WORKERS, host_queue.qsize())
+        info('Using ' + str(num_workers) + ' download workers for ' +
+             str(host_queue.qsize()) + ' media files on host "' + host + '"...')
+        for i in range(num_workers):
+            thread = threading.Thread(target=worker, args=(host_queue, active_downloads))
+            thread.daemon = True
+            thread.start()
+            workers.append(thread)
+
+    # Join with a timeout, so that the main thread remains interruptible
+    for thread in workers:
+        while thread.is_alive():
+            thread.join(1)
+
+    # The media files of a host are left in its queue if none of its workers
+    # could connect to the database.
+    num_unprocessed = sum(host_queue.qsize() for host_queue in host_queues.values())
+    if num_unprocessed > 0:
+        error(str(num_unprocessed) + ' media files were left unprocessed by the download workers')
+
+
+def report_download_throughput(elapsed_secs):
+    megabytes = download_stats['bytes'] / 1048576.0
+    info('Downloaded ' + str(download_stats['files']) + ' media files (' +
+         '%.2f' % megabytes + ' MB) in ' + '%.2f' % elapsed_secs + ' seconds...')
+    if elapsed_secs > 0:
+        info('Download throughput: ' + '%.2f' % (megabytes / elapsed_secs) + ' MB/s, ' +
+             '%.2f' % (download_stats['files'] / elapsed_secs) + ' files/s')
+
+
+# Media files are claimed and downloaded in batches, until there are none left.
+def download_media():
+    global download_stats
+    download_stats = {'files': 0, 'bytes': 0}
+    start_time = time.time()
+    claimed_ids = set()
+    try:
+        while True:
+            jobs = claim_download_jobs(claimed_ids)
+            if len(jobs) == 0:
+                break
+            info('Downloading ' + str(len(jobs)) + ' media files...')
+            if DOWNLOAD_WORKERS > 1:
+                download_concurrently(jobs)
+            else:
+                for job in jobs:
+                    download_one(*job)
+    finally:
+        close_sessions()
+    if len(claimed_ids) > 0:
+        info('Downloaded ' + str(len(claimed_ids)) + ' claimed media files...')
+        report_download_throughput(time.time() - start_time)
     else:
         info('No media files to download...')
 
@@ -700,6 +1391,11 @@ def get_image_size(image_file):
 
 # Determine the width and height of the original image in pixels
 def get_image_width_height(tiles_path, tile_size):
+    # The manifest of the tiles records the size of the original image.
+    manifest = image_tiler.read_manifest(tiles_path)
+    if manifest is not None:
+        return manifest['width'], manifest['height']
+
     # See if the converted original JPEG file still exists.
     # For later versions of the tile generation script, the original will be available.
     size = get_image_size(tiles_path + 'original.jpg')
@@ -730,17 +1426,31 @@ def get_image_width_height(tiles_path, tile_size):
         except OSError as e:
             error('Tiles directory ' + original_scale_tiles_path + ' does not exist...')
             error(str(e))
+
+    # Write the manifest, so that the tiles need not be scanned again.
+    if size is not None:
+        try:
+            image_tiler.scan_manifest(tiles_path, size)
+        except (IOError, OSError) as e:
+            error('Failed to write the manifest of tiles in ' + tiles_path + '...')
+            error(str(e))
     return size
 
 
-# Update meta-data for the image tiles that have been generated from the original media.
-def update_tile_metadata(media_id, image_size):
+# Update meta-data for the image tiles that have been generated from the original media,
+# for all of the media files that share the tiles, and release the claim on the checksum.
+# media_ids - Primary keys of the media files with the same checksum
+# file_checksum - The checksum of the media files
+# image_size - Width and height of the image, or None if the tiling failed
+def update_tile_metadata(media_ids, file_checksum, image_size):
     cur = connection.cursor()
     if image_size is None:
-        cur.execute(DB_UPDATE_PHASE_STATUS, (TILE_GENERATION_PHASE, FAILED_STATUS, media_id))
+        set_phase_status_of_media_files(media_ids, TILE_GENERATION_PHASE, FAILED_STATUS)
     else:
-        cur.execute(DB_UPDATE_IMAGE_SIZE, image_size + (media_id,))
-        cur.execute(DB_UPDATE_PHASE_STATUS, (TILE_GENERATION_PHASE, DONE_STATUS, media_id))
+        cur.execute(DB_UPDATE_IMAGE_SIZE_OF_MEDIA_FILES.format(', '.join(['%s'] * len(media_ids))),
+                    list(image_size) + media_ids)
+        set_phase_status_of_media_files(media_ids, TILE_GENERATION_PHASE, DONE_STATUS)
+    cur.execute(DB_RELEASE_CHECKSUM, (file_checksum, lease_owner))
     connection.commit()
 
 
@@ -752,175 +1462,519 @@ def get_tile_storage_path(file_checksum):
     return IMAGE_TILES_DIR + re.sub(r'(.{4})', '\\1/', file_checksum, 0, re.DOTALL)
 
 
+# Check if the tiles of an image exist. The manifest is written once all of the tiles
+# were generated, but tiles generated before manifests were introduced only have the
+# thumbnail.
+def has_tiles(tiles_path):
+    return os.path.isfile(image_tiler.get_manifest_path(tiles_path)) or \
+        os.path.isfile(tiles_path + 'thumbnail.jpg')
+
+
+# The scales that are tiled by the tiling phase. The other scales are tiled on demand
+# by tile_server.py from the original media file.
+def get_tiled_scales():
+    return [x for x in image_tiler.parse_int_list(IMAGE_SCALES) if x not in LAZY_SCALES]
+
+
 # Generates tiles from the supplied media file for the supplied scales and tile size.
-# connection - Connection to use for accessing phenodcc_media
-# media_id - Primary key of record associated with the media file
+# This does not access the database, so that it could be run by a tiling process.
 # original_media - File path to the original media file
-# checksum - The checksum of the media file that was downloaded
-def generate_image_tiles(media_id, original_media, file_checksum):
+# file_checksum - The checksum of the media file that was downloaded
+#
+# Returns the width and height of the image, or None if the tiling failed.
+def tile_image(original_media, file_checksum):
+    # Generate the image tiles in-process, unless the image requires the script.
+    if TILER == 'python' and TILE_PYRAMID == 'deepzoom':
+        try:
+            return tile_deepzoom.generate_tiles(original_media, IMAGE_TILES_DIR, file_checksum,
+                                                image_tiler.parse_int_list(TILE_SIZE)[0],
+                                                memory_limit=TILING_MEMORY_LIMIT_MB * 1048576)
+        except image_tiler.UnsupportedImage as e:
+            info(str(e) + '... will use tiling script')
+        # Pillow raises other errors than IOError (e.g., TypeError, OverflowError) on
+        # corrupt images, which must fail the image instead of the tiling phase.
+        except Exception as e:
+            error('Failed to generate tiles for "' + original_media + '"...')
+            error(str(e))
+            return None
+    elif TILER == 'python':
+        if TILE_STORAGE == 'container':
+            writer_class = tile_container.ContainerTileWriter
+        else:
+            writer_class = image_tiler.TileWriter
+        try:
+            return image_tiler.generate_tiles(original_media, IMAGE_TILES_DIR, file_checksum,
+                                              image_tiler.parse_int_list(TILE_SIZE),
+                                              get_tiled_scales(),
+                                              memory_limit=TILING_MEMORY_LIMIT_MB * 1048576,
+                                              writer_class=writer_class, lazy_scales=LAZY_SCALES,
+                                              uniform_tolerance=UNIFORM_TOLERANCE)
+        except image_tiler.UnsupportedImage as e:
+            info(str(e) + '... will use tiling script')
+        # Pillow raises other errors than IOError (e.g., TypeError, OverflowError) on
+        # corrupt images, which must fail the image instead of the tiling phase.
+        except Exception as e:
+            error('Failed to generate tiles for "' + original_media + '"...')
+            error(str(e))
+            return None
+
+    # Run the script that generates the image tiles. ImageMagick keeps its pixel
+    # cache on disk once the memory limit is reached.
+    env = dict(os.environ)
+    env['MAGICK_MEMORY_LIMIT'] = env['MAGICK_MAP_LIMIT'] = str(TILING_MEMORY_LIMIT_MB) + 'MiB'
+    try:
+        return_code = call(['./generate_tiles_for_image.sh', original_media,
+                            IMAGE_TILES_DIR, TILE_SIZE, IMAGE_SCALES], env=env)
+    except OSError as e:
+        error('Failed to run the tiling script for "' + original_media + '"...')
+        error(str(e))
+        return None
+    if return_code == 0:
+        # To work around file system restrictions on the number of items allowed in a
+        # directory, we do not store the tiles using the file_checksum. Instead, we decompose
+        # the 40 character file_checksum into a path that is 10 levels deep, where the directory
+        # name contains four characters.
+        tiles_path = get_tile_storage_path(file_checksum)
+        size = get_image_width_height(tiles_path, TILE_SIZE)
+        if size is not None and TILE_STORAGE == 'container':
+            pack_tiles(tiles_path)
+        if size is not None and TILE_PYRAMID == 'deepzoom':
+            convert_to_deepzoom(tiles_path)
+        return size
+    return None
+
+
+# Moves the tiles generated by the script into a container. If this fails, the
+# tiles are still served from their directories.
+def pack_tiles(tiles_path):
+    try:
+        tile_container.convert_directory(tiles_path)
+    except (IOError, OSError) as e:
+        error('Failed to move the tiles in ' + tiles_path + ' into a container...')
+        error(str(e))
+
+
+# Replaces the scales generated by the script with a Deep Zoom pyramid, which is
+# generated from the tiles of the 100% scale. If this fails, the scales are kept.
+def convert_to_deepzoom(tiles_path):
+    try:
+        if tile_deepzoom.convert_tile_set(tiles_path, image_tiler.parse_int_list(TILE_SIZE)[0], True) is None:
+            error('Tiles in ' + tiles_path + ' do not have the 100% scale for a Deep Zoom pyramid...')
+    except (IOError, OSError) as e:
+        error('Failed to convert the tiles in ' + tiles_path + ' to a Deep Zoom pyramid...')
+        error(str(e))
+
+
+# Generates tiles for an image in a tiling process. Since the parent must record the
+# outcome of every image, all errors are reported as a failed tiling. The parent is
+# told which process is tiling the image, so that it could tell if the process died.
+# job - Tuple (media_ids, original_media, file_checksum)
+# slot - Index of the process id of this job in the shared array of process ids
+def tile_image_in_worker(job, slot=None):
+    media_ids, original_media, file_checksum = job
+    if slot is not None:
+        tiling_pids[slot] = os.getpid()
+    try:
+        return media_ids, file_checksum, tile_image(original_media, file_checksum)
+    except Exception as e:
+        error('Failed to generate tiles for "' + original_media + '"...')
+        error(str(e))
+        return media_ids, file_checksum, None
+
+
+# A tiling process could be forked whilst another thread holds the output lock.
+# pids - Shared array of the process ids that are tiling the images, by job slot.
+#        This has no lock, since a process that is killed whilst holding a lock
+#        would block the other processes.
+def init_tiling_process(pids):
+    global output_lock, tiling_pids
+    output_lock = threading.Lock()
+    tiling_pids = pids
+
+
+# Generates tiles from the supplied media file, and records the outcome. The media
+# files and their checksum must have been claimed by this worker.
+# media_ids - Primary keys of the media files with the same checksum
+# original_media - File path to the original media file of one of these
+# file_checksum - The checksum of the media files that were downloaded
+def generate_image_tiles(media_ids, original_media, file_checksum):
+    update_tile_metadata(media_ids, file_checksum, tile_image(original_media, file_checksum))
+
+
+# An image that was sent to a tiling process.
+class TilingJob(object):
+    def __init__(self, job, slot, result):
+        self.media_ids, self.original_media, self.file_checksum = job
+        self.slot = slot
+        self.result = result
+        self.start_time = None
+        self.pid = None
+
+    # Returns whether the tiling is done, and the image size (None, if the tiling
+    # failed). The image has failed if the tiling process that was
+    # tiling it died (e.g., it was killed when out of memory), since the pool then
+    # never completes the job, or if the tiling took too long, in which case the
+    # tiling process is killed.
+    # alive - Process ids of the tiling processes that are still running
+    def get_outcome(self, alive):
+        if self.result.ready():
+            try:
+                return True, self.result.get()[2]
+            except Exception as e:
+                error('Failed to generate tiles for "' + self.original_media + '"...')
+                error(str(e))
+                return True, None
+        if self.pid is not None and self.pid not in alive:
+            error('Tiling process ' + str(self.pid) + ' exited whilst tiling "' + self.original_media + '"...')
+            return True, None
+        # An image that is still queued in the pool is not timed out, since the
+        # images ahead of it are.
+        if self.start_time is None or time.time() < self.start_time + TILING_TIMEOUT_SECS:
+            return False, None
+        error('Tiling "' + self.original_media + '" did not finish within ' + str(TILING_TIMEOUT_SECS) +
+              ' seconds...')
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        return True, None
+
+
+# Wait until at most the supplied number of images are still being tiled, and record
+# the outcome of every image that is done. Failed images are recorded as well, so
+# that the heartbeat no longer renews their leases. We poll, so that the parent could
+# still be interrupted.
+# pool - Pool of tiling processes
+# pending - TilingJob of every image being tiled, by checksum
+# pids - Shared array of the process ids that are tiling the images, by job slot
+# free_slots - Job slots that are not used by the pending images
+def wait_for_tiled_images(pool, pending, pids, free_slots, max_pending):
+    while len(pending) > max_pending:
+        alive = set(p.pid for p in pool._pool if p.exitcode is None)
+        for file_checksum, job in pending.items():
+            if job.pid is None and pids[job.slot] != 0:
+                job.pid = pids[job.slot]
+                job.start_time = time.time()
+            done, image_size = job.get_outcome(alive)
+            if done:
+                del pending[file_checksum]
+                free_slots.append(job.slot)
+                update_tile_metadata(job.media_ids, file_checksum, image_size)
+        if len(pending) > max_pending:
+            time.sleep(TILING_POLL_SECS)
+
+
+# Generates tiles for the supplied images using a pool of tiling processes. The
+# tiling processes do not access the database; the parent claims the images, and
+# records the image size and the done or failed status when they are tiled. Only a
+# limited number of images are dispatched at any one time, so that the images to
+# tile could be claimed in batches.
+# jobs - Iterable of (media_ids, original_media, file_checksum) tuples
+def generate_tiles_concurrently(jobs):
+    max_pending = TILE_WORKERS * TILE_JOBS_PER_WORKER
+    pids = multiprocessing.RawArray('i', max_pending)
+    free_slots = range(max_pending)
+    pool = multiprocessing.Pool(TILE_WORKERS, init_tiling_process, (pids,))
+    pending = {}
+    num_dispatched = 0
+    try:
+        for job in jobs:
+            wait_for_tiled_images(pool, pending, pids, free_slots, max_pending - 1)
+            slot = free_slots.pop()
+            pids[slot] = 0
+            pending[job[2]] = TilingJob(job, slot, pool.apply_async(tile_image_in_worker, (job, slot)))
+            num_dispatched += 1
+        pool.close()
+        wait_for_tiled_images(pool, pending, pids, free_slots, 0)
+    finally:
+        # The pool is not joined, since it waits forever for the jobs of the tiling
+        # processes that died.
+        pool.terminate()
+    return num_dispatched
+
+
+# Generates tiles for the supplied images, and returns the number of images.
+# jobs - Iterable of (media_ids, original_media, file_checksum) tuples
+def tile_images(jobs):
+    if TILE_WORKERS > 1:
+        info('Tiling images using ' + str(TILE_WORKERS) + ' processes...')
+        return generate_tiles_concurrently(jobs)
+    num_media_files = 0
+    for job in jobs:
+        generate_image_tiles(*job)
+        num_media_files += 1
+    return num_media_files
+
+
+# Claims a checksum for tiling. Returns False if another worker is tiling it.
+def claim_checksum(file_checksum):
     cur = connection.cursor()
-    cur.execute(DB_UPDATE_PHASE_STATUS, (TILE_GENERATION_PHASE, RUNNING_STATUS, media_id))
-    connection.commit()
+    execute_claim(cur, DB_CLAIM_CHECKSUM, (file_checksum, lease_owner, LEASE_SECS))
+    cur.execute(DB_GET_CHECKSUM_LEASE_OWNER, (file_checksum,))
+    row = cur.fetchone()
+    return row is not None and row[0] == lease_owner
 
-    # To work around file system restrictions on the number of items allowed in a
-    # directory, we do not store the tiles using the file_checksum. Instead, we decompose
-    # the 40 character file_checksum into a path that is 10 levels deep, where the directory
-    # name contains four characters.
-    tiles_path = get_tile_storage_path(file_checksum)
 
-    # Run the script that generates the image tiles.
-    return_code = call(['./generate_tiles_for_image.sh', original_media,
-                        IMAGE_TILES_DIR, TILE_SIZE, IMAGE_SCALES])
-    if return_code == 0:
-        update_tile_metadata(media_id, get_image_width_height(tiles_path, TILE_SIZE))
-    else:
-        update_tile_metadata(media_id, None)
-    return return_code
+def release_checksum(file_checksum):
+    connection.cursor().execute(DB_RELEASE_CHECKSUM, (file_checksum, lease_owner))
+    connection.commit()
 
 
-# Generate tiles for all of the image media files.
-def generate_tiles():
-    cur = connection.cursor(MySQLdb.cursors.DictCursor)
-    cur.execute(DB_GET_IMAGE_FILES_TO_TILE)
-    if cur.rowcount > 0:
-        info('Generating tiles for ' + str(cur.rowcount) + ' media files...')
-        for i in range(cur.rowcount):
-            record = cur.fetchone()
-            media_id = record['id']
-            centre_id = record['cid']
-            pipeline_id = record['lid']
-            genotype_id = record['gid']
-            strain_id = record['sid']
-            procedure_id = record['pid']
-            parameter_id = record['qid']
-            file_extension = record['extension']
-            file_checksum = record['checksum']
+# Returns the width and height of an image with the supplied checksum that was
+# already tiled, if its tiles still exist.
+def get_tiled_image_size(file_checksum):
+    cur = connection.cursor()
+    cur.execute(DB_GET_TILED_IMAGE_SIZE, (file_checksum, TILE_GENERATION_PHASE, DONE_STATUS))
+    row = cur.fetchone()
+    if row is not None and has_tiles(get_tile_storage_path(file_checksum)):
+        return int(row[0]), int(row[1])
+    return None
+
+
+# Claims images to tile in batches of checksums, until there are none left. Media
+# files with the same checksum share the same tiles, hence, every checksum is
+# claimed with all of its media files and tiled once. If the checksum was tiled
+# previously, the media files are marked done with the size of that image instead.
+# stats - Counts the media files and checksums that were claimed, and reused
+def get_images_to_tile(stats):
+    cur = connection.cursor()
+    claimed_ids = set()
+    while True:
+        cur.execute(DB_GET_CHECKSUMS_TO_TILE, (CHECKSUM_PHASE, DONE_STATUS, TILE_GENERATION_PHASE,
+                                               RUNNING_STATUS, CLAIM_BATCH_SIZE))
+        checksums = [row[0] for row in cur.fetchall()]
+        if len(checksums) == 0:
+            break
+        for file_checksum in checksums:
+            if not claim_checksum(file_checksum):
+                continue
+            rows = claim_media_files(DB_CLAIM_IMAGE_FILES_WITH_CHECKSUM,
+                                     (TILE_GENERATION_PHASE, RUNNING_STATUS, lease_owner, LEASE_SECS,
+                                      file_checksum, CHECKSUM_PHASE, DONE_STATUS,
+                                      TILE_GENERATION_PHASE, RUNNING_STATUS),
+                                     DB_GET_CLAIMED_IMAGE_FILES_WITH_CHECKSUM,
+                                     (lease_owner, file_checksum, TILE_GENERATION_PHASE, RUNNING_STATUS),
+                                     claimed_ids)
+            if len(rows) == 0:
+                release_checksum(file_checksum)
+                continue
+            media_ids = [row[0] for row in rows]
+            stats['media_files'] += len(media_ids)
+            stats['checksums'] += 1
+
+            image_size = get_tiled_image_size(file_checksum)
+            if image_size is not None:
+                info('Reusing tiles of checksum ' + file_checksum + ' for media ids: ' +
+                     ', '.join(map(str, media_ids)))
+                update_tile_metadata(media_ids, file_checksum, image_size)
+                stats['reused'] += len(media_ids)
+                continue
 
+            (media_id, centre_id, pipeline_id, genotype_id, strain_id, procedure_id,
+             parameter_id, file_extension) = rows[0]
             info('---------------------------------')
-            info('Processing media id: ' + str(media_id))
+            info('Processing media ids: ' + ', '.join(map(str, media_ids)))
             info('---------------------------------')
 
             original_media = get_original_media_path(centre_id, pipeline_id,
                                                      genotype_id, strain_id,
                                                      procedure_id, parameter_id,
                                                      media_id, file_extension)
-            generate_image_tiles(media_id, original_media, file_checksum)
+            yield media_ids, original_media, file_checksum
+
+
+# Claims an image that was tiled, so that its tiles could be regenerated. Returns
+# False if the image is no longer in the tile/done state, e.g., if another worker
+# is regenerating its tiles.
+def claim_image_to_regenerate(media_id):
+    cur = connection.cursor()
+    cur.execute(DB_CLAIM_IMAGE_FILE_TO_REGENERATE, (RUNNING_STATUS, lease_owner, LEASE_SECS, media_id,
+                                                    TILE_GENERATION_PHASE, DONE_STATUS))
+    connection.commit()
+    return cur.rowcount == 1
+
+
+# Generate tiles for all of the image media files.
+def generate_tiles():
+    stats = {'media_files': 0, 'checksums': 0, 'reused': 0}
+    num_images = tile_images(get_images_to_tile(stats))
+    if stats['media_files'] > 0:
+        info('Generated tiles for ' + str(num_images) + ' images, for ' + str(stats['media_files']) +
+             ' media files with ' + str(stats['checksums']) + ' distinct checksums...')
+        info('Skipped tiling for ' + str(stats['media_files'] - num_images) + ' media files (' +
+             str(stats['reused']) + ' reused tiles that were generated previously)...')
     else:
         info('No image files to tile...')
 
 
-def fix_interrupted_downloads():
-    cur = connection.cursor(MySQLdb.cursors.DictCursor)
-    modify_cur = connection.cursor()
-    cur.execute(DB_GET_INTERRUPTED_DOWNLOADS, (download_centre_id,))
-    if cur.rowcount > 0:
-        info('Fixing ' + str(cur.rowcount) + ' interrupted downloads...')
-        for i in range(cur.rowcount):
-            record = cur.fetchone()
-            media_id = record['id']
-            centre_id = record['cid']
-            pipeline_id = record['lid']
-            genotype_id = record['gid']
-            strain_id = record['sid']
-            procedure_id = record['pid']
-            parameter_id = record['qid']
-            file_extension = record['extension']
-            info('Will re-download media file with id ' + str(media_id))
-
-            # If the download was interrupted, any existing file could be corrupted or incomplete.
-            # Since the normal downloader skips existing files, we must first delete any existing
-            # file so that the media file is downloaded again.
-            original_media = get_original_media_path(centre_id, pipeline_id,
-                                                     genotype_id, strain_id,
-                                                     procedure_id, parameter_id,
-                                                     media_id, file_extension)
-            if original_media and os.path.exists(original_media):
-                if os.path.islink(original_media):
-                    info('Removing existing symbolic link "' + original_media + '"')
-                    os.remove(original_media)
-                else:
-                    new_name = original_media + datetime.now().strftime("_%Y_%m_%d_%H_%M") + '.old'
-                    info('Renaming existing file "' + original_media + '" to "' + new_name + '"')
-                    os.rename(original_media, new_name)
+def set_phase_status_of_media_files(media_ids, phase_id, status_id):
+    if len(media_ids) > 0:
+        cur = connection.cursor()
+        cur.execute(DB_UPDATE_PHASE_STATUS_OF_MEDIA_FILES.format(', '.join(['%s'] * len(media_ids))),
+                    [phase_id, status_id] + media_ids)
 
-            # Now, mark this for re-downloading in the next download run.
-            modify_cur.execute(DB_UPDATE_PHASE_STATUS, (DOWNLOAD_PHASE, PENDING_STATUS, media_id))
-            connection.commit()
-    else:
-        info('No interrupted downloads found...')
+
+# Records the checksums of a batch of media files, and marks them done.
+def record_checksums(checksums):
+    media_checksum.update_checksums(connection.cursor(), checksums)
+    set_phase_status_of_media_files([media_id for media_id, sha1 in checksums],
+                                    CHECKSUM_PHASE, DONE_STATUS)
+    connection.commit()
 
 
+# Since only checksum was interrupted, the download must have completed
+# successfully. The checksums of these files are calculated in parallel,
+# and recorded in batches.
 def fix_interrupted_checksum():
-    cur = connection.cursor(MySQLdb.cursors.DictCursor)
-    modify_cur = connection.cursor()
-    cur.execute(DB_GET_INTERRUPTED_CHECKSUM, (download_centre_id,))
-    if cur.rowcount > 0:
-        info('Fixing ' + str(cur.rowcount) + ' interrupted checksum calculations...')
-        for i in range(cur.rowcount):
-            record = cur.fetchone()
-            media_id = record['id']
-            info('Will re-calculate checksum for media file with id ' + str(media_id))
-            # Mark this for re-downloading in the next download run.
-            # Since only checksum was interrupted, the download must have completed
-            # successfully. By not deleting this file, the download phase will be skipped
-            # followed by calculation of the checksum as usual.
-            modify_cur.execute(DB_UPDATE_PHASE_STATUS, (DOWNLOAD_PHASE, PENDING_STATUS, media_id))
-            connection.commit()
+    media_files = []
+    for (media_id, centre_id, pipeline_id, genotype_id, strain_id, procedure_id,
+         parameter_id, file_extension) in claim_media_files(
+            DB_CLAIM_INTERRUPTED_CHECKSUM,
+            (CHECKSUM_PHASE, RUNNING_STATUS, lease_owner, LEASE_SECS, download_centre_id,
+             CHECKSUM_PHASE, PENDING_STATUS, RUNNING_STATUS, DOWNLOAD_PHASE, DONE_STATUS),
+            DB_GET_CLAIMED_CHECKSUM, (lease_owner, download_centre_id, CHECKSUM_PHASE, RUNNING_STATUS),
+            set()):
+        media_files.append((media_id, get_original_media_path(centre_id, pipeline_id,
+                                                              genotype_id, strain_id,
+                                                              procedure_id, parameter_id,
+                                                              media_id, file_extension)))
+    if len(media_files) > 0:
+        info('Fixing ' + str(len(media_files)) + ' interrupted checksum calculations...')
+        stats = media_checksum.ChecksumStats()
+        checksums = []
+        unreadable = []
+        for media_id, file_path, sha1 in media_checksum.calculate_checksums(media_files, stats,
+                                                                             CHECKSUM_WORKERS):
+            if sha1 is None:
+                info('Failed to read "' + file_path + '"; will re-download media file with id ' +
+                     str(media_id))
+                unreadable.append(media_id)
+            else:
+                checksums.append((media_id, sha1))
+                if len(checksums) == CHECKSUM_BATCH_SIZE:
+                    record_checksums(checksums)
+                    checksums = []
+        record_checksums(checksums)
+
+        # Mark files that could not be read for re-downloading in the next download run.
+        set_phase_status_of_media_files(unreadable, DOWNLOAD_PHASE, PENDING_STATUS)
+        connection.commit()
+        info(stats.summary())
     else:
         info('No interrupted checksum calculations to fix...')
 
 
-def fix_interrupted_tiling():
-    cur = connection.cursor(MySQLdb.cursors.DictCursor)
-    modify = connection.cursor()
-    cur.execute(DB_GET_INTERRUPTED_TILING)
-    if cur.rowcount > 0:
-        info('Fixing ' + str(cur.rowcount) + ' interrupted media tiling...')
-        for i in range(cur.rowcount):
-            record = cur.fetchone()
-            media_id = record['id']
-            file_checksum = record['checksum']
-            info('    Will re-generate tiles for media file with id ' +
-                 str(media_id) + ' and checksum ' + file_checksum)
-            # If the tiling was interrupted, it is highly likely that the tiles set is
-            # incomplete. We therefore need to assume that the worst has happen and
-            # re-generate the tiles set all over again. To do this, we must first delete
-            # the existing tiles directory.
-            tiles_path = get_tile_storage_path(file_checksum)
-            if tiles_path and os.path.exists(tiles_path):
-                shutil.rmtree(tiles_path)
-
-            # Now, mark this for tile re-generation.
-            modify.execute(DB_UPDATE_PHASE_STATUS, (CHECKSUM_PHASE, DONE_STATUS, media_id))
-            connection.commit()
+# Scans the tiles directory once for the checksums that have a complete tiles set.
+# Unless a rescan was requested, only the subtrees that were added since the previous
+# scan are walked, and only the tiles directories that changed are listed again.
+def get_checksums_with_tiles():
+    index = tile_index.TileIndex(IMAGE_TILES_DIR)
+    if not opt_rescan and index.load():
+        info('Scanning tiles directory for changes since the previous scan...')
     else:
-        info('No interrupted tiling to fix...')
+        info('Scanning entire tiles directory...')
+    stats = tile_index.ScanStats()
+    checksums = index.scan(stats, TILE_SCAN_WORKERS)
+    try:
+        index.save()
+    except (IOError, OSError) as e:
+        error('Failed to save tile index "' + index.get_index_path() + '"...')
+        error(str(e))
+    info(stats.summary(len(checksums)))
+    return checksums
+
+
+# Get the images that were tiled, but whose tiles are missing. Since media files
+# with the same checksum share the same tiles, every checksum is regenerated once.
+# Only the checksums that were not found by the scan are checked individually,
+# since they could have been tiled after the scan.
+# stats - Counts the number of images that were checked
+# checksums_with_tiles - Checksums with complete tiles sets
+def get_images_with_missing_tiles(stats, checksums_with_tiles):
+    regenerated_checksums = set()
+    for (media_id, centre_id, pipeline_id, genotype_id, strain_id, procedure_id,
+         parameter_id, file_extension, file_checksum, width, height) in stream_query(DB_GET_TILING_DONE):
+        stats['media_files'] += 1
+        if file_checksum in checksums_with_tiles or file_checksum in regenerated_checksums:
+            continue
+        tiles_path = get_tile_storage_path(file_checksum)
+        if tiles_path and has_tiles(tiles_path):
+            continue
+        if not claim_checksum(file_checksum):
+            continue
+        if not claim_image_to_regenerate(media_id):
+            release_checksum(file_checksum)
+            continue
+        regenerated_checksums.add(file_checksum)
+        original_media = get_original_media_path(centre_id, pipeline_id,
+                                                 genotype_id, strain_id,
+                                                 procedure_id, parameter_id,
+                                                 media_id, file_extension)
+        yield [media_id], original_media, file_checksum
+
+
+# Get the tiles sets of the images that were tiled, once for every checksum. The
+# tiles are verified against the width and height recorded for the media file, or
+# in the manifest, if the media file does not have these.
+# stats - Counts the number of images, and those whose size is not known
+def get_tile_sets_to_verify(stats):
+    checksums = set()
+    for row in stream_query(DB_GET_TILING_DONE):
+        stats['media_files'] += 1
+        file_checksum, width, height = row[8:]
+        if file_checksum in checksums:
+            continue
+        checksums.add(file_checksum)
+        tiles_path = get_tile_storage_path(file_checksum)
+        if width is None or height is None:
+            manifest = image_tiler.read_manifest(tiles_path)
+            if manifest is None:
+                stats['unknown_size'] += 1
+                continue
+            width, height = manifest['width'], manifest['height']
+        yield row, tiles_path, (int(width), int(height))
+
+
+# Get the images whose tiles sets are incomplete, i.e., with tiles that are missing,
+# or that were only partially written. Every tile is verified, and the tiles sets are
+# verified in parallel by a pool of threads.
+# stats - Counts the number of images that were checked
+# verify_stats - Counts the tiles sets and tiles that were verified
+def get_images_with_broken_tiles(stats, verify_stats):
+    for row, broken in tile_verify.verify_tile_sets(get_tile_sets_to_verify(stats), verify_stats,
+                                                     image_tiler.parse_int_list(TILE_SIZE),
+                                                     get_tiled_scales(), TILE_VERIFY_WORKERS):
+        if not broken:
+            continue
+        (media_id, centre_id, pipeline_id, genotype_id, strain_id, procedure_id,
+         parameter_id, file_extension, file_checksum, width, height) = row
+        if not claim_checksum(file_checksum):
+            continue
+        if not claim_image_to_regenerate(media_id):
+            release_checksum(file_checksum)
+            continue
+        original_media = get_original_media_path(centre_id, pipeline_id,
+                                                 genotype_id, strain_id,
+                                                 procedure_id, parameter_id,
+                                                 media_id, file_extension)
+        yield [media_id], original_media, file_checksum
 
 
 def regenerate_missing_tiles():
-    cur = connection.cursor(MySQLdb.cursors.DictCursor)
-    cur.execute(DB_GET_TILING_DONE)
-    if cur.rowcount > 0:
-        info('Regenerating missing tiles for ' + str(cur.rowcount) + ' media files...')
-        for i in range(cur.rowcount):
-            record = cur.fetchone()
-            media_id = record['id']
-            centre_id = record['cid']
-            pipeline_id = record['lid']
-            genotype_id = record['gid']
-            strain_id = record['sid']
-            procedure_id = record['pid']
-            parameter_id = record['qid']
-            file_extension = record['extension']
-            file_checksum = record['checksum']
-            tiles_path = get_tile_storage_path(file_checksum)
-            if not (tiles_path and os.path.exists(tiles_path)
-                    and os.path.isfile(tiles_path + 'thumbnail.jpg')):
-                original_media = get_original_media_path(centre_id, pipeline_id,
-                                                         genotype_id, strain_id,
-                                                         procedure_id, parameter_id,
-                                                         media_id, file_extension)
-                generate_image_tiles(media_id, original_media, file_checksum)
+    stats = {'media_files': 0, 'unknown_size': 0}
+    if opt_verify:
+        info('Verifying tiles sets using ' + str(TILE_VERIFY_WORKERS) + ' threads...')
+        verify_stats = tile_verify.VerifyStats()
+        num_regenerated = tile_images(get_images_with_broken_tiles(stats, verify_stats))
+        info(verify_stats.summary())
+        if stats['unknown_size'] > 0:
+            info('Skipped verifying ' + str(stats['unknown_size']) +
+                 ' tiles sets without a known image size...')
+    else:
+        num_regenerated = tile_images(get_images_with_missing_tiles(stats, get_checksums_with_tiles()))
+    if num_regenerated > 0:
+        info('Regenerated missing tiles for ' + str(num_regenerated) + ' of ' +
+             str(stats['media_files']) + ' media files...')
     else:
         info('No missing tiles to regenerate...')
 
@@ -928,14 +1982,22 @@ def regenerate_missing_tiles():
 def print_usage():
     print '\nPhenoDCC media downloader and tile generator\n(http://www.mousephenotype.org)'
     print 'Version', VERSION, '\n'
-    print 'USAGE:\n\tphenodcc_media.py [-p | --prepare | -d | --download | -t | --tile |'
-    print '\t\t -c | --centre | -x | --config-file | -l | --lock-dir |'
-    print '\t\t -silent | --silent | -h | --help]\n'
+    print 'USAGE:\n\tphenodcc_media.py [-p | --prepare | -f | --full | -d | --download | -t | --tile |'
+    print '\t\t -r | --regen | --rescan | --verify | -w | --workers | -c | --centre | -x | --config-file |'
+    print '\t\t -l | --lock-dir | -silent | --silent | -h | --help]\n'
     print '    -p, --prepare      Prepare media files by marking them for download.'
+    print '    -f, --full         Consider all measurements when preparing, instead of only'
+    print '                       those recorded since the last prepare. Run this periodically'
+    print '                       to add media files that an incremental prepare has missed.'
     print '    -d, --download     Download media files that was marked for download.'
     print '    -t, --tile         Generate tiles for all of the image media files'
     print '                       that was downloaded successfully.'
     print '    -r, --regen        Identify missing tiles and re-generate them from original image.'
+    print '        --rescan       Scan the entire tiles directory when regenerating, instead of'
+    print '                       only the directories that changed since the previous scan.'
+    print '        --verify       Verify every tile when regenerating, and re-generate the tiles'
+    print '                       sets with tiles that are missing or incomplete.'
+    print '    -w, --workers      Number of processes for generating tiles (default 1).'
     print '    -c, --centre       Restrict download to given centre.'
     print '    -l, --lock-dir     Directory where single instance locks are held.'
     print '    -x, --config-file  Which file to use for getting configuration.'
@@ -947,14 +2009,19 @@ def print_usage():
     print 'The following settings are allowed:\n'
     print '    tracker - Database for getting active contexts and media file URLs.'
     print '      media - Database where we track the download and processing of media files.'
-    print '       tile - Set tile size.'
-    print '     scales - Set zooming scales.\n'
+    print '       tile - Set tile size, the tiler and how the tiles are stored.'
+    print '     scales - Set zooming scales.'
+    print '    prepare - Set margin of measurement ids re-scanned below the watermark.'
+    print '   download - Set download workers and connections per host.'
+    print '   checksum - Set checksum workers and update batch size.'
+    print '      lease - Set lease duration, heartbeat interval and claim batch size.'
+    print '      regen - Set number of threads for scanning and verifying the tiles directory.\n'
     print 'Single Instance\n---------------'
     print 'To allow the script to be invoked periodically as part of an automated system,'
-    print 'the script uses file locking to allow only one running instance of a phase.'
-    print 'Hence, a file name prepare.lock, download.lock or tiling.lock is created in the'
-    print 'directory from which the script is invoked. Note that this only works if the script'
-    print 'is always run from the same directory. Two different phases can run simultaneously.'
+    print 'the script uses file locking to allow only one running instance of the prepare'
+    print 'and regen phases. Hence, a file named prepare.lock or regen.lock is created in the'
+    print 'lock directory. The download and tile phases could be run by several instances,'
+    print 'on one or more hosts, since every instance claims the media files it processes.'
     sys.stdout.flush()
 
 
@@ -979,13 +2046,6 @@ def is_valid_centre(centre):
     return True
 
 
-def prepare_lock_name(action):
-    lock_name = opt_lock_dir + action + '_'
-    if opt_specified_centre:
-        lock_name = lock_name + opt_specified_centre
-    return lock_name + '.lock'
-
-
 def log_timed(message, when):
     if opt_verbose:
         print message, when
@@ -1005,6 +2065,7 @@ def prepare_for_download():
         end_time = datetime.now()
         log_timed('Preparation for download ended at:', end_time)
         log_timed('Elapsed time:', end_time - start_time)
+        log_peak_memory()
         info('---------------------------------')
     except IOError as e:
         error('Already preparing media files for download... check "' + lock_name + '"')
@@ -1022,18 +2083,14 @@ def prepare_for_download():
 def download_the_media():
     if not is_valid_centre(opt_specified_centre):
         cleanup_and_exit(1)
-    lock_name = prepare_lock_name('download')
-    fp = None
+    start_lease_heartbeat()
     try:
-        fp = open(lock_name, 'w')
-        fcntl.lockf(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
         start_time = datetime.now()
         info('---------------------------------')
-        log_timed('Started fixing interrupted downloads at:', start_time)
-        fix_interrupted_downloads()
+        log_timed('Started fixing interrupted checksums at:', start_time)
         fix_interrupted_checksum()
         end_time = datetime.now()
-        log_timed('Finished fixing interrupted downloads at:', end_time)
+        log_timed('Finished fixing interrupted checksums at:', end_time)
         log_timed('Elapsed time:', end_time - start_time)
         start_time = datetime.now()
         info('---------------------------------')
@@ -1042,29 +2099,16 @@ def download_the_media():
         end_time = datetime.now()
         log_timed('Finished downloading media files at:', end_time)
         log_timed('Elapsed time:', end_time - start_time)
+        log_peak_memory()
         info('---------------------------------')
-    except IOError as e:
-        error('Already downloading media files... check "' + lock_name + '"')
-        error(str(e))
     finally:
-        if fp and not fp.closed:
-            fp.close()
-        os.remove(lock_name)
+        stop_lease_heartbeat()
 
 
+# Images whose tiling was interrupted are claimed again once their lease has expired.
 def tile_image_media():
-    lock_name = opt_lock_dir + 'tiling.lock'
-    fp = None
+    start_lease_heartbeat()
     try:
-        fp = open(lock_name, 'w')
-        fcntl.lockf(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
-        start_time = datetime.now()
-        info('---------------------------------')
-        log_timed('Started fixing interrupted tiling at:', start_time)
-        fix_interrupted_tiling()
-        end_time = datetime.now()
-        log_timed('Finished fixing interrupted tiling at:', end_time)
-        log_timed('Elapsed time:', end_time - start_time)
         start_time = datetime.now()
         info('---------------------------------')
         log_timed('Started tiling images at:', start_time)
@@ -1072,22 +2116,19 @@ def tile_image_media():
         end_time = datetime.now()
         log_timed('Finished tiling images at:', end_time)
         log_timed('Elapsed time:', end_time - start_time)
+        log_peak_memory()
         info('---------------------------------')
-    except IOError as e:
-        error('Already tiling image files... check "' + lock_name + '"')
-        error(str(e))
     finally:
-        if fp and not fp.closed:
-            fp.close()
-        os.remove(lock_name)
+        stop_lease_heartbeat()
 
 
 def regenerate_tiles():
-    lock_name = opt_lock_dir + 'tiling.lock'
+    lock_name = opt_lock_dir + 'regen.lock'
     fp = None
     try:
         fp = open(lock_name, 'w')
         fcntl.lockf(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        start_lease_heartbeat()
         start_time = datetime.now()
         info('---------------------------------')
         log_timed('Started regenerating missing tiles at:', start_time)
@@ -1095,11 +2136,13 @@ def regenerate_tiles():
         end_time = datetime.now()
         log_timed('Finished regenerating  missing tiles at:', end_time)
         log_timed('Elapsed time:', end_time - start_time)
+        log_peak_memory()
         info('---------------------------------')
     except IOError as e:
-        error('Already tiling image files... check "' + lock_name + '"')
+        error('Already regenerating missing tiles... check "' + lock_name + '"')
         error(str(e))
     finally:
+        stop_lease_heartbeat()
         if fp and not fp.closed:
             fp.close()
         os.remove(lock_name)
@@ -1139,11 +2182,23 @@ def check_lock_directory(directory):
     return directory
 
 
+def get_config_int(config, section, option, default):
+    if config.has_option(section, option):
+        return config.getint(section, option)
+    return default
+
+
 def get_configuration():
     global opt_config_file, sleep_message
     global MEDIA_DATABASE, MEDIA_HOSTNAME, MEDIA_USERNAME, MEDIA_PASSWORD
     global ORIGINAL_MEDIA_FILES_DIR, IMAGE_TILES_DIR
-    global TILE_SIZE, IMAGE_SCALES
+    global TILE_SIZE, IMAGE_SCALES, TILER, TILE_STORAGE, TILE_PYRAMID, LAZY_SCALES, UNIFORM_TOLERANCE
+    global TILING_MEMORY_LIMIT_MB, TILING_TIMEOUT_SECS
+    global PREPARE_WATERMARK_MARGIN
+    global DOWNLOAD_WORKERS, CONNECTIONS_PER_HOST
+    global CHECKSUM_WORKERS, CHECKSUM_BATCH_SIZE
+    global LEASE_SECS, HEARTBEAT_SECS, CLAIM_BATCH_SIZE
+    global TILE_SCAN_WORKERS, TILE_VERIFY_WORKERS
 
     check_config_file()
     config = ConfigParser.RawConfigParser()
@@ -1164,6 +2219,65 @@ def get_configuration():
     # Concerning tile generation
     TILE_SIZE = config.get('tiling', 'tile_size')
     IMAGE_SCALES = config.get('tiling', 'image_scales')
+    TILER = DEFAULT_TILER
+    if config.has_option('tiling', 'tiler'):
+        TILER = config.get('tiling', 'tiler')
+    if TILER not in ('python', 'script'):
+        error_exit('Invalid tiler "' + TILER + '"; must be either python or script...')
+    TILE_STORAGE = DEFAULT_TILE_STORAGE
+    if config.has_option('tiling', 'storage'):
+        TILE_STORAGE = config.get('tiling', 'storage')
+    if TILE_STORAGE not in ('directory', 'container'):
+        error_exit('Invalid tile storage "' + TILE_STORAGE + '"; must be either directory or container...')
+    LAZY_SCALES = []
+    if config.has_option('tiling', 'lazy_scales'):
+        LAZY_SCALES = image_tiler.parse_int_list(config.get('tiling', 'lazy_scales'))
+    if not set(LAZY_SCALES).issubset(image_tiler.parse_int_list(IMAGE_SCALES)):
+        error_exit('Invalid lazy scales "' + config.get('tiling', 'lazy_scales') +
+                   '"; must be a subset of the image scales...')
+    UNIFORM_TOLERANCE = None
+    if config.has_option('tiling', 'uniform_tolerance') and config.get('tiling', 'uniform_tolerance').strip():
+        UNIFORM_TOLERANCE = config.getint('tiling', 'uniform_tolerance')
+        if UNIFORM_TOLERANCE < 0:
+            error_exit('Invalid uniform tolerance "' + str(UNIFORM_TOLERANCE) + '"; must not be negative...')
+    TILE_PYRAMID = DEFAULT_TILE_PYRAMID
+    if config.has_option('tiling', 'pyramid'):
+        TILE_PYRAMID = config.get('tiling', 'pyramid')
+    if TILE_PYRAMID not in ('scales', 'deepzoom'):
+        error_exit('Invalid tile pyramid "' + TILE_PYRAMID + '"; must be either scales or deepzoom...')
+    if TILE_PYRAMID == 'deepzoom' and \
+            (TILE_STORAGE != 'directory' or LAZY_SCALES or UNIFORM_TOLERANCE is not None):
+        error_exit('A deepzoom tile pyramid requires directory storage, without lazy scales or uniform tolerance...')
+    TILING_MEMORY_LIMIT_MB = get_config_int(config, 'tiling', 'memory_limit',
+                                            DEFAULT_TILING_MEMORY_LIMIT_MB)
+    TILING_TIMEOUT_SECS = get_config_int(config, 'tiling', 'timeout', DEFAULT_TILING_TIMEOUT_SECS)
+
+    # Concerning the incremental prepare
+    PREPARE_WATERMARK_MARGIN = get_config_int(config, 'prepare', 'watermark_margin',
+                                              DEFAULT_PREPARE_WATERMARK_MARGIN)
+
+    # Concerning concurrent downloads
+    DOWNLOAD_WORKERS = get_config_int(config, 'download', 'workers', DEFAULT_DOWNLOAD_WORKERS)
+    CONNECTIONS_PER_HOST = get_config_int(config, 'download', 'connections_per_host',
+                                          DEFAULT_CONNECTIONS_PER_HOST)
+    if config.has_section('host_limits'):
+        for host, limit in config.items('host_limits'):
+            HOST_CONNECTION_LIMITS[host.lower()] = int(limit)
+
+    # Concerning checksum calculation
+    CHECKSUM_WORKERS = get_config_int(config, 'checksum', 'workers', media_checksum.DEFAULT_WORKERS)
+    CHECKSUM_BATCH_SIZE = get_config_int(config, 'checksum', 'batch_size', media_checksum.DEFAULT_BATCH_SIZE)
+
+    # Concerning claiming of media files
+    LEASE_SECS = get_config_int(config, 'lease', 'duration', DEFAULT_LEASE_SECS)
+    HEARTBEAT_SECS = get_config_int(config, 'lease', 'heartbeat', DEFAULT_HEARTBEAT_SECS)
+    CLAIM_BATCH_SIZE = get_config_int(config, 'lease', 'batch_size', DEFAULT_CLAIM_BATCH_SIZE)
+    if HEARTBEAT_SECS >= LEASE_SECS:
+        error_exit('Lease heartbeat must be shorter than the lease duration...')
+
+    # Concerning the scan and verification of the tiles directory when regenerating missing tiles
+    TILE_SCAN_WORKERS = get_config_int(config, 'regen', 'scan_workers', tile_index.DEFAULT_WORKERS)
+    TILE_VERIFY_WORKERS = get_config_int(config, 'regen', 'verify_workers', tile_verify.DEFAULT_WORKERS)
 
     if SLEEP_SECS_BEFORE_RETRY > 60:
         sleep_message = str(SLEEP_SECS_BEFORE_RETRY / 60) + ' minutes'
@@ -1174,15 +2288,30 @@ def get_configuration():
 
 def parse_options(opts):
     global what_to_do, opt_verbose, opt_specified_centre, opt_config_file, opt_lock_dir
+    global opt_full_prepare, opt_rescan, opt_verify, TILE_WORKERS
     for option, argument in opts:
         if option in ("-p", "--prepare"):
             what_to_do = "prepare"
+        elif option in ("-f", "--full"):
+            opt_full_prepare = True
         elif option in ("-d", "--download"):
             what_to_do = "download"
         elif option in ("-t", "--tile"):
             what_to_do = "tile"
         elif option in ("-r", "--regen"):
             what_to_do = "regen"
+        elif option == "--rescan":
+            opt_rescan = True
+        elif option == "--verify":
+            opt_verify = True
+        elif option in ("-w", "--workers"):
+            try:
+                TILE_WORKERS = int(argument)
+            except ValueError:
+                TILE_WORKERS = 0
+            if TILE_WORKERS < 1:
+                error('Number of tiling workers must be a positive integer...')
+                print_usage_and_exit()
         elif option in ("-c", "--centre"):
             opt_specified_centre = argument
         elif option in ("-l", "--lock-dir"):
@@ -1197,10 +2326,10 @@ def parse_options(opts):
 
 def parse_commandline():
     global opt_lock_dir
-    options = ["help", "download", "prepare", "regen", "centre=",
+    options = ["help", "download", "prepare", "full", "regen", "rescan", "verify", "workers=", "centre=",
                "lock-dir=", "config-file=", "tile", "silent"]
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hdprc:x:l:ts", options)
+        opts, args = getopt.getopt(sys.argv[1:], "hdpfrw:c:x:l:ts", options)
         if opts:
             parse_options(opts)
             if opt_lock_dir:
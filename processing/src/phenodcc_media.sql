@@ -95,17 +95,42 @@ create table media_file (
        created datetime not null, /* when was this record created */
        last_update timestamp not null default current_timestamp on update current_timestamp,
        touched tinyint not null default 1, /* 1 if the URL is still valid */
+       lease_owner varchar(128), /* host and process that claimed the media file for processing */
+       lease_expiry datetime, /* when the claim expires, unless renewed by the lease owner */
        primary key (id),
        unique data_context (cid, lid, gid, sid, pid, qid, mid),
        index (url),
        index (checksum),
        index (mid),
+       index phase_status_lease (phase_id, status_id, lease_expiry),
+       index (lease_owner),
        foreign key (extension_id) references file_extension(id) on update cascade on delete restrict,
        foreign key (phase_id) references phase(id) on update cascade on delete restrict,
        foreign key (status_id) references a_status(id) on update cascade on delete restrict
 ) engine = innodb;
 
 
+/* Media files with the same checksum share their tiles, hence, a checksum is tiled by one instance at a time. The instance that tiles a checksum claims it here, and deletes the claim once the tiles are generated. */
+drop table if exists checksum_lease;
+create table checksum_lease (
+       checksum varchar(40) not null, /* sha1 checksum of the media files being tiled */
+       lease_owner varchar(128) not null, /* host and process that claimed the checksum for tiling */
+       lease_expiry datetime not null, /* when the claim expires, unless renewed by the lease owner */
+       primary key (checksum),
+       index (lease_owner)
+) engine = innodb;
+
+
+/* The prepare phase only considers measurements that were recorded after the previous run. The highest measurement id that it has considered so far is recorded here. There is only one watermark, with id 1. */
+drop table if exists prepare_watermark;
+create table prepare_watermark (
+       id tinyint unsigned not null,
+       measurement_id bigint unsigned not null, /* highest measurement id considered by the prepare phase */
+       last_update timestamp not null default current_timestamp on update current_timestamp,
+       primary key (id)
+) engine = innodb;
+
+
 /* For every phase (e.g., download and processing), we wish to record reasons for failure. This is captured here by capturing the runtime Python exceptions. */
 drop table if exists error_logs;
 create table error_logs (
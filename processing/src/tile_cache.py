@@ -0,0 +1,260 @@
+#
+# Copyright 2014 Medical Research Council Harwell.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# @author Gagarine Yaikhom <g.yaikhom@har.mrc.ac.uk>
+#
+
+# DESCRIPTION:
+#
+# Generates the tiles of the scales that were not tiled by the tiling phase (see
+# lazy_scales in phenodcc_media.config) when they are first requested, and keeps
+# them in a cache directory. The manifest of such a tiles set records the scales
+# that are tiled on demand, and the original image that they are tiled from.
+#
+# The tiles of a tile size and scale (a level) are generated together, since the
+# original image must be decoded for any one of them. The cache directory uses
+# the same layout as the tiles directory:
+#
+#     <cache directory>/<checksum path>/<tile size>/<scale>/<tile>.jpg
+#
+# The total size of the levels in the cache is limited, and the least recently
+# used levels are deleted once the limit is reached. The order of use is kept in
+# memory, and the modification time of every level is updated when it is used,
+# so that the order could be restored when the cache is opened again.
+#
+# When several threads request tiles of a level that is not in the cache, only
+# the first thread generates the level, and the others wait for it to finish.
+# The level is generated in a temporary directory, which is renamed once all of
+# its tiles have been written, so that a level in the cache is always complete.
+# The levels that could not be generated are remembered until the cache is opened
+# again, so that requests for their tiles fail without decoding the original again.
+# This is used by tile_server.py.
+
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+
+import image_tiler
+
+DEFAULT_CACHE_MB = 10240
+
+
+class LevelWriter(image_tiler.TileWriter):
+    # Only the tiles of the level are required.
+    def write_thumbnail(self, img):
+        pass
+
+
+def read_file(file_path):
+    try:
+        with open(file_path, 'rb') as f:
+            return f.read()
+    except IOError:
+        return None
+
+
+# Other threads could be creating the same directory.
+def make_directory(path):
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+
+def get_directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, x)) for root, dirs, files in os.walk(path) for x in files)
+
+
+# Generates the tiles of a tile size and scale from the original image.
+# original - The original image file
+# level_path - The directory of the tiles, which must not exist
+# tile_size - Maximum size of the tiles in pixels
+# scale - Scale in percentage
+# memory_limit - If the image requires more memory (in bytes), it is tiled in bands
+#
+# Returns the width and height of the original image, and the grid of tiles and
+# their number of bytes.
+def generate_level(original, level_path, tile_size, scale, memory_limit=None):
+    temp_path = level_path.rstrip('/') + '.' + str(os.getpid()) + '.' + str(threading.current_thread().ident)
+    img, original_size, reader = image_tiler.open_for_tiling(original, [scale], memory_limit)
+    writer = LevelWriter(temp_path + '/')
+    try:
+        if reader:
+            image_tiler.generate_tiles_in_bands(reader, img.size, writer, [tile_size], [scale])
+        else:
+            for scaled_scale, scaled in image_tiler.get_pyramid(img, [scale], original_size=original_size):
+                image_tiler.write_tiles(writer, scaled, tile_size, scaled_scale)
+        os.rename(temp_path + '/' + str(tile_size) + '/' + str(scale), level_path)
+    finally:
+        if reader:
+            reader.close()
+        shutil.rmtree(temp_path, True)
+    return original_size, writer.levels[(tile_size, scale)]
+
+
+class TileCache(object):
+    def __init__(self, cache_dir, max_bytes, memory_limit=None):
+        if not cache_dir.endswith('/'):
+            cache_dir += '/'
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.memory_limit = memory_limit
+        self.lock = threading.Lock()
+        self.levels = OrderedDict()
+        self.num_bytes = 0
+        self.pending = {}
+        self.failed = set()
+        self.num_generated = 0
+        self.num_waits = 0
+        self.generate_secs = 0.0
+        self.load()
+
+    def get_level_path(self, key):
+        checksum_path, tile_size, scale = key
+        return self.cache_dir + checksum_path + str(tile_size) + '/' + str(scale)
+
+    # Find the levels in the cache directory, and order them by their modification
+    # time. Temporary directories of levels that were being generated are deleted.
+    def load(self):
+        levels = []
+        depth = len(self.cache_dir.rstrip('/').split('/'))
+        for root, dirs, files in os.walk(self.cache_dir):
+            names = root.rstrip('/').split('/')
+            if len(names) - depth == 11:
+                for scale in list(dirs):
+                    if scale.isdigit():
+                        path = os.path.join(root, scale)
+                        checksum_path = '/'.join(names[depth:depth + 10]) + '/'
+                        levels.append((os.path.getmtime(path), (checksum_path, int(names[-1]), int(scale)),
+                                       get_directory_size(path)))
+                    else:
+                        shutil.rmtree(os.path.join(root, scale), True)
+                del dirs[:]
+        for mtime, key, num_bytes in sorted(levels):
+            self.levels[key] = num_bytes
+            self.num_bytes += num_bytes
+        self.evict()
+
+    # Delete the least recently used levels until the cache is within its limit.
+    # The most recently used level is always kept.
+    def evict(self):
+        with self.lock:
+            evicted = []
+            while self.num_bytes > self.max_bytes and len(self.levels) > 1:
+                key, num_bytes = self.levels.popitem(last=False)
+                self.num_bytes -= num_bytes
+                evicted.append(key)
+        for key in evicted:
+            shutil.rmtree(self.get_level_path(key), True)
+
+    # Returns True if the level is in the cache, and marks it as the most recently used.
+    def use_level(self, key):
+        with self.lock:
+            num_bytes = self.levels.pop(key, None)
+            if num_bytes is None:
+                return False
+            self.levels[key] = num_bytes
+        try:
+            os.utime(self.get_level_path(key), None)
+        except OSError:
+            pass
+        return True
+
+    # Generates a level, unless another thread is already generating it, in which
+    # case this waits for that thread, or the level has failed before. Returns True
+    # if the level is in the cache.
+    def generate(self, key, original, size):
+        generating = False
+        with self.lock:
+            if key in self.failed:
+                return False
+            event = self.pending.get(key)
+            if event is not None:
+                self.num_waits += 1
+            elif key not in self.levels:
+                event = self.pending[key] = threading.Event()
+                generating = True
+        if not generating:
+            if event is not None:
+                event.wait()
+            return self.use_level(key)
+
+        num_bytes = None
+        try:
+            start_time = time.time()
+            level_path = self.get_level_path(key)
+            if os.path.isdir(level_path):
+                shutil.rmtree(level_path)
+            make_directory(os.path.dirname(level_path))
+            original_size, level = generate_level(original, level_path, key[1], key[2], self.memory_limit)
+            if original_size != size:
+                shutil.rmtree(level_path, True)
+                print 'Original image "' + original + '" does not match the size of its tiles...'
+            else:
+                num_bytes = level['bytes']
+        # Pillow raises other errors than IOError (e.g., TypeError) on corrupt images,
+        # which must fail the request instead of the thread that serves it.
+        except Exception as e:
+            print 'Failed to generate tiles from "' + original + '":', str(e)
+        finally:
+            with self.lock:
+                del self.pending[key]
+                if num_bytes is None:
+                    self.failed.add(key)
+                else:
+                    self.levels[key] = num_bytes
+                    self.num_bytes += num_bytes
+                    self.num_generated += 1
+                    self.generate_secs += time.time() - start_time
+            event.set()
+        if num_bytes is None:
+            return False
+        self.evict()
+        return True
+
+    # Returns the JPEG data of a tile of a scale that is tiled on demand, or None if
+    # the tile does not exist, or the scale is not tiled on demand.
+    # tiles_path - Directory that contains the tiles set
+    # checksum_path - Path of the tiles set relative to the tiles directory
+    def get_tile(self, tiles_path, checksum_path, tile_size, scale, num_cols, num_rows, row, col):
+        key = (checksum_path, tile_size, scale)
+        tile_name = '/' + image_tiler.get_tile_name(num_cols, num_rows, row, col)
+        if self.use_level(key):
+            data = read_file(self.get_level_path(key) + tile_name)
+            if data is not None:
+                return data
+
+        manifest = image_tiler.read_manifest(tiles_path)
+        lazy = manifest and manifest.get('lazy')
+        if not lazy or tile_size not in lazy['tile_sizes'] or scale not in lazy['scales']:
+            return None
+        size = (manifest['width'], manifest['height'])
+        if image_tiler.get_tile_grid(image_tiler.get_scaled_size(size, scale), tile_size) != (num_cols, num_rows):
+            return None
+        if not self.generate(key, lazy['original'], size):
+            return None
+        return read_file(self.get_level_path(key) + tile_name)
+
+    def summary(self):
+        msg = str(len(self.levels)) + ' levels (' + '%.1f' % (self.num_bytes / 1048576.0) + \
+            ' MB) in the cache; ' + str(self.num_generated) + ' levels generated'
+        if self.num_generated > 0:
+            msg += ' in ' + '%.1f' % (self.generate_secs * 1000.0 / self.num_generated) + ' ms on average'
+        return msg + ', ' + str(len(self.failed)) + ' levels failed, ' + str(self.num_waits) + \
+            ' requests waited for a level being generated'
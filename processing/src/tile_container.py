@@ -0,0 +1,304 @@
+#! /usr/bin/python
+#
+# Copyright 2014 Medical Research Council Harwell.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# @author Gagarine Yaikhom <g.yaikhom@har.mrc.ac.uk>
+#
+
+# DESCRIPTION:
+#
+# Stores all of the tiles of an image in a single container file (tiles.pack),
+# instead of one file for every tile, every scale and every tile size. This cuts
+# the number of files in the tiles directory by two orders of magnitude, which
+# makes backups, scans of the tiles directory and deleting tiles much faster.
+# The thumbnail and the manifest are still stored as files next to the
+# container, and the manifest records that the tiles are in the container.
+#
+# The container contains the JPEG data of the tiles, followed by an index, and a
+# trailer at the end of the file:
+#
+#     tiles - The JPEG files of the tiles, one after the other
+#     levels - For every tile size and scale: tile size, scale, columns, rows
+#     offsets - For every tile of every level, in the order of the levels, and
+#               by row and column: offset and length of the JPEG data
+#     trailer - "PDCCPACK", version, number of levels, offset of the levels
+#
+# All numbers are unsigned little-endian integers. A tile that is missing (e.g.,
+# a uniform tile that is only recorded in the manifest) has length zero. Once the
+# index is read, any tile is read with one seek.
+#
+# When run as a script, the tiles sets of the supplied checksums, or of every
+# checksum in the tiles directory, are converted from directories to containers.
+
+import os
+import shutil
+import struct
+import sys
+import time
+from cStringIO import StringIO
+
+import image_tiler
+import tile_index
+
+CONTAINER_FILE = 'tiles.pack'
+CONTAINER_MAGIC = 'PDCCPACK'
+CONTAINER_VERSION = 1
+
+# magic, version, number of levels, offset of the levels
+TRAILER = struct.Struct('<8sIIQ')
+
+# tile size, scale, columns, rows
+LEVEL = struct.Struct('<IIII')
+
+# offset, length
+OFFSET = struct.Struct('<QI')
+
+
+class InvalidContainer(Exception):
+    pass
+
+
+def get_container_path(tiles_path):
+    return os.path.join(tiles_path, CONTAINER_FILE)
+
+
+def has_container(tiles_path):
+    return os.path.isfile(get_container_path(tiles_path))
+
+
+# Writes the tiles to a temporary file, which is renamed once the index has been
+# written, so that a container that exists is always complete.
+class ContainerWriter(object):
+    def __init__(self, container_path):
+        self.container_path = container_path
+        self.f = open(container_path + '.tmp', 'wb')
+        self.levels = {}
+
+    def add_level(self, tile_size, scale, num_cols, num_rows):
+        level = self.levels.get((tile_size, scale))
+        if level is None:
+            level = self.levels[(tile_size, scale)] = (num_cols, num_rows, [None] * (num_cols * num_rows))
+        return level
+
+    def add_tile(self, tile_size, scale, num_cols, num_rows, row, col, data):
+        level = self.add_level(tile_size, scale, num_cols, num_rows)
+        level[2][row * num_cols + col] = (self.f.tell(), len(data))
+        self.f.write(data)
+
+    # Write the index and the trailer, and rename the container.
+    def close(self):
+        if self.f.closed:
+            return
+        index_offset = self.f.tell()
+        levels = sorted(self.levels.items(), key=lambda x: (x[0][0], -x[0][1]))
+        for (tile_size, scale), (num_cols, num_rows, offsets) in levels:
+            self.f.write(LEVEL.pack(tile_size, scale, num_cols, num_rows))
+        for key, (num_cols, num_rows, offsets) in levels:
+            self.f.write(''.join(OFFSET.pack(*(x or (0, 0))) for x in offsets))
+        self.f.write(TRAILER.pack(CONTAINER_MAGIC, CONTAINER_VERSION, len(levels), index_offset))
+        self.f.close()
+        os.rename(self.container_path + '.tmp', self.container_path)
+
+    # Delete the temporary file of a container that was not completed.
+    def abort(self):
+        if not self.f.closed:
+            self.f.close()
+            os.remove(self.container_path + '.tmp')
+
+
+# Reads tiles from a container. The index is read when the container is opened,
+# hence, every tile is then read with a single seek. Since the file position is
+# shared, a reader must not be used by several threads at the same time.
+class ContainerReader(object):
+    def __init__(self, container_path):
+        self.f = open(container_path, 'rb')
+        try:
+            self.f.seek(0, os.SEEK_END)
+            file_size = self.f.tell()
+            if file_size < TRAILER.size:
+                raise InvalidContainer('Container "' + container_path + '" is truncated')
+            self.f.seek(file_size - TRAILER.size)
+            magic, version, num_levels, index_offset = TRAILER.unpack(self.f.read(TRAILER.size))
+            if magic != CONTAINER_MAGIC or version != CONTAINER_VERSION or \
+                    index_offset + num_levels * LEVEL.size > file_size - TRAILER.size:
+                raise InvalidContainer('Container "' + container_path + '" is not valid')
+            self.f.seek(index_offset)
+            self.index = self.f.read(file_size - TRAILER.size - index_offset)
+        except:
+            self.f.close()
+            raise
+        self.data_size = index_offset
+
+        # The position of the offsets of every level in the index
+        self.levels = {}
+        position = num_levels * LEVEL.size
+        for i in range(num_levels):
+            tile_size, scale, num_cols, num_rows = LEVEL.unpack_from(self.index, i * LEVEL.size)
+            self.levels[(tile_size, scale)] = (num_cols, num_rows, position)
+            position += num_cols * num_rows * OFFSET.size
+        if position != len(self.index):
+            self.f.close()
+            raise InvalidContainer('Index of container "' + container_path + '" is not valid')
+
+    # Returns the number of columns and rows of tiles, or None if there are no tiles
+    # for the supplied tile size and scale.
+    def get_grid(self, tile_size, scale):
+        level = self.levels.get((tile_size, scale))
+        if level is None:
+            return None
+        return level[0], level[1]
+
+    # Returns the offset and length of a tile, or None if the tile does not exist.
+    def get_offset(self, tile_size, scale, row, col):
+        level = self.levels.get((tile_size, scale))
+        if level is None or row < 0 or col < 0 or row >= level[1] or col >= level[0]:
+            return None
+        offset, length = OFFSET.unpack_from(self.index, level[2] + (row * level[0] + col) * OFFSET.size)
+        if length == 0 or offset + length > self.data_size:
+            return None
+        return offset, length
+
+    # Returns the JPEG data of a tile, or None if the tile does not exist.
+    def read_tile(self, tile_size, scale, row, col):
+        offset = self.get_offset(tile_size, scale, row, col)
+        if offset is None:
+            return None
+        self.f.seek(offset[0])
+        return self.f.read(offset[1])
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# Writes the tiles of an image to a container, instead of a file for every tile.
+# This is used by image_tiler.generate_tiles() in place of TileWriter.
+class ContainerTileWriter(image_tiler.TileWriter):
+    def __init__(self, tiles_path, lazy=None, uniform_tolerance=None):
+        image_tiler.TileWriter.__init__(self, tiles_path, lazy, uniform_tolerance)
+        self.container = ContainerWriter(get_container_path(tiles_path))
+
+    def write_tile(self, tile_size, scale, num_cols, num_rows, row, col, img):
+        level = self.levels.get((tile_size, scale))
+        if level is None:
+            level = self.levels[(tile_size, scale)] = image_tiler.create_manifest_level(tile_size, scale,
+                                                                                        num_cols, num_rows)
+            # The grid is recorded, even if every tile of the level is uniform.
+            self.container.add_level(tile_size, scale, num_cols, num_rows)
+        if self.add_uniform_tile(level, row, col, img):
+            return
+        buf = StringIO()
+        img.save(buf, 'JPEG', quality=image_tiler.JPEG_QUALITY)
+        self.container.add_tile(tile_size, scale, num_cols, num_rows, row, col, buf.getvalue())
+        level['bytes'] += buf.tell()
+        level['tiles'] += 1
+        self.num_tiles += 1
+
+    # The container is completed before the manifest is written.
+    def write_manifest(self, size):
+        self.container.close()
+        manifest = self.create_manifest(size)
+        manifest['container'] = CONTAINER_FILE
+        image_tiler.write_manifest(self.tiles_path, manifest)
+
+    def close(self):
+        self.container.abort()
+
+
+# Converts the tiles set of an image from a directory for every tile size and scale
+# to a container. The manifest is updated once the container is complete, and the
+# directories are then deleted. Tiles sets without a manifest are not converted,
+# since the manifest records the size of the image.
+#
+# Returns the number of tiles in the container, or None if the tiles set was not
+# converted.
+def convert_directory(tiles_path):
+    manifest = image_tiler.read_manifest(tiles_path)
+    if manifest is None or manifest.get('container'):
+        return None
+    tile_size_dirs = [x for x in os.listdir(tiles_path)
+                      if x.isdigit() and os.path.isdir(os.path.join(tiles_path, x))]
+    writer = ContainerWriter(get_container_path(tiles_path))
+    num_tiles = 0
+    try:
+        # The grid is recorded, even if every tile of the level is uniform.
+        for level in manifest['levels']:
+            writer.add_level(level['tile_size'], level['scale'], level['columns'], level['rows'])
+        for tile_size in tile_size_dirs:
+            for scale in os.listdir(os.path.join(tiles_path, tile_size)):
+                scale_path = os.path.join(tiles_path, tile_size, scale)
+                if not scale.isdigit() or not os.path.isdir(scale_path):
+                    continue
+                for tile in os.listdir(scale_path):
+                    if image_tiler.TILE_NAME_PATTERN.match(tile) is None:
+                        continue
+                    num_cols, num_rows, row, col = [int(x) for x in tile.split('.')[0].split('_')]
+                    with open(os.path.join(scale_path, tile), 'rb') as f:
+                        writer.add_tile(int(tile_size), int(scale), num_cols, num_rows, row, col, f.read())
+                    num_tiles += 1
+        writer.close()
+    finally:
+        writer.abort()
+    manifest['container'] = CONTAINER_FILE
+    image_tiler.write_manifest(tiles_path, manifest)
+    for tile_size in tile_size_dirs:
+        shutil.rmtree(os.path.join(tiles_path, tile_size))
+    return num_tiles
+
+
+def print_usage():
+    print 'Usage:'
+    print '    tile_container.py <tiles directory> [checksum ...]'
+    print ''
+    print ' Converts the tiles sets of the supplied checksums, or of every checksum in the'
+    print ' tiles directory, from a directory for every tile size and scale to a container.'
+
+
+def main(argv):
+    if len(argv) < 1 or not os.path.isdir(argv[0]):
+        print_usage()
+        sys.exit(1)
+
+    tiles_dir = argv[0]
+    checksums = argv[1:]
+    if len(checksums) == 0:
+        stats = tile_index.ScanStats()
+        checksums = sorted(tile_index.TileIndex(tiles_dir).scan(stats))
+        print stats.summary(len(checksums))
+
+    start_time = time.time()
+    num_converted = num_tiles = 0
+    for checksum in checksums:
+        tiles_path = image_tiler.get_tiles_path(tiles_dir, checksum)
+        try:
+            converted = convert_directory(tiles_path)
+        except (IOError, OSError) as e:
+            print 'Failed to convert tiles set "' + tiles_path + '":', str(e)
+            continue
+        if converted is not None:
+            num_converted += 1
+            num_tiles += converted
+    print 'Converted ' + str(num_converted) + ' of ' + str(len(checksums)) + ' tiles sets (' + \
+          str(num_tiles) + ' tiles) in ' + '%.2f' % (time.time() - start_time) + ' seconds'
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,376 @@
+#! /usr/bin/python
+#
+# Copyright 2014 Medical Research Council Harwell.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# @author Gagarine Yaikhom <g.yaikhom@har.mrc.ac.uk>
+#
+
+# DESCRIPTION:
+#
+# Generates the tiles of an image as a Deep Zoom (DZI) pyramid, instead of the
+# scales in percentage (see image_scales in phenodcc_media.config). Every level
+# of the pyramid is half the width and height of the next larger level, down to
+# a single pixel, hence, the pyramid needs a third of the pixels of the original
+# image in addition to the original, and the levels are understood by standard
+# tiled image viewers (e.g., OpenSeadragon) and by any static file server:
+#
+#     <checksum path>/image.dzi - The descriptor of the image
+#     <checksum path>/image_files/<level>/<column>_<row>.jpg - Tiles
+#
+# where level 0 is a single pixel, and the largest level is the original image.
+# The tiles do not overlap. The thumbnail and the manifest are stored as usual,
+# and the manifest records the grid of every level of the pyramid.
+#
+# When run as a script, the tiles sets of the supplied checksums, or of every
+# checksum in the tiles directory, are converted from scales to a Deep Zoom
+# pyramid. The pyramid is generated, band by band, from the tiles of the 100%
+# scale (in a directory or a container), hence, the original images are not
+# required. The scales are kept for the existing viewer, unless -d is supplied.
+
+import getopt
+import os
+import shutil
+import sys
+import time
+from cStringIO import StringIO
+
+from PIL import Image
+
+import image_tiler
+import tile_container
+import tile_index
+
+DEEPZOOM_DESCRIPTOR = 'image.dzi'
+DEEPZOOM_FILES = 'image_files'
+DEEPZOOM_NAMESPACE = 'http://schemas.microsoft.com/deepzoom/2008'
+DEEPZOOM_OVERLAP = 0
+DEFAULT_TILE_SIZE = 256
+
+
+def get_files_path(tiles_path):
+    return tiles_path + DEEPZOOM_FILES + '/'
+
+
+def get_tile_name(col, row):
+    return str(col) + '_' + str(row) + '.' + image_tiler.PREFERRED_FORMAT
+
+
+# Returns the (level, width and height) of every level of the pyramid, from the
+# original image down to a single pixel. Level n is the original image divided
+# by 2^(max level - n), rounded up.
+def get_levels(size):
+    max_level = (max(size) - 1).bit_length()
+    return [(level, (-(-size[0] >> (max_level - level)), -(-size[1] >> (max_level - level))))
+            for level in range(max_level, -1, -1)]
+
+
+# Returns the (level, columns, rows) of the tile grid of every level.
+def get_grids(size, tile_size):
+    return [(level, ) + image_tiler.get_tile_grid(level_size, tile_size) for level, level_size in get_levels(size)]
+
+
+def create_descriptor(size, tile_size):
+    return '<?xml version="1.0" encoding="UTF-8"?>\n' + \
+           '<Image xmlns="' + DEEPZOOM_NAMESPACE + '" Format="' + image_tiler.PREFERRED_FORMAT + \
+           '" Overlap="' + str(DEEPZOOM_OVERLAP) + '" TileSize="' + str(tile_size) + '">\n' + \
+           '  <Size Width="' + str(size[0]) + '" Height="' + str(size[1]) + '"/>\n' + \
+           '</Image>\n'
+
+
+# Write the descriptor to a temporary file, and rename it, so that a descriptor
+# that exists is always complete.
+def write_descriptor(tiles_path, size, tile_size):
+    descriptor_path = tiles_path + DEEPZOOM_DESCRIPTOR
+    with open(descriptor_path + '.tmp', 'w') as f:
+        f.write(create_descriptor(size, tile_size))
+    os.rename(descriptor_path + '.tmp', descriptor_path)
+
+
+# Writes the tiles of every level of the pyramid into the files directory, which
+# could be a temporary directory that is renamed once the pyramid is complete.
+# The tiles are written by image_tiler.write_tiles() and PyramidLevel with the
+# level in place of the scale.
+class DeepZoomWriter(image_tiler.TileWriter):
+    def __init__(self, tiles_path, files_path=None):
+        image_tiler.TileWriter.__init__(self, tiles_path)
+        self.files_path = files_path or get_files_path(tiles_path)
+        self.tile_size = None
+
+    def write_tile(self, tile_size, level, num_cols, num_rows, row, col, img):
+        path = self.files_path + str(level) + '/'
+        entry = self.levels.get(level)
+        if entry is None:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            entry = self.levels[level] = {'level': level, 'columns': num_cols, 'rows': num_rows,
+                                          'tiles': 0, 'bytes': 0}
+            self.tile_size = tile_size
+        entry['bytes'] += self.save(img, path + get_tile_name(col, row))
+        entry['tiles'] += 1
+        self.num_tiles += 1
+
+    # The pyramid that is recorded in the manifest.
+    def get_pyramid(self):
+        return {'descriptor': DEEPZOOM_DESCRIPTOR, 'files': DEEPZOOM_FILES, 'tile_size': self.tile_size,
+                'overlap': DEEPZOOM_OVERLAP, 'levels': sorted(self.levels.values(), key=lambda x: -x['level'])}
+
+    # A tiles set that only has the pyramid has no scales.
+    def create_manifest(self, size):
+        manifest = image_tiler.create_manifest(size, 'pillow', image_tiler.JPEG_QUALITY, self.thumbnail, [])
+        manifest['pyramid'] = 'deepzoom'
+        manifest['deepzoom'] = self.get_pyramid()
+        return manifest
+
+    # The descriptor is written once all of the tiles were written.
+    def write_manifest(self, size):
+        write_descriptor(self.tiles_path, size, self.tile_size)
+        image_tiler.TileWriter.write_manifest(self, size)
+
+
+# Generate the thumbnail and the tiles of every level from an image in memory.
+# Every level is resampled from the next larger level, and the thumbnail from
+# the smallest level that is still wider than it.
+def generate_pyramid(img, writer, tile_size):
+    scaled = img
+    thumbnail_source = img
+    for level, size in get_levels(img.size):
+        if scaled.size != size:
+            scaled = scaled.resize(size, Image.LANCZOS)
+        image_tiler.write_tiles(writer, scaled, tile_size, level)
+        if size[0] >= image_tiler.THUMBNAIL_WIDTH:
+            thumbnail_source = scaled
+    writer.write_thumbnail(thumbnail_source.resize(image_tiler.get_thumbnail_size(img.size), Image.LANCZOS))
+
+
+# Generate the tiles of every level from an image in horizontal bands, as done by
+# image_tiler.generate_tiles_in_bands() for the scales. The thumbnail is only
+# generated if required.
+def generate_pyramid_in_bands(reader, size, writer, tile_size, with_thumbnail=True):
+    levels = get_levels(size)
+    original = image_tiler.PyramidLevel(levels[0][0], size, None, [tile_size])
+    previous = original
+    thumbnail_source = original
+    for level, level_size in levels[1:]:
+        previous = image_tiler.PyramidLevel(level, level_size, previous, [tile_size])
+        if level_size[0] >= image_tiler.THUMBNAIL_WIDTH:
+            thumbnail_source = previous
+    thumbnail = None
+    if with_thumbnail:
+        thumbnail_size = image_tiler.get_thumbnail_size(size)
+        thumbnail = image_tiler.PyramidLevel(None, thumbnail_size, thumbnail_source, [], True)
+
+    for y in range(0, size[1], image_tiler.BAND_ROWS):
+        original.append(reader.read(y, min(y + image_tiler.BAND_ROWS, size[1])), writer)
+    if thumbnail is not None:
+        writer.write_thumbnail(thumbnail.rows)
+
+
+# Generate the thumbnail and the Deep Zoom pyramid of an image.
+#
+# image_file - The original image file
+# tiles_dir - Root directory for all of the tiles
+# checksum - SHA1 checksum of the original image file
+# tile_size - Maximum size of the tiles in pixels
+# memory_limit - If the image requires more memory (in bytes), it is tiled in bands
+#
+# Any existing tiles for the image are deleted. Returns the width and height
+# of the original image.
+def generate_tiles(image_file, tiles_dir, checksum, tile_size, memory_limit=None):
+    img, original_size, reader = image_tiler.open_for_tiling(image_file, [100], memory_limit)
+    tiles_path = image_tiler.get_tiles_path(tiles_dir, checksum)
+    if os.path.isdir(tiles_path):
+        print 'Tiles directory "' + tiles_path + '" exists... will delete and redo tiling'
+        shutil.rmtree(tiles_path)
+    print 'Processing "' + image_file + '"...'
+    os.makedirs(tiles_path)
+
+    writer = DeepZoomWriter(tiles_path)
+    try:
+        if reader:
+            print 'Tiling "' + image_file + '" in bands of ' + str(image_tiler.BAND_ROWS) + ' rows...'
+            generate_pyramid_in_bands(reader, original_size, writer, tile_size)
+        else:
+            generate_pyramid(img, writer, tile_size)
+        writer.write_manifest(original_size)
+    finally:
+        if reader:
+            reader.close()
+        writer.close()
+    return original_size
+
+
+# Reads the 100% scale of a tiles set in horizontal bands by decoding its tiles,
+# from their directory or from the container. Uniform tiles that are recorded in
+# the manifest are filled with their colour. Only one row of tiles is decoded at
+# a time.
+class TileBandReader(object):
+    def __init__(self, tiles_path, manifest, tile_size):
+        self.size = (manifest['width'], manifest['height'])
+        self.tile_size = tile_size
+        self.num_cols, self.num_rows = image_tiler.get_tile_grid(self.size, tile_size)
+        self.path = tiles_path + str(tile_size) + '/100/'
+        self.uniform = image_tiler.get_uniform_tiles(manifest)
+        self.container = None
+        if manifest.get('container'):
+            self.container = tile_container.ContainerReader(tile_container.get_container_path(tiles_path))
+        self.row = None
+        self.strip = None
+
+    def read_tile(self, row, col):
+        colour = self.uniform.get((self.tile_size, 100, row, col))
+        if colour is not None:
+            size = image_tiler.get_tile_size(self.size, self.tile_size, row, col)
+            if len(colour) == 1:
+                return Image.new('L', size, colour[0])
+            return Image.new('RGB', size, tuple(colour))
+        if self.container:
+            data = self.container.read_tile(self.tile_size, 100, row, col)
+        else:
+            tile_name = image_tiler.get_tile_name(self.num_cols, self.num_rows, row, col)
+            try:
+                with open(self.path + tile_name, 'rb') as f:
+                    data = f.read()
+            except IOError:
+                data = None
+        if data is None:
+            raise IOError('Tile ' + str(row) + ', ' + str(col) + ' of the 100% scale is missing')
+        return Image.open(StringIO(data))
+
+    # Returns the row of tiles as a single image.
+    def read_row(self, row):
+        if self.row != row:
+            tiles = [image_tiler.to_jpeg_mode(self.read_tile(row, col)) for col in range(self.num_cols)]
+            strip = Image.new(tiles[0].mode, (self.size[0], tiles[0].size[1]))
+            for col, tile in enumerate(tiles):
+                strip.paste(tile, (col * self.tile_size, 0))
+            self.row = row
+            self.strip = strip
+        return self.strip
+
+    # Returns rows [y0, y1) of the image.
+    def read(self, y0, y1):
+        band = None
+        for row in range(y0 // self.tile_size, (y1 - 1) // self.tile_size + 1):
+            strip = self.read_row(row)
+            top = row * self.tile_size
+            part = strip.crop((0, max(y0, top) - top, self.size[0], min(y1, top + strip.size[1]) - top))
+            if band is None:
+                band = Image.new(strip.mode, (self.size[0], y1 - y0))
+            band.paste(part, (0, max(y0, top) - y0))
+        return band
+
+    def close(self):
+        if self.container:
+            self.container.close()
+
+
+# Generates the Deep Zoom pyramid of a tiles set from its tiles of the 100% scale.
+# The manifest is updated once the pyramid is complete. If the scales are deleted,
+# the tiles set only has the pyramid, and the scales that are tiled on demand are
+# no longer recorded. Tiles sets without a manifest, or without the tiles of the
+# 100% scale (e.g., if the 100% scale is tiled on demand), are not converted.
+#
+# Returns the number of tiles in the pyramid, or None if the tiles set was not
+# converted.
+def convert_tile_set(tiles_path, tile_size, delete_scales=False):
+    manifest = image_tiler.read_manifest(tiles_path)
+    if manifest is None or manifest.get('deepzoom') or \
+            image_tiler.get_manifest_level(manifest, tile_size, 100) is None:
+        return None
+    size = (manifest['width'], manifest['height'])
+    files_path = get_files_path(tiles_path)
+    temp_path = files_path.rstrip('/') + '.tmp/'
+    shutil.rmtree(temp_path, True)
+    reader = TileBandReader(tiles_path, manifest, tile_size)
+    writer = DeepZoomWriter(tiles_path, temp_path)
+    try:
+        generate_pyramid_in_bands(reader, size, writer, tile_size, False)
+        shutil.rmtree(files_path, True)
+        os.rename(temp_path, files_path)
+    finally:
+        reader.close()
+        shutil.rmtree(temp_path, True)
+    write_descriptor(tiles_path, size, tile_size)
+
+    manifest['deepzoom'] = writer.get_pyramid()
+    if delete_scales:
+        manifest['pyramid'] = 'deepzoom'
+        manifest['levels'] = []
+        manifest.pop('container', None)
+        manifest.pop('lazy', None)
+    image_tiler.write_manifest(tiles_path, manifest)
+    if delete_scales:
+        for name in os.listdir(tiles_path):
+            if name.isdigit() and os.path.isdir(os.path.join(tiles_path, name)):
+                shutil.rmtree(os.path.join(tiles_path, name))
+        if tile_container.has_container(tiles_path):
+            os.remove(tile_container.get_container_path(tiles_path))
+    return writer.num_tiles
+
+
+def print_usage():
+    print 'Usage:'
+    print '    tile_deepzoom.py [-d] [-t <tile size>] <tiles directory> [checksum ...]'
+    print ''
+    print ' Converts the tiles sets of the supplied checksums, or of every checksum in the'
+    print ' tiles directory, from scales to a Deep Zoom pyramid.'
+    print ''
+    print ' -d - Delete the scales once the pyramid is complete.'
+    print ' -t - Tile size of the 100% scale and of the pyramid (default ' + str(DEFAULT_TILE_SIZE) + ').'
+
+
+def main(argv):
+    delete_scales = False
+    tile_size = DEFAULT_TILE_SIZE
+    try:
+        opts, args = getopt.getopt(argv, "dt:")
+        for opt, arg in opts:
+            if opt == '-d':
+                delete_scales = True
+            elif opt == '-t':
+                tile_size = int(arg)
+    except (getopt.GetoptError, ValueError):
+        print_usage()
+        sys.exit(2)
+    if len(args) < 1 or not os.path.isdir(args[0]):
+        print_usage()
+        sys.exit(1)
+
+    tiles_dir = args[0]
+    checksums = args[1:]
+    if len(checksums) == 0:
+        stats = tile_index.ScanStats()
+        checksums = sorted(tile_index.TileIndex(tiles_dir).scan(stats))
+        print stats.summary(len(checksums))
+
+    start_time = time.time()
+    num_converted = num_tiles = 0
+    for checksum in checksums:
+        tiles_path = image_tiler.get_tiles_path(tiles_dir, checksum)
+        try:
+            converted = convert_tile_set(tiles_path, tile_size, delete_scales)
+        except (IOError, OSError, tile_container.InvalidContainer) as e:
+            print 'Failed to convert tiles set "' + tiles_path + '":', str(e)
+            continue
+        if converted is not None:
+            num_converted += 1
+            num_tiles += converted
+    print 'Converted ' + str(num_converted) + ' of ' + str(len(checksums)) + ' tiles sets (' + \
+          str(num_tiles) + ' tiles) in ' + '%.2f' % (time.time() - start_time) + ' seconds'
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,236 @@
+#
+# Copyright 2014 Medical Research Council Harwell.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# @author Gagarine Yaikhom <g.yaikhom@har.mrc.ac.uk>
+#
+
+# DESCRIPTION:
+#
+# Finds the checksums that have a complete tiles set, by scanning the tiles
+# directory once with a pool of threads, instead of checking the tiles of
+# every media file. The tiles of a checksum are stored in a directory that
+# is 10 levels deep, where every directory name contains four characters.
+#
+# The result of the scan is saved in the tiles directory, together with the
+# modification times of the directories in the first level, and of the tiles
+# directory of every checksum. The next scan only walks the subtrees that were
+# added since, and lists the tiles directory of a checksum again only if its
+# modification time has changed. Since a checksum added below a subtree that
+# already existed is not found, these are checked by the caller directly.
+
+import os
+import re
+import time
+from multiprocessing.pool import ThreadPool
+
+import image_tiler
+
+INDEX_FILE = 'tile_index.txt'
+INDEX_VERSION = '1'
+DEFAULT_WORKERS = 8
+
+# Number of first level directories that are scanned by a thread in one task.
+DIRECTORIES_PER_TASK = 64
+
+# The checksum is decomposed into 10 directory names of four characters.
+DIRECTORY_NAME_LENGTH = 4
+DIRECTORY_LEVELS = 10
+
+DIRECTORY_NAME_PATTERN = re.compile(r'^[0-9a-f]{4}$')
+
+
+# A directory is only trusted if it was not modified within a second of the
+# previous scan, since the modification time may not change if it is modified
+# again within the resolution of the file system timestamps.
+def is_unchanged(mtime, indexed_mtime, scan_time):
+    return indexed_mtime is not None and mtime == indexed_mtime and mtime < scan_time - 1
+
+
+# Relative path of the first and second level directories that contain the
+# tiles directory of a checksum, e.g., "b5ea" and "b5ea/f562".
+def get_indexed_directories(checksum):
+    return checksum[:DIRECTORY_NAME_LENGTH], \
+        checksum[:DIRECTORY_NAME_LENGTH] + '/' + checksum[DIRECTORY_NAME_LENGTH:2 * DIRECTORY_NAME_LENGTH]
+
+
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def list_directories(path):
+    try:
+        return [x for x in os.listdir(path) if DIRECTORY_NAME_PATTERN.match(x)]
+    except OSError:
+        return []
+
+
+# The tiles set is complete if the manifest exists, or the thumbnail for tiles
+# generated before manifests were introduced, since these are written last.
+def has_tiles(names):
+    return image_tiler.MANIFEST_FILE in names or 'thumbnail.' + image_tiler.PREFERRED_FORMAT in names
+
+
+class ScanStats(object):
+    def __init__(self):
+        self.start_time = time.time()
+        self.num_listed = 0
+        self.num_checked = 0
+
+    def add(self, other):
+        self.num_listed += other.num_listed
+        self.num_checked += other.num_checked
+
+    def summary(self, num_complete):
+        return 'Found ' + str(num_complete) + ' complete tiles sets in ' + \
+               '%.2f' % (time.time() - self.start_time) + ' seconds (listed ' + \
+               str(self.num_listed) + ' directories, checked ' + str(self.num_checked) + ' tiles sets)'
+
+
+# Index of the checksums that have a complete tiles set.
+#
+# directories - Modification time of directories in the first level, by name
+# checksums - (modification time, complete) of the tiles directory, by checksum
+class TileIndex(object):
+    def __init__(self, tiles_dir):
+        if not tiles_dir.endswith('/'):
+            tiles_dir += '/'
+        self.tiles_dir = tiles_dir
+        self.scan_time = 0
+        self.directories = {}
+        self.checksums = {}
+        self.indexed_entries = {}
+
+    def get_index_path(self):
+        return self.tiles_dir + INDEX_FILE
+
+    # Load the index saved by the previous scan. An index that could not be read
+    # is ignored, in which case the entire tiles directory is scanned.
+    def load(self):
+        try:
+            with open(self.get_index_path()) as f:
+                header = f.readline().split()
+                if len(header) != 2 or header[0] != INDEX_VERSION:
+                    return False
+                scan_time = float(header[1])
+                directories = {}
+                checksums = {}
+                for line in f:
+                    name, mtime, complete = line.split()
+                    if complete == '-':
+                        directories[name] = float(mtime)
+                    else:
+                        checksums[name] = (float(mtime), complete == '1')
+        except (IOError, ValueError):
+            return False
+        self.scan_time = scan_time
+        self.directories = directories
+        self.checksums = checksums
+        return True
+
+    # Save the index to a temporary file, and rename it, so that a partially
+    # written index is never loaded.
+    def save(self):
+        index_path = self.get_index_path()
+        with open(index_path + '.tmp', 'w') as f:
+            f.write(INDEX_VERSION + ' ' + repr(self.scan_time) + '\n')
+            for name in sorted(self.directories):
+                f.write(name + ' ' + repr(self.directories[name]) + ' -\n')
+            for checksum in sorted(self.checksums):
+                mtime, complete = self.checksums[checksum]
+                f.write(checksum + ' ' + repr(mtime) + (' 1\n' if complete else ' 0\n'))
+        os.rename(index_path + '.tmp', index_path)
+
+    # Scans the tiles directory, and returns the set of checksums with a complete
+    # tiles set. Every directory in the first level is scanned by a thread.
+    def scan(self, stats, workers=DEFAULT_WORKERS):
+        scan_time = time.time()
+        directories = {}
+        checksums = {}
+
+        # The checksums in every second level directory from the previous scan
+        self.indexed_entries = {}
+        for checksum in self.checksums:
+            top, second = get_indexed_directories(checksum)
+            self.indexed_entries.setdefault(top, {}).setdefault(second, []).append(checksum)
+
+        pool = ThreadPool(workers)
+        try:
+            for scanned_directories, scanned_checksums, scanned_stats in pool.imap_unordered(
+                    self.scan_top_level, list_directories(self.tiles_dir), DIRECTORIES_PER_TASK):
+                directories.update(scanned_directories)
+                checksums.update(scanned_checksums)
+                stats.add(scanned_stats)
+            pool.close()
+            pool.join()
+        finally:
+            pool.terminate()
+        stats.num_listed += 1
+        self.scan_time = scan_time
+        self.directories = directories
+        self.checksums = checksums
+        return set(checksum for checksum, (mtime, complete) in checksums.items() if complete)
+
+    # Scans a directory in the first level. If the directory has not changed,
+    # the checksums from the previous scan are checked instead of listing it.
+    # Otherwise, only the subtrees that were not indexed are walked.
+    def scan_top_level(self, name):
+        directories = {}
+        checksums = {}
+        stats = ScanStats()
+        mtime = get_mtime(self.tiles_dir + name)
+        if mtime is None:
+            return directories, checksums, stats
+        directories[name] = mtime
+        indexed = self.indexed_entries.get(name, {})
+        if is_unchanged(mtime, self.directories.get(name), self.scan_time):
+            subdirectories = indexed.keys()
+        else:
+            stats.num_listed += 1
+            subdirectories = [name + '/' + x for x in list_directories(self.tiles_dir + name)]
+        for relative_path in subdirectories:
+            if relative_path in indexed:
+                for checksum in indexed[relative_path]:
+                    self.check_tiles(checksum, checksums, stats)
+            else:
+                self.walk_directory(relative_path, 2, checksums, stats)
+        return directories, checksums, stats
+
+    # Walks a directory below the first levels, to find the tiles directories.
+    def walk_directory(self, relative_path, level, checksums, stats):
+        if level == DIRECTORY_LEVELS:
+            self.check_tiles(relative_path.replace('/', ''), checksums, stats)
+            return
+        stats.num_listed += 1
+        for name in list_directories(self.tiles_dir + relative_path):
+            self.walk_directory(relative_path + '/' + name, level + 1, checksums, stats)
+
+    # Checks the tiles directory of a checksum, unless it has not changed.
+    def check_tiles(self, checksum, checksums, stats):
+        tiles_path = image_tiler.get_tiles_path(self.tiles_dir, checksum)
+        mtime = get_mtime(tiles_path)
+        if mtime is None:
+            return
+        indexed_mtime, complete = self.checksums.get(checksum, (None, False))
+        if not is_unchanged(mtime, indexed_mtime, self.scan_time):
+            stats.num_checked += 1
+            try:
+                complete = has_tiles(os.listdir(tiles_path))
+            except OSError:
+                return
+        checksums[checksum] = (mtime, complete)
@@ -0,0 +1,432 @@
+#! /usr/bin/python
+#
+# Copyright 2014 Medical Research Council Harwell.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# @author Gagarine Yaikhom <g.yaikhom@har.mrc.ac.uk>
+#
+
+# DESCRIPTION:
+#
+# Serves the tiles and thumbnails in the tiles directory over HTTP, using the
+# same paths as the tiles directory, so that the image viewer could use it in
+# place of a static file server, e.g.:
+#
+#     /b5ea/f562/.../256/100/16_12_3_7.jpg
+#     /b5ea/f562/.../thumbnail.jpg
+#
+# Tiles are read from their files, or from the container of the image (see
+# tile_container.py). Since the tiles are addressed by the SHA1 checksum of the
+# original image, they never change. Hence, the most recently used tiles are
+# kept in memory, up to a limit on their total size, and every tile is served
+# with a strong ETag that is derived from its path, and with headers that allow
+# browsers and proxies to cache it indefinitely. Conditional requests with a
+# matching ETag are answered without reading the tile.
+#
+# Uniform tiles that are only recorded in the manifest are served as a tile of
+# their colour, which is encoded once for every size and colour. If a cache
+# directory is supplied, the tiles of the scales that are tiled on demand are
+# generated from the original image when they are first requested, and are kept
+# in the cache directory (see tile_cache.py).
+#
+# The descriptor and the tiles of a Deep Zoom pyramid (see tile_deepzoom.py) are
+# served in the same way, so that a standard viewer could use them, e.g.:
+#
+#     /b5ea/f562/.../image.dzi
+#     /b5ea/f562/.../image_files/12/3_7.jpg
+
+import errno
+import getopt
+import os
+import re
+import sys
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from collections import OrderedDict
+
+import image_tiler
+import tile_cache
+import tile_container
+import tile_deepzoom
+import tile_verify
+
+DEFAULT_PORT = 8080
+DEFAULT_CACHE_MB = 256
+DEFAULT_MEMORY_LIMIT_MB = 2048
+
+# Number of containers that are kept open.
+OPEN_CONTAINERS = 64
+
+# Number of manifests whose uniform tiles are kept in memory, and the number of
+# encoded uniform tiles that are shared by the tiles of the same size and colour.
+CACHED_MANIFESTS = 1024
+CACHED_PLACEHOLDERS = 1024
+
+# Tiles never change, hence, they could be cached for a year.
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+TILE_PATH_PATTERN = re.compile(r'^/((?:[0-9a-f]{4}/){10})(?:thumbnail|(\d+)/(\d+)/(\d+)_(\d+)_(\d+)_(\d+))\.' +
+                               image_tiler.PREFERRED_FORMAT + '$')
+DEEPZOOM_PATH_PATTERN = re.compile(r'^/((?:[0-9a-f]{4}/){10})(' + re.escape(tile_deepzoom.DEEPZOOM_DESCRIPTOR) +
+                                   '|' + tile_deepzoom.DEEPZOOM_FILES + r'/\d+/\d+_\d+\.' +
+                                   image_tiler.PREFERRED_FORMAT + ')$')
+
+
+# A map that keeps the most recently used values, up to a limit on the total
+# size of the values. Values that are larger than the limit are not kept.
+class LRUCache(object):
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.values = OrderedDict()
+        self.lock = threading.Lock()
+        self.num_hits = 0
+        self.num_misses = 0
+
+    def get(self, key):
+        with self.lock:
+            value = self.values.pop(key, None)
+            if value is None:
+                self.num_misses += 1
+                return None
+            self.values[key] = value
+            self.num_hits += 1
+            return value
+
+    def put(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self.lock:
+            previous = self.values.pop(key, None)
+            if previous is not None:
+                self.num_bytes -= len(previous)
+            self.values[key] = value
+            self.num_bytes += len(value)
+            while self.num_bytes > self.max_bytes:
+                key, value = self.values.popitem(last=False)
+                self.num_bytes -= len(value)
+
+
+# A container that is kept open. Since the file position of the reader is shared,
+# only one thread could read a tile at a time.
+class OpenContainer(object):
+    def __init__(self, reader):
+        self.reader = reader
+        self.lock = threading.Lock()
+
+    def read_tile(self, tile_size, scale, num_cols, num_rows, row, col):
+        with self.lock:
+            if self.reader.get_grid(tile_size, scale) != (num_cols, num_rows):
+                return None
+            return self.reader.read_tile(tile_size, scale, row, col)
+
+
+# Resolves a tile to its JPEG data, from the file of the tile, from the container
+# of the image, from the colour of a uniform tile, or from the cache of the tiles
+# that are generated on demand. The most recently used containers are kept open.
+# A container that is no longer kept open is closed once no thread is reading
+# from it.
+class TileStore(object):
+    def __init__(self, tiles_dir, lazy_cache=None):
+        if not tiles_dir.endswith('/'):
+            tiles_dir += '/'
+        self.tiles_dir = tiles_dir
+        self.lazy_cache = lazy_cache
+        self.containers = OrderedDict()
+        self.manifests = OrderedDict()
+        self.placeholders = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_container(self, tiles_path):
+        with self.lock:
+            container = self.containers.pop(tiles_path, None)
+            if container is not None:
+                self.containers[tiles_path] = container
+                return container
+        try:
+            reader = tile_container.ContainerReader(tile_container.get_container_path(tiles_path))
+        except (IOError, tile_container.InvalidContainer):
+            return None
+        container = OpenContainer(reader)
+        with self.lock:
+            self.containers[tiles_path] = container
+            if len(self.containers) > OPEN_CONTAINERS:
+                self.containers.popitem(last=False)
+        return container
+
+    # Returns the size of the original image, the grid of every tile size and scale,
+    # and the colours of the uniform tiles in the manifest of a tiles set, or None
+    # if there is no manifest.
+    def get_manifest(self, tiles_path):
+        with self.lock:
+            manifest = self.manifests.pop(tiles_path, None)
+            if manifest is not None:
+                self.manifests[tiles_path] = manifest
+                return manifest
+        manifest = image_tiler.read_manifest(tiles_path)
+        if manifest is None:
+            return None
+        grids = dict(((x['tile_size'], x['scale']), (x['columns'], x['rows'])) for x in manifest['levels'])
+        manifest = ((manifest['width'], manifest['height']), grids, image_tiler.get_uniform_tiles(manifest))
+        with self.lock:
+            self.manifests[tiles_path] = manifest
+            if len(self.manifests) > CACHED_MANIFESTS:
+                self.manifests.popitem(last=False)
+        return manifest
+
+    # Returns the JPEG data of a uniform tile, or None if the tile is not uniform.
+    def get_uniform_tile(self, tiles_path, tile_size, scale, num_cols, num_rows, row, col):
+        manifest = self.get_manifest(tiles_path)
+        if manifest is None:
+            return None
+        size, grids, uniform = manifest
+        colour = uniform.get((tile_size, scale, row, col))
+        if colour is None or grids.get((tile_size, scale)) != (num_cols, num_rows):
+            return None
+        tile_dimensions = image_tiler.get_tile_size(image_tiler.get_scaled_size(size, scale), tile_size, row, col)
+        key = (tile_dimensions, tuple(colour))
+        with self.lock:
+            data = self.placeholders.pop(key, None)
+            if data is not None:
+                self.placeholders[key] = data
+                return data
+        data = image_tiler.create_uniform_tile(tile_dimensions, colour)
+        with self.lock:
+            self.placeholders[key] = data
+            if len(self.placeholders) > CACHED_PLACEHOLDERS:
+                self.placeholders.popitem(last=False)
+        return data
+
+    # Returns the JPEG data of a tile, or of the thumbnail if the tile size is None.
+    # Returns None if the tile does not exist, or if it is not a complete JPEG file,
+    # since it would otherwise be cached indefinitely.
+    def get_tile(self, checksum_path, tile_size=None, scale=None, num_cols=None, num_rows=None, row=None,
+                 col=None):
+        tiles_path = self.tiles_dir + checksum_path
+        if tile_size is None:
+            data = read_file(tiles_path + 'thumbnail.' + image_tiler.PREFERRED_FORMAT)
+        else:
+            data = read_file(tiles_path + str(tile_size) + '/' + str(scale) + '/' +
+                             image_tiler.get_tile_name(num_cols, num_rows, row, col))
+            if data is None:
+                container = self.get_container(tiles_path)
+                if container is not None:
+                    data = container.read_tile(tile_size, scale, num_cols, num_rows, row, col)
+            if data is None:
+                data = self.get_uniform_tile(tiles_path, tile_size, scale, num_cols, num_rows, row, col)
+            if data is None and self.lazy_cache is not None:
+                data = self.lazy_cache.get_tile(tiles_path, checksum_path, tile_size, scale, num_cols, num_rows,
+                                                row, col)
+        if data is None or not tile_verify.is_complete_jpeg_data(data):
+            return None
+        return data
+
+    # Returns the descriptor or a tile of the Deep Zoom pyramid, or None if it does
+    # not exist, or if the tile is not a complete JPEG file.
+    def get_deepzoom_file(self, checksum_path, name):
+        data = read_file(self.tiles_dir + checksum_path + name)
+        if data is None or name == tile_deepzoom.DEEPZOOM_DESCRIPTOR:
+            return data
+        if not tile_verify.is_complete_jpeg_data(data):
+            return None
+        return data
+
+
+def read_file(file_path):
+    try:
+        with open(file_path, 'rb') as f:
+            return f.read()
+    except IOError as e:
+        if e.errno in (errno.ENOENT, errno.ENOTDIR):
+            return None
+        raise
+
+
+# A strong ETag that identifies the tile, which could be derived from its path
+# since the tiles of a checksum never change, e.g., "b5eaf562...-256-100-16_12_3_7".
+# tile - (checksum path, tile size, scale, columns, rows, row, column), where the
+#        tile size is None for the thumbnail
+def get_etag(tile):
+    checksum = tile[0].replace('/', '')
+    if tile[1] is None:
+        return '"' + checksum + '-thumbnail"'
+    return '"' + checksum + '-' + tile[1] + '-' + tile[2] + '-' + '_'.join(tile[3:]) + '"'
+
+
+# The ETag of the descriptor or a tile of a Deep Zoom pyramid, e.g.,
+# "b5eaf562...-image_files-12-3_7.jpg".
+def get_deepzoom_etag(checksum_path, name):
+    return '"' + checksum_path.replace('/', '') + '-' + name.replace('/', '-') + '"'
+
+
+class TileRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'PhenoDCCTileServer/1.0'
+
+    # The status line, headers and tile are sent together once the response is
+    # complete, instead of a small packet for every header, which would wait for
+    # the delayed acknowledgement of the client on persistent connections.
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.send_tile(True)
+
+    def do_HEAD(self):
+        self.send_tile(False)
+
+    def send_tile(self, include_body):
+        path = self.path.split('?', 1)[0]
+        content_type = 'image/jpeg'
+        match = TILE_PATH_PATTERN.match(path)
+        if match is not None:
+            tile = match.groups()
+            etag = get_etag(tile)
+            read_tile = lambda: self.server.store.get_tile(tile[0], *[None if x is None else int(x)
+                                                                      for x in tile[1:]])
+        else:
+            match = DEEPZOOM_PATH_PATTERN.match(path)
+            if match is None:
+                self.send_error(404, 'Not a tile')
+                return
+            checksum_path, name = match.groups()
+            etag = get_deepzoom_etag(checksum_path, name)
+            if name == tile_deepzoom.DEEPZOOM_DESCRIPTOR:
+                content_type = 'application/xml'
+            read_tile = lambda: self.server.store.get_deepzoom_file(checksum_path, name)
+        if_none_match = self.headers.get('If-None-Match')
+        etags = [] if if_none_match is None else [x.strip() for x in if_none_match.split(',')]
+        if etag in etags:
+            self.send_not_modified(etag)
+            return
+
+        data = self.server.cache.get(etag)
+        if data is None:
+            try:
+                data = read_tile()
+            except IOError as e:
+                self.send_error(500, str(e))
+                return
+            if data is None:
+                self.send_error(404, 'Tile does not exist')
+                return
+            self.server.cache.put(etag, data)
+
+        # Any ETag matches, but only a tile that exists.
+        if '*' in etags:
+            self.send_not_modified(etag)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_cache_headers(etag)
+        self.end_headers()
+        if include_body:
+            self.wfile.write(data)
+
+    def send_not_modified(self, etag):
+        self.send_response(304)
+        self.send_cache_headers(etag)
+        self.end_headers()
+
+    # The viewer draws the tiles on a canvas, which requires CORS.
+    def send_cache_headers(self, etag):
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', CACHE_CONTROL)
+        self.send_header('Access-Control-Allow-Origin', '*')
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class TileServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, tiles_dir, cache_bytes, lazy_cache=None, verbose=False):
+        HTTPServer.__init__(self, address, TileRequestHandler)
+        self.store = TileStore(tiles_dir, lazy_cache)
+        self.cache = LRUCache(cache_bytes)
+        self.verbose = verbose
+
+
+def print_usage():
+    print 'Usage:'
+    print '    tile_server.py [-p <port>] [-c <cache size>] [-v]'
+    print '                   [-l <cache directory> [-L <cache size>] [-m <memory limit>]] <tiles directory>'
+    print ''
+    print ' -p - Port to listen on (default ' + str(DEFAULT_PORT) + ').'
+    print ' -c - Maximum size (in megabytes) of the tiles kept in memory (default ' + str(DEFAULT_CACHE_MB) + ').'
+    print ' -l - Generate the tiles of the scales that are tiled on demand, and keep them in this directory.'
+    print ' -L - Maximum size (in megabytes) of the tiles in the cache directory (default ' + \
+          str(tile_cache.DEFAULT_CACHE_MB) + ').'
+    print ' -m - Tile images that require more memory (in megabytes) in bands (default ' + \
+          str(DEFAULT_MEMORY_LIMIT_MB) + ').'
+    print ' -v - Log every request.'
+
+
+def main(argv):
+    port = DEFAULT_PORT
+    cache_mb = DEFAULT_CACHE_MB
+    lazy_cache_dir = None
+    lazy_cache_mb = tile_cache.DEFAULT_CACHE_MB
+    memory_limit_mb = DEFAULT_MEMORY_LIMIT_MB
+    verbose = False
+    try:
+        opts, argv = getopt.getopt(argv, "p:c:l:L:m:v")
+        for opt, arg in opts:
+            if opt == '-p':
+                port = int(arg)
+            elif opt == '-c':
+                cache_mb = int(arg)
+            elif opt == '-l':
+                lazy_cache_dir = arg
+            elif opt == '-L':
+                lazy_cache_mb = int(arg)
+            elif opt == '-m':
+                memory_limit_mb = int(arg)
+            elif opt == '-v':
+                verbose = True
+    except (getopt.GetoptError, ValueError):
+        print_usage()
+        sys.exit(1)
+    if len(argv) != 1 or not os.path.isdir(argv[0]):
+        print_usage()
+        sys.exit(1)
+
+    lazy_cache = None
+    if lazy_cache_dir is not None:
+        if not os.path.isdir(lazy_cache_dir):
+            os.makedirs(lazy_cache_dir)
+        lazy_cache = tile_cache.TileCache(lazy_cache_dir, lazy_cache_mb * 1048576, memory_limit_mb * 1048576)
+        print 'Generating tiles on demand in "' + lazy_cache_dir + '": ' + lazy_cache.summary()
+
+    server = TileServer(('', port), argv[0], cache_mb * 1048576, lazy_cache, verbose)
+    print 'Serving tiles in "' + argv[0] + '" on port ' + str(server.server_address[1]) + '...'
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if lazy_cache is not None:
+            print lazy_cache.summary()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,236 @@
+#
+# Copyright 2014 Medical Research Council Harwell.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# @author Gagarine Yaikhom <g.yaikhom@har.mrc.ac.uk>
+#
+
+# DESCRIPTION:
+#
+# Verifies the tiles sets of images using a pool of threads. The tiles that are
+# expected for every tile size and scale are calculated from the width and
+# height of the original image, and every one of these, and the thumbnail, must
+# exist and must be a complete JPEG file. The tiles in a container (see
+# tile_container.py) are verified in the same way. Uniform tiles that are
+# recorded in the manifest instead of being written are not expected. The tiles
+# of a Deep Zoom pyramid are expected for every level of the pyramid instead.
+# This is used by phenodcc_media.py.
+
+import os
+import time
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+
+import image_tiler
+import tile_container
+import tile_deepzoom
+
+DEFAULT_WORKERS = 8
+
+# Number of tiles sets queued for every thread in the pool at any one time.
+TILE_SETS_PER_WORKER = 16
+
+# Every JPEG file starts with the start of image marker, and ends with the end of
+# image marker. A tile that was only partially written does not have the latter.
+JPEG_START_OF_IMAGE = '\xff\xd8'
+JPEG_END_OF_IMAGE = '\xff\xd9'
+
+
+# Returns the (tile size, scale, columns, rows) of the tile grid that is expected
+# for every tile size and scale.
+def get_expected_grids(size, tile_sizes, scales):
+    grids = []
+    for scale in set(scales):
+        scaled_size = image_tiler.get_scaled_size(size, scale)
+        for tile_size in set(tile_sizes):
+            grids.append((tile_size, scale) + image_tiler.get_tile_grid(scaled_size, tile_size))
+    return grids
+
+
+# Check that the file is a complete JPEG file, by reading its first and last two
+# bytes. Empty and truncated files are not complete.
+def is_complete_jpeg(file_path):
+    try:
+        with open(file_path, 'rb') as f:
+            if f.read(2) != JPEG_START_OF_IMAGE:
+                return False
+            f.seek(-2, os.SEEK_END)
+            return f.read(2) == JPEG_END_OF_IMAGE
+    except IOError:
+        return False
+
+
+def is_complete_jpeg_data(data):
+    return data.startswith(JPEG_START_OF_IMAGE) and data.endswith(JPEG_END_OF_IMAGE)
+
+
+def list_files(path):
+    try:
+        return set(os.listdir(path))
+    except OSError:
+        return set()
+
+
+# Verifies the tiles in the directory of every tile size and scale, except for the
+# uniform tiles. Returns the number of tiles that are missing, and that are not
+# complete.
+def verify_directories(tiles_path, grids, uniform):
+    num_missing = num_invalid = 0
+    for tile_size, scale, num_cols, num_rows in grids:
+        path = tiles_path + str(tile_size) + '/' + str(scale) + '/'
+        existing = list_files(path)
+        for row in range(num_rows):
+            for col in range(num_cols):
+                if (tile_size, scale, row, col) in uniform:
+                    continue
+                name = image_tiler.get_tile_name(num_cols, num_rows, row, col)
+                if name not in existing:
+                    num_missing += 1
+                elif not is_complete_jpeg(path + name):
+                    num_invalid += 1
+    return num_missing, num_invalid
+
+
+# Verifies the tiles in the container of a tiles set, except for the uniform tiles.
+# A container that could not be read is missing all of its tiles.
+def verify_container(tiles_path, grids, uniform):
+    num_missing = num_invalid = 0
+    try:
+        reader = tile_container.ContainerReader(tile_container.get_container_path(tiles_path))
+    except (IOError, tile_container.InvalidContainer):
+        return sum(num_cols * num_rows for tile_size, scale, num_cols, num_rows in grids), 0
+    with reader:
+        for tile_size, scale, num_cols, num_rows in grids:
+            if reader.get_grid(tile_size, scale) != (num_cols, num_rows):
+                num_missing += num_cols * num_rows
+                continue
+            for row in range(num_rows):
+                for col in range(num_cols):
+                    if (tile_size, scale, row, col) in uniform:
+                        continue
+                    data = reader.read_tile(tile_size, scale, row, col)
+                    if data is None:
+                        num_missing += 1
+                    elif not is_complete_jpeg_data(data):
+                        num_invalid += 1
+    return num_missing, num_invalid
+
+
+# Verifies the tiles of every level of a Deep Zoom pyramid, and its descriptor.
+def verify_deepzoom(tiles_path, grids):
+    num_missing = num_invalid = 0
+    for level, num_cols, num_rows in grids:
+        path = tile_deepzoom.get_files_path(tiles_path) + str(level) + '/'
+        existing = list_files(path)
+        for row in range(num_rows):
+            for col in range(num_cols):
+                name = tile_deepzoom.get_tile_name(col, row)
+                if name not in existing:
+                    num_missing += 1
+                elif not is_complete_jpeg(path + name):
+                    num_invalid += 1
+    if not os.path.isfile(tiles_path + tile_deepzoom.DEEPZOOM_DESCRIPTOR):
+        num_missing += 1
+    return num_missing, num_invalid
+
+
+# Verifies the tiles set of an image. The tiles set of an image that was tiled as
+# a Deep Zoom pyramid (see tile_deepzoom.py) is verified using the first tile
+# size, instead of the scales.
+#
+# tiles_path - Directory that contains the tiles set
+# size - Width and height of the original image
+# tile_sizes - List of tile sizes in pixels
+# scales - List of scales in percentage
+#
+# Returns the number of tiles that were expected, and the number of tiles
+# (including the thumbnail) that are missing or are not complete.
+def verify_tiles(tiles_path, size, tile_sizes, scales):
+    manifest = image_tiler.read_manifest(tiles_path)
+    if manifest and manifest.get('pyramid') == 'deepzoom':
+        grids = tile_deepzoom.get_grids(size, tile_sizes[0])
+        num_missing, num_invalid = verify_deepzoom(tiles_path, grids)
+        num_tiles = 1 + sum(num_cols * num_rows for level, num_cols, num_rows in grids)
+    else:
+        grids = get_expected_grids(size, tile_sizes, scales)
+        uniform = image_tiler.get_uniform_tiles(manifest) if manifest else {}
+        if tile_container.has_container(tiles_path):
+            num_missing, num_invalid = verify_container(tiles_path, grids, uniform)
+        else:
+            num_missing, num_invalid = verify_directories(tiles_path, grids, uniform)
+        num_tiles = sum(num_cols * num_rows for tile_size, scale, num_cols, num_rows in grids)
+    thumbnail_path = tiles_path + 'thumbnail.' + image_tiler.PREFERRED_FORMAT
+    if not os.path.isfile(thumbnail_path):
+        num_missing += 1
+    elif not is_complete_jpeg(thumbnail_path):
+        num_invalid += 1
+    return num_tiles + 1, num_missing, num_invalid
+
+
+class VerifyStats(object):
+    def __init__(self):
+        self.start_time = time.time()
+        self.num_images = 0
+        self.num_broken = 0
+        self.num_tiles = 0
+        self.num_missing = 0
+        self.num_invalid = 0
+
+    def add(self, num_tiles, num_missing, num_invalid):
+        self.num_images += 1
+        self.num_tiles += num_tiles
+        self.num_missing += num_missing
+        self.num_invalid += num_invalid
+        if num_missing > 0 or num_invalid > 0:
+            self.num_broken += 1
+
+    def summary(self):
+        elapsed_secs = time.time() - self.start_time
+        msg = 'Verified ' + str(self.num_images) + ' tiles sets (' + str(self.num_tiles) + \
+              ' tiles) in ' + '%.2f' % elapsed_secs + ' seconds'
+        if elapsed_secs > 0:
+            msg += ': ' + '%.2f' % (self.num_images / elapsed_secs) + ' images/s'
+        return msg + '; ' + str(self.num_broken) + ' broken tiles sets (' + str(self.num_missing) + \
+            ' missing and ' + str(self.num_invalid) + ' incomplete tiles)'
+
+
+# Verifies the tiles sets of images using a pool of threads.
+#
+# tile_sets - Iterable of (key, tiles_path, size) tuples, where the key identifies
+#             the image to the caller
+# stats - Accumulates the number of tiles sets and tiles verified
+# tile_sizes - List of tile sizes in pixels
+# scales - List of scales in percentage
+# workers - Number of tiles sets to verify in parallel
+#
+# Yields (key, broken) tuples in order of completion. Only a limited number of
+# tiles sets are queued at any one time, so that the images could be streamed.
+def verify_tile_sets(tile_sets, stats, tile_sizes, scales, workers=DEFAULT_WORKERS):
+    def verify(tile_set):
+        key, tiles_path, size = tile_set
+        return key, verify_tiles(tiles_path, size, tile_sizes, scales)
+
+    tile_sets = iter(tile_sets)
+    pool = ThreadPool(workers)
+    try:
+        while True:
+            chunk = list(islice(tile_sets, workers * TILE_SETS_PER_WORKER))
+            if not chunk:
+                break
+            for key, (num_tiles, num_missing, num_invalid) in pool.imap_unordered(verify, chunk):
+                stats.add(num_tiles, num_missing, num_invalid)
+                yield key, num_missing > 0 or num_invalid > 0
+    finally:
+        pool.terminate()